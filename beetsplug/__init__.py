@@ -24,9 +24,23 @@
 #
 #-----------------------------------------------------------------------
 # System Libraries
-#import os.path
-#import threading
-#from concurrent import futures
+import os.path
+import binascii
+import copy
+import errno
+import shutil
+import threading
+import sqlite3
+import hashlib
+import json
+import heapq
+import shlex
+import signal
+import subprocess
+import tempfile
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 import six
 
 # 3rd Party Libraries
@@ -35,583 +49,871 @@ import six
 # Application Libraries
 # System Library Overrides
 # Other Application Libraries
-#import beets
+import beets
 from beets import plugins
 from beets import ui
 from beets.library import Item, Album, parse_query_string
-#from beets import util
-#from beets import art
+from beets.library import FileOperationError, PF_KEY_DEFAULT
+from beets.dbcore.query import Query, AndQuery, OrQuery, NotQuery, TrueQuery
+from beets.dbcore.query import FieldQuery, NoneQuery
+from beets.dbcore.query import MultipleSort
+from beets import util
 
-#from beets.ui import get_path_formats, input_yn, UserError, print_
-#from beets.util import syspath, displayable_path, cpu_count, bytestring_path
-#from beetsplug import convert
+from beets.ui import get_path_formats, input_yn, UserError, print_
+from beets.ui import human_bytes, human_seconds
+from beets.util import syspath, displayable_path, cpu_count, bytestring_path
+from beets.util.functemplate import Template
+
+# Deferred Libraries
+#
+# The plugin is loaded for every beet command.  ctypes,
+# concurrent.futures, beets.util.artresizer and the convert plugin are
+# only imported where they are used, so that commands other than
+# 'alt' do not pay for them.
 
 # Conditional Libraries
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+try:
+    from mediafile import MediaFile, UnreadableFileError
+    from mediafile import Image, ImageType
+except ImportError:
+    # Bundled with beets before 1.4.8
+    from beets.mediafile import MediaFile, UnreadableFileError
+    from beets.mediafile import Image, ImageType
 
 #-----------------------------------------------------------------------
 #
 # Global Variables
 #
 #-----------------------------------------------------------------------
+# Options of the plugin, other keys name alternatives in the old
+# configuration layout
+OPTIONS = ('auto', 'alt_dir', 'alternatives', 'cache_dir', 'cache_size')
 
-#-----------------------------------------------------------------------
-#
-# Classes
-#
-# SmartAlternativesPlugin
-# AlternativesCommand
-# AlternativeFiles
-# FLAC Files
-# MP3 Files
-# Symlink Files
-# AAC Files
-#
-#-----------------------------------------------------------------------
+# Journal of library changes, stored in the beets configuration directory
+JOURNAL_FILE = 'alternatives.db'
 
-#-----------------------------------------------------------------------
-#
-# Class SmartAlternativesPlugin
-#
-# This creates the actual plugin...
-#
-# It is a sublcass of the BeetsPlugin class.
-#
-# Inputs
-# ------
-#    @param: ...
-#
-# Returns
-# -------
-#    @return: ...
-#
-# Raises
-# ------
-#    @raises: ...
-#
-#-----------------------------------------------------------------------
-class SmartAlternativesPlugin(plugins.BeetsPlugin):
-    def __init__(self):
-        super(SmartAlternativesPlugin, self).__init__()
+# Default transcode cache, in the beets configuration directory
+CACHE_DIR = 'alternatives-cache'
 
-        # Create the Config Options
-        self.config.add({
-            'auto': 'True',
-            'alt_dir': '.',
-            'alternatives': {},
-        })
+# Index of the transcode cache, stored in the cache directory
+CACHE_INDEX = b'index.db'
 
-        self._matched_alternatives = None
-        self._unmatched_alternatives = None
+# Suffixes accepted by parse_size()
+SIZE_UNITS = u'KMGT'
 
-        # For later ...
-        #if self.config['auto']:
-        #    self.register_listener('database_change', self.db_change)
+# Bytes read at once when hashing files
+COPY_CHUNK = 1024 * 1024
 
+# Ways of copying files that are not transcoded, see copy_file
+COPY_METHODS = (u'copy', u'reflink', u'hardlink')
 
-    #-------------------------------------------------------------------
-    #
-    # Function commands
-    #
-    # Create the subcommand and options for this plugin
-    #
-    # Inputs
-    # ------
-    #    @param: self
-    #
-    # Returns
-    # -------
-    #    @return: [alt_cmd]- Contains the parser information
-    #
-    # Raises
-    # ------
-    #    @raises: ...
-    #
-    #-------------------------------------------------------------------
-    def commands(self):
-        alt_cmd = ui.Subcommand('alternatives',
-                                aliases=['alt'],
-                                help='Manage alternative files')
-        alt_cmd.parser.add_option(
-            '-u', '--update', dest='update',
-            action='store_true', default=False,
-            help="I don't know what this does."
-        )
-        alt_cmd.parser.add_option(
-            '-f', '--force', dest='force',
-            action='store_true', default=False,
-            help='re-download genre when already present'
-        )
-        # How do I allow mandatory 'name'
-        #alt_cmd.parser.add_option('--name',
-        #                          help="The name of the alt to update...")
-        alt_cmd.func = self.update_cmd
-        return [alt_cmd]
+# Number of processed cover images kept in memory, see ArtCache
+ART_CACHE_SIZE = 64
 
-    #-------------------------------------------------------------------
-    #
-    # Function update_cmd
-    #
-    # ...
-    #
-    # Inputs
-    # ------
-    #    @param: self
-    #    @param: lib
-    #    @param: options
-    #
-    # Returns
-    # -------
-    #    @return: ...
-    #
-    # Raises
-    # ------
-    #    @raises: UserError
-    #
-    #-------------------------------------------------------------------
-    def update_cmd(self, lib, options, unk_option):
-        self.build_queries()
+# Bytes per copy_file_range() or sendfile() call
+KERNEL_CHUNK = 64 * 1024 * 1024
 
-        try:
-            alt = self.alternative(lib)
-        except Exception as e:
-             raise Exception("Alternative collection '{0}' not found."
-                            .format(e.args[0]))
-        #alt.update(create=options.create)
+# ioctl() request cloning a file on btrfs and XFS
+FICLONE = 0x40049409
 
-    #-------------------------------------------------------------------
-    #
-    # Function build_queries
-    #
-    # Create the search query to identify which songs to make an
-    # alternative directory structure for.
-    #
-    # Inputs
-    # ------
-    #    @param: self
-    #    @param: name
-    #    @param: lib
-    #
-    # Returns
-    # -------
-    #    @return: None (? How does that work ?)
-    #
-    # Raises
-    # ------
-    #    @raises: Exception (Pick / Make a better error code)
-    #
-    #-------------------------------------------------------------------
-    def build_queries(self):
-        """
-        Instanciate queries for the alternatives.
-
-        Each Alternate has 2 queries, one for items and one for albums. 
-        We must also remember its name.
-        _unmatched_playlists is a set of tuples (name, (q, q_sort), 
-        (album_q, album_q_sort)).
-        """
-        self._unmatched_alternatives = set()
-        self._matched_alternatives = set()
-
-        for alternative in self.config['alternatives'].get(list):
-            if 'name' not in alternative:
-                self._log.warning("Alternative configuration is missing name")
-                continue
+# Errors of link(), FICLONE and the copy system calls that mean the
+# operation is not supported for these files
+UNSUPPORTED = frozenset(getattr(errno, name) for name in [
+    'EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOTTY', 'EPERM',
+    'EMLINK', 'ENOSYS', 'EBADF'] if hasattr(errno, name))
 
-            alt_data = (alternative['name'],)
+# Item fields that Item.write() puts into the file
+TAG_FIELDS = sorted(getattr(Item, '_media_tag_fields', Item._media_fields))
 
-            try:
-                for key, Model, in (('query', Item),
-                                    ('album_query', Album)):
-                    qs = alternative.get(key)
-                    if qs is None:
-                        query_and_sort = None, None
-                    elif isinstance(qs, six.string_types):
-                        query_and_sort = parse_query_string(qs, Model)
-                    elif len(qs) == 1:
-                        query_and_sort = parse_query_string(qs[0], Model)
-                    else:
-                        # multiple queries and sorts
-                        queries, sorts = zip(*(parse_query_string(q, Model)
-                                               for q in qs))
-                        query = OrQuery(queries)
-                        final_sorts = []
-                        for s in sorts:
-                            if s:
-                                if isinstance(s, MultipleSort):
-                                    final_sorts += s.sorts
-                                else:
-                                    final_sorts.append(s)
-                        if not final_sorts:
-                            sort = None
-                        elif len(final_sorts) == 1:
-                            sort, = final_sorts
-                        else:
-                            sort = MultipleSort(final_sorts)
-                        query_and_sort = query, sort
-
-                    alt_data += (query_and_sort,)
-
-            except Exception as exc:
-                self._log.warning("invalid query in alternative {}: {}",
-                                  alternative['name'], exc)
-                continue
+# Manifest of the synced files, stored in the root of each collection
+MANIFEST_FILE = b'.beets-alternatives.db'
 
-            self._unmatched_alternatives.add(alt_data)
+# State of a synced file, see Manifest
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'source_mtime',
+                                             'source_size', 'dest_mtime',
+                                             'dest_size', 'art_mtime'])
 
-    #-------------------------------------------------------------------
-    #
-    # Function alternative
-    #
-    # ...
-    #
-    # Inputs
-    # ------
-    #    @param: self
-    #    @param: name
-    #    @param: lib
-    #
-    # Returns
-    # -------
-    #    @return: ...
-    #    @return: ...
-    #
-    # Raises
-    # ------
-    #    @raises: KeyError
-    #
-    #-------------------------------------------------------------------
-    def alternative(self, lib):
+# Manifest changes between two commits, see Manifest
+CHECKPOINT_INTERVAL = 100
 
-        for alternative in self.config['alternatives'].get(list):
-            if 'name' not in alternative:
-                self._log.warning("Alternative configuration is missing name")
-                continue
+# Library stores written in one transaction, and the longest time a
+# store waits for its transaction in seconds, see LibraryWriter
+STORE_BATCH = 500
+STORE_INTERVAL = 1.0
 
-            alt_data = (alternative['name'],)
-            for directory_data in alternative['directories']:
-                directory = directory_data['directory']
-                formats = []
-                for format_ in directory_data['formats'].split(' '):
-                    formats.append(format_)
-                paths = directory_data['paths']
-                print("Dir = ", directory)
-                print("Formats = ", formats)
-                print("Paths = ", paths)
+# Compiled configuration of an alternative, see
+# SmartAlternativesPlugin.registry()
+AlternativeSpec = namedtuple('AlternativeSpec', [
+    'name', 'query', 'sort', 'album_query', 'album_sort', 'directories',
+    'fingerprint'])
 
+# Compiled configuration of one directory of an alternative.  formats
+# is a tuple of format names, path_formats a tuple of (query,
+# Template) pairs and directory is absolute.
+DirectorySpec = namedtuple('DirectorySpec', [
+    'path_key', 'formats', 'path_formats', 'directory', 'config'])
 
-                if 'directory' not in directory_data:
-                    self._log.warning("Alternative configuration is missing directory")
-                    continue
+# What an installed program can do, see Capabilities
+ProgramInfo = namedtuple('ProgramInfo', ['path', 'mtime', 'version',
+                                         'decodes', 'encodes'])
+
+# Names of the library's formats in pipelines, other names are lower
+# cased
+FORMAT_NAMES = {
+    'wave': 'wav',
+    'windows media': 'wma',
+    "monkey's audio": 'ape',
+}
+
+# FFmpeg decoder and encoder for each format
+FFMPEG_CODECS = {
+    'aac': ('aac', 'aac'),
+    'alac': ('alac', 'alac'),
+    'ape': ('ape', None),
+    'flac': ('flac', 'flac'),
+    'mp3': ('mp3', 'libmp3lame'),
+    'ogg': ('vorbis', 'libvorbis'),
+    'opus': ('opus', 'libopus'),
+    'wav': ('pcm_s16le', 'pcm_s16le'),
+    'wma': ('wmav2', 'wmav2'),
+}
+
+# Summed throughput measurements, see Throughput
+Measurement = namedtuple('Measurement', ['seconds', 'size', 'elapsed'])
 
-        return AlternativeFiles(self.config['alt_dir'], directory, formats, paths)
+# Maximum number of ids bound to a single SQL statement
+SQL_CHUNK = 500
 
+# renameat2() arguments, see exchange_paths
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
 
-        #if conf['formats'].exists():
-        #    fmt = conf['formats'].as_str()
-        #    if fmt == u'link':
-        #        return SymlinkView(self._log, name, lib, conf)
-        #    else:
-        #        return ExternalConvert(self._log, name, fmt.split(), lib, conf)
-        #else:
-        #    return External(self._log, name, lib, conf)
+# Whether item fields fall back to the album's fields (beets >= 1.5)
+ALBUM_FALLBACK = hasattr(Item, '_cached_album')
 
+# Template functions whose result only depends on their arguments.
+# Destinations of templates using other functions, like %aunique, are
+# not kept across updates.
+PURE_FUNCTIONS = frozenset(['lower', 'upper', 'title', 'left', 'right', 'if',
+                            'asciify', 'time', 'first'])
+
+# Compiled path format, see External.path_template
+PathTemplate = namedtuple('PathTemplate', ['query', 'template', 'fields',
+                                           'persistent'])
+
+# Relative cost of encoding one second of audio to a format
+TRANSCODE_COST = {
+    'aac': 1.5,
+    'alac': 0.4,
+    'flac': 0.4,
+    'mp3': 1.0,
+    'ogg': 1.2,
+    'opus': 1.2,
+    'wav': 0.1,
+}
+
+# Relative cost of copying one second of audio
+COPY_COST = 0.05
+
+# Decoder used when an item is transcoded for several directories,
+# unless `convert.formats.wav` is configured
+DECODE_COMMAND = b'ffmpeg -i $source -y -vn -acodec pcm_s16le $dest'
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Functions
 #
-# Factory Class
+#-----------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
 #
-# It is a sublcass of the BeetsPlugin class.
+# Function sql_clause
+#
+# Translate a query into an SQLite expression for the table of model.
+#
+# Unlike Query.clause(), queries on flexible attributes are supported:
+# they become an EXISTS test on the model's attribute table.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: query - Query or None, which matches nothing
+#    @param: model - Item or Album
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: (clause, subvals)
+#    @return: (None, ()) - The query has no SQL equivalent
 #
 # Raises
 # ------
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class AlternativeFiles(object):
-    def __init__(self, alt_dir, directory, formats, paths):
-        print("Fuck")
+def sql_clause(query, model):
+    if query is None:
+        return u'0', []
+
+    if isinstance(query, (AndQuery, OrQuery)):
+        clauses = []
+        subvals = []
+        for subquery in query.subqueries:
+            clause, values = sql_clause(subquery, model)
+            if clause is None:
+                return None, ()
+            clauses.append(u'(' + clause + u')')
+            subvals += values
+        if isinstance(query, AndQuery):
+            return u' and '.join(clauses) or u'1', subvals
+        return u' or '.join(clauses) or u'0', subvals
+
+    if isinstance(query, NotQuery):
+        clause, subvals = sql_clause(query.subquery, model)
+        if clause is None:
+            return None, ()
+        return u'not (' + clause + u')', subvals
+
+    if (isinstance(query, FieldQuery) and not query.fast
+            and not isinstance(query, NoneQuery)):
+        # Match the value column of the flexible attribute instead
+        value_query = copy.copy(query)
+        value_query.field = 'value'
+        value_clause, value_subvals = value_query.col_clause()
+        if not value_clause:
+            return None, ()
+        flex = (u'EXISTS (SELECT 1 FROM {0} WHERE entity_id = {1}.id '
+                u'AND key = ?{2})')
+        clause = flex.format(model._flex_table, model._table,
+                             u' AND (' + value_clause + u')')
+        subvals = [query.field] + list(value_subvals)
+        if model is not Item or not ALBUM_FALLBACK:
+            return clause, subvals
+
+        # Items without the attribute use the album's value
+        if query.field in Album._fields:
+            album_clause, album_subvals = query.col_clause()
+            album_clause = (u'EXISTS (SELECT 1 FROM albums WHERE '
+                            u'albums.id = items.album_id AND ({0}))'
+                            .format(album_clause))
+        else:
+            album_clause = (u'EXISTS (SELECT 1 FROM album_attributes WHERE '
+                            u'entity_id = items.album_id AND key = ? '
+                            u'AND ({0}))'.format(value_clause))
+            album_subvals = [query.field] + list(value_subvals)
+        clause = u'CASE WHEN {0} THEN {1} ELSE {2} END'.format(
+            flex.format(model._flex_table, model._table, u''),
+            clause, album_clause)
+        return clause, [query.field] + subvals + list(album_subvals)
+
+    clause, subvals = query.clause()
+    if not clause:
+        return None, ()
+    return clause, list(subvals)
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
-#
-# Factory Class
+# Function parse_size
 #
-# It is a sublcass of the BeetsPlugin class.
+# Parse a size in bytes with an optional K, M, G or T suffix.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: value - int or string like '500M'
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: int
 #
 # Raises
 # ------
-#    @raises: ...
+#    @raises: UserError
 #
 #-----------------------------------------------------------------------
-class File(object):
-    def __init__(self):
-        print("Me")
+def parse_size(value):
+    if isinstance(value, six.integer_types):
+        return value
+    value = six.text_type(value or 0).strip().upper().rstrip(u'B')
+    factor = 1
+    if value and value[-1] in SIZE_UNITS:
+        factor = 1024 ** (SIZE_UNITS.index(value[-1]) + 1)
+        value = value[:-1]
+    try:
+        return int(float(value) * factor)
+    except ValueError:
+        raise UserError(u'invalid size: {0}'.format(value))
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Function audio_digest
 #
-# Factory Class
+# Hash the audio data of a file, leaving out the tags.
 #
-# It is a sublcass of the BeetsPlugin class.
+# ID3v2 tags at the start, ID3v1 and APEv2 tags at the end and FLAC
+# metadata blocks are skipped.  Other formats keep their tags inside
+# the audio container and are hashed as a whole.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: path
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: Hex digest
 #
 # Raises
 # ------
-#    @raises: ...
+#    @raises: OSError, IOError
 #
 #-----------------------------------------------------------------------
-class MP3File(File):
-    pass
+def audio_digest(path):
+    digest = hashlib.sha1()
+    with open(syspath(path), 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+
+        start = 0
+        f.seek(0)
+        header = bytearray(f.read(10))
+        if header[:3] == b'ID3' and len(header) == 10:
+            start = 10 + (header[6] << 21 | header[7] << 14 |
+                          header[8] << 7 | header[9])
+            if header[5] & 0x10:
+                start += 10
+            f.seek(start)
+            header = bytearray(f.read(4))
+
+        if header[:4] == b'fLaC':
+            start += 4
+            last = False
+            while not last:
+                f.seek(start)
+                block = bytearray(f.read(4))
+                if len(block) < 4:
+                    break
+                last = block[0] & 0x80
+                start += 4 + (block[1] << 16 | block[2] << 8 | block[3])
+
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+        if end - start >= 32:
+            f.seek(end - 32)
+            footer = bytearray(f.read(32))
+            if footer[:8] == b'APETAGEX':
+                size = footer[12] | footer[13] << 8 | footer[14] << 16 | \
+                    footer[15] << 24
+                if footer[23] & 0x80:
+                    size += 32
+                end -= min(size, end - start)
+
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, COPY_CHUNK))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
-#
-# Factory Class
+# Function tag_equal
 #
-# It is a sublcass of the BeetsPlugin class.
+# Compare an item field with the tag read from a file.  Empty values
+# are equal, floats only need to match the precision tags are written
+# with.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: value - Item field
+#    @param: tag - Value read by MediaFile
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: bool
 #
 # Raises
 # ------
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class FLACFile(File):
-    pass
+def tag_equal(value, tag):
+    if not value and not tag:
+        return True
+    if isinstance(value, float) or isinstance(tag, float):
+        try:
+            return abs(float(value) - float(tag)) < 0.01
+        except (TypeError, ValueError):
+            return False
+    return value == tag
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Function copy_file
 #
-# Factory Class
+# Copy a file as a hard link, a reflink or a real copy.  Hard links
+# fall back to reflinks, reflinks to copies if the filesystem does not
+# support them or the files are on different filesystems.
 #
-# It is a sublcass of the BeetsPlugin class.
+# The file is created under a temporary name next to the destination
+# and renamed when it is complete, so an interrupted copy never leaves
+# a truncated file at the destination.  Callers that already write to
+# a temporary name pass atomic=False.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: path
+#    @param: dest - Replaced if it exists
+#    @param: method - One of COPY_METHODS
+#    @param: atomic - Copy to a temporary name first
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: The method that was used
 #
 # Raises
 # ------
-#    @raises: ...
+#    @raises: OSError, IOError
 #
 #-----------------------------------------------------------------------
-class AACFile(File):
-    pass
+def copy_file(path, dest, method=u'copy', atomic=True):
+    if atomic:
+        directory, name = os.path.split(dest)
+        tmp = os.path.join(directory, b'.' + name + b'.' +
+                           binascii.hexlify(os.urandom(4)) + b'.tmp')
+    else:
+        tmp = dest
+        if os.path.lexists(syspath(dest)):
+            os.remove(syspath(dest))
+    try:
+        used = None
+        if method == u'hardlink':
+            try:
+                os.link(syspath(path), syspath(tmp))
+                used = u'hardlink'
+            except OSError as exc:
+                if exc.errno not in UNSUPPORTED:
+                    raise
+        if used is None and method in (u'hardlink', u'reflink') and \
+                reflink_file(path, tmp):
+            used = u'reflink'
+        if used is None:
+            kernel_copy(path, tmp)
+            used = u'copy'
+        if tmp != dest:
+            os.rename(syspath(tmp), syspath(dest))
+    except BaseException:
+        if os.path.lexists(syspath(tmp)):
+            os.remove(syspath(tmp))
+        raise
+    return used
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
-#
-# Factory Class
+# Function partial_path
 #
-# It is a sublcass of the BeetsPlugin class.
+# Get the name a file is written under until it is complete.  The
+# name only depends on the destination, so the partial files of an
+# interrupted update can be found again.  The extension is kept since
+# encoders pick the output format from it.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: dest
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: path
 #
 # Raises
 # ------
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class APEFile(File):
-    pass
+def partial_path(dest):
+    directory, name = os.path.split(dest)
+    root, ext = os.path.splitext(name)
+    return os.path.join(directory, b'.' + root + b'.part' + ext)
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
-#
-# Factory Class
+# Function reflink_file
 #
-# It is a sublcass of the BeetsPlugin class.
+# Clone a file with the FICLONE ioctl.  The copy shares its blocks
+# with the original until either is changed.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: path
+#    @param: dest
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: bool - False if the filesystem can not clone the file
 #
 # Raises
 # ------
-#    @raises: ...
+#    @raises: OSError, IOError
 #
 #-----------------------------------------------------------------------
-class WAVFile(File):
-    pass
+def reflink_file(path, dest):
+    if fcntl is None:
+        return False
+    with open(syspath(path), 'rb') as src:
+        with open(syspath(dest), 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+            except (IOError, OSError) as exc:
+                if exc.errno not in UNSUPPORTED:
+                    raise
+    return False
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Function kernel_copy
 #
-# Factory Class
+# Copy a file with copy_file_range() or sendfile(), so the data does
+# not pass through Python.  Falls back to reading and writing, also
+# when a system call stops short of the size of the file.
 #
-# It is a sublcass of the BeetsPlugin class.
+# The kernel is told that the source is read sequentially, and that
+# both files are not needed in the page cache afterwards.  A large
+# sync then does not push the rest of the system out of memory.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: path
+#    @param: dest
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: None
 #
 # Raises
 # ------
-#    @raises: ...
+#    @raises: OSError, IOError
 #
 #-----------------------------------------------------------------------
-class Program(object):
-    def __init__(self):
-        print("WTH")
+def kernel_copy(path, dest):
+    with open(syspath(path), 'rb') as src:
+        with open(syspath(dest), 'wb') as dst:
+            infd, outfd = src.fileno(), dst.fileno()
+            size = os.fstat(infd).st_size
+            _fadvise(infd, 'POSIX_FADV_SEQUENTIAL')
+            try:
+                for copier in (_copy_file_range, _sendfile):
+                    try:
+                        if copier(infd, outfd, size):
+                            return
+                    except OSError as exc:
+                        if exc.errno not in UNSUPPORTED:
+                            raise
+                    # Start over
+                    os.lseek(infd, 0, os.SEEK_SET)
+                    os.lseek(outfd, 0, os.SEEK_SET)
+                    os.ftruncate(outfd, 0)
+                shutil.copyfileobj(src, dst, COPY_CHUNK)
+            finally:
+                _fadvise(infd, 'POSIX_FADV_DONTNEED')
+                _fadvise(outfd, 'POSIX_FADV_DONTNEED')
+
+
+def _fadvise(fd, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            # Only a hint
+            pass
+
+
+def _copy_file_range(infd, outfd, size):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(infd, outfd,
+                                   min(size - copied, KERNEL_CHUNK))
+        if not count:
+            # The file ended early, leave it to the next method
+            break
+        copied += count
+    return copied == size
+
+
+def _sendfile(infd, outfd, size):
+    if not hasattr(os, 'sendfile'):
+        return False
+    copied = 0
+    while copied < size:
+        count = os.sendfile(outfd, infd, copied,
+                            min(size - copied, KERNEL_CHUNK))
+        if not count:
+            # The file ended early, leave it to the next method
+            break
+        copied += count
+    return copied == size
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
-#
-# Factory Class
+# Function exchange_paths
 #
-# It is a sublcass of the BeetsPlugin class.
+# Atomically swap two directories with renameat2(RENAME_EXCHANGE).
+# Where the system call is not available the directories are swapped
+# with two renames, during which `path` is briefly missing.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: path
+#    @param: other
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: None
 #
 # Raises
 # ------
-#    @raises: ...
+#    @raises: OSError
 #
 #-----------------------------------------------------------------------
-class LAMEProgram(Program):
-    pass
+def exchange_paths(path, other):
+    import ctypes
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError, TypeError):
+        renameat2 = None
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD, bytestring_path(path), AT_FDCWD,
+                     bytestring_path(other), RENAME_EXCHANGE) == 0:
+            return
+        error = ctypes.get_errno()
+        if error not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(error, os.strerror(error), path)
+
+    aside = other + b'.old'
+    count = 0
+    while os.path.lexists(syspath(aside)):
+        count += 1
+        aside = other + b'.old.' + str(count).encode('ascii')
+    os.rename(syspath(path), syspath(aside))
+    os.rename(syspath(other), syspath(path))
+    os.rename(syspath(aside), syspath(other))
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
-#
-# Factory Class
+# Function foreign_file
 #
-# It is a sublcass of the BeetsPlugin class.
+# Find a file in a symlink view that the view did not create: anything
+# but links, directories and the manifest.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: root
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: Path of the first such file or None
 #
 # Raises
 # ------
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class FFMPEGProgram(Program):
-    pass
+def foreign_file(root):
+    for dirpath, dirnames, filenames in os.walk(syspath(root)):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path) and \
+                    not name.startswith(MANIFEST_FILE):
+                return bytestring_path(path)
+    return None
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Function remove_links
 #
-# Factory Class
+# Remove a symlink view: its links, its manifest and the directories
+# that are empty afterwards.  Other files are kept.
 #
-# It is a sublcass of the BeetsPlugin class.
+# Inputs
+# ------
+#    @param: root
+#
+# Returns
+# -------
+#    @return: List of the paths that were kept
+#
+# Raises
+# ------
+#    @raises: OSError
+#
+#-----------------------------------------------------------------------
+def remove_links(root):
+    kept = []
+    for dirpath, dirnames, filenames in os.walk(syspath(root),
+                                                topdown=False):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or \
+                    (name.startswith(MANIFEST_FILE) and
+                     os.path.isfile(path)):
+                os.remove(path)
+            elif os.path.isdir(path):
+                if not os.listdir(path):
+                    os.rmdir(path)
+            else:
+                kept.append(bytestring_path(path))
+    if not os.listdir(syspath(root)):
+        os.rmdir(syspath(root))
+    return kept
+
+#-----------------------------------------------------------------------
+#
+# Function find_program
+#
+# Look up an executable in the PATH.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: name
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: Path or None
 #
 # Raises
 # ------
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class MACProgram(Program):
-    pass
+def find_program(name):
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Function program_output
 #
-# Factory Class
+# Run a program and get what it printed.  The exit status is ignored,
+# some programs fail when they only print their version.
 #
-# It is a sublcass of the BeetsPlugin class.
+# Inputs
+# ------
+#    @param: args
+#
+# Returns
+# -------
+#    @return: Text printed to stdout and stderr
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+def program_output(args):
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   close_fds=True)
+        output = process.communicate()[0]
+    except OSError:
+        return u''
+    return output.decode('utf-8', 'replace')
+
+#-----------------------------------------------------------------------
+#
+# Function update_alternatives
+#
+# Update several alternatives at once.  The alternatives are planned
+# and their moves, removals and tag updates applied concurrently, one
+# start() per alternative in a worker pool.  A directory is written by
+# at most one start() at a time.  Once all are done, the added items
+# of all of them are converted by one FanOut, which keeps to the
+# io_limit of every directory.  The library stores go through the
+# plugin's shared LibraryWriter.
+#
+# The pending items of all alternatives are looked up before the first
+# start(), so that those matching the whole library do so in one scan.
+# Removable collections that are missing are asked for first, so the
+# questions are not mixed up.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: alternatives - [AlternativeFiles]
+#    @param: max_workers - Defaults to the number of CPUs
+#    @param: create - Answer to External.ask_create() or None
+#    @param: full - Ignore the journal and match the whole library
+#    @param: verify - Check the external files against the manifest
+#    @param: rebuild - Rebuild symlink views instead of updating them
+#    @param: resume - Keep the files an interrupted update finished
 #
 # Returns
 # -------
-#    @return: ...
+#    @return: None
 #
 # Raises
 # ------
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class MPG321Program(Program):
-    pass
+def update_alternatives(alternatives, max_workers=None, create=None,
+                        full=False, verify=False, rebuild=False,
+                        resume=False):
+    def start(alt, seq, ids, answers):
+        alt.start(fanout, seq, ids, create=answers, verify=verify,
+                  rebuild=rebuild, resume=resume)
+
+    fanout = FanOut(max_workers)
+    planner = Worker(start, max_workers=max_workers,
+                     groups=lambda alt, *args: alt.directories(),
+                     limit=lambda directory: 1)
+    try:
+        pending = [alt.pending(full or verify) for alt in alternatives]
+        answers = [alt.ask_create(create) for alt in alternatives]
+        for alt, (seq, ids), asked in zip(alternatives, pending, answers):
+            planner.submit(alt, seq, ids, asked)
+        for _ in planner.as_completed():
+            pass
+        for external, item, dest in fanout.as_completed():
+            external.added(item, dest)
+        for alt in alternatives:
+            alt.finish()
+    finally:
+        # Running start()s still use the manifests
+        planner.shutdown()
+        fanout.shutdown()
+        for alt in alternatives:
+            alt.close()
 
 #-----------------------------------------------------------------------
 #
-# Class AlternativeFiles
+# Classes
 #
-# Factory Class
+# SmartAlternativesPlugin
+# AlternativesCommand
+# AlternativeFiles
+# FLAC Files
+# MP3 Files
+# Symlink Files
+# AAC Files
+#
+#-----------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#
+# Class SmartAlternativesPlugin
+#
+# This creates the actual plugin...
 #
 # It is a sublcass of the BeetsPlugin class.
 #
@@ -628,40 +930,6247 @@ class MPG321Program(Program):
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-class MPG123Program(Program):
-    pass
+class SmartAlternativesPlugin(plugins.BeetsPlugin):
+    def __init__(self):
+        super(SmartAlternativesPlugin, self).__init__()
+
+        # Create the Config Options
+        self.config.add({
+            'auto': True,
+            'alt_dir': '.',
+            'alternatives': {},
+            'cache_dir': None,
+            'cache_size': 0,
+        })
+
+        # Name -> AlternativeSpec, see registry()
+        self._registry = None
+        self._registry_key = None
+
+        # Changes not yet written to the journal
+        self._dirty_items = set()
+        self._dirty_albums = set()
+        self._orphans = set()
+        self._updating = False
+
+        self._cache = None
+        self._throughput = None
+        self._capabilities = None
+        # Created by the first alternative, see alternative()
+        self._stats = None
+        self._art_cache = None
+        self._convert_plugin = None
+        self._writer = None
+        self._membership = None
+
+        if self.config['auto'].get(bool):
+            self.register_listener('database_change', self.db_change)
+            self.register_listener('item_removed', self.item_removed)
+            self.register_listener('cli_exit', self.flush_journal)
+
+
+    #-------------------------------------------------------------------
+    #
+    # Function commands
+    #
+    # Create the subcommand and options for this plugin
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: [alt_cmd]- Contains the parser information
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def commands(self):
+        alt_cmd = ui.Subcommand('alternatives',
+                                aliases=['alt'],
+                                help='Manage alternative files')
+        alt_cmd.parser.usage += u' update [--all] NAME...\n' \
+            u'       beet alternatives plan NAME...\n' \
+            u'       beet alternatives cache [prune|clear]'
+        alt_cmd.parser.add_option(
+            '--all', dest='all',
+            action='store_true', default=False,
+            help='update all alternatives together'
+        )
+        alt_cmd.parser.add_option(
+            '--create', dest='create',
+            action='store_true', default=None,
+            help='create removable collections without asking'
+        )
+        alt_cmd.parser.add_option(
+            '--no-create', dest='create',
+            action='store_false',
+            help='skip removable collections that do not exist'
+        )
+        alt_cmd.parser.add_option(
+            '--full', dest='full',
+            action='store_true', default=False,
+            help='match the whole library instead of the journaled changes'
+        )
+        alt_cmd.parser.add_option(
+            '--verify-fs', dest='verify',
+            action='store_true', default=False,
+            help='check every external file instead of trusting the manifest'
+        )
+        alt_cmd.parser.add_option(
+            '--rebuild', dest='rebuild',
+            action='store_true', default=False,
+            help='build symlink views from scratch and swap them in'
+        )
+        alt_cmd.parser.add_option(
+            '--resume', dest='resume',
+            action='store_true', default=False,
+            help='keep the files an interrupted update finished'
+        )
+        alt_cmd.parser.add_option(
+            '--stats', dest='stats',
+            action='store_true', default=False,
+            help='print the time spent in each phase of the update'
+        )
+        alt_cmd.parser.add_option(
+            '--stats-json', dest='stats_json', metavar='FILE',
+            help='write the time spent in each phase of the update to FILE'
+        )
+        alt_cmd.func = self.alternatives_cmd
+        return [alt_cmd]
+
+    #-------------------------------------------------------------------
+    #
+    # Function alternatives_cmd
+    #
+    # Run the action named by the first argument.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #    @param: options
+    #    @param: args - ['update', NAME...], ['plan', NAME...] or
+    #                   ['cache', ...]
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def alternatives_cmd(self, lib, options, args):
+        if args and args[0] == 'cache':
+            self.cache_cmd(lib, options, args[1:])
+        elif args and args[0] == 'plan':
+            self.plan_cmd(lib, options, args[1:])
+        else:
+            self.update_cmd(lib, options, args)
+
+    #-------------------------------------------------------------------
+    #
+    # Function update_cmd
+    #
+    # Update the alternatives named on the command line, or all of them
+    # with --all.  They are updated together, see update_alternatives().
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #    @param: options
+    #    @param: args - ['update', NAME...]
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def update_cmd(self, lib, options, args):
+        if not args or args[0] != 'update' or \
+                (len(args) < 2 and not options.all):
+            raise UserError(u'usage: beet alt update [--all] NAME...')
+
+        self._stats = Stats()
+        with self._stats.phase('build_queries'):
+            registry = self.registry(lib)
+        names = []
+        for name in args[1:]:
+            if name not in names:
+                names.append(name)
+        if options.all:
+            names = [name for name in registry if name not in names] + names
+        alts = [self.alternative(name, lib) for name in names]
+
+        self.flush_journal(lib)
+        self._updating = True
+        try:
+            update_alternatives(alts, create=options.create,
+                                full=options.full, verify=options.verify,
+                                rebuild=options.rebuild,
+                                resume=options.resume)
+        finally:
+            self._updating = False
+            self.close_state()
+            if options.stats:
+                self._stats.print_summary()
+            if options.stats_json:
+                self._stats.dump(options.stats_json)
+
+    #-------------------------------------------------------------------
+    #
+    # Function plan_cmd
+    #
+    # Show what updating the alternatives named on the command line
+    # would do.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #    @param: options
+    #    @param: args - [NAME...]
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def plan_cmd(self, lib, options, args):
+        if not args:
+            raise UserError(u'usage: beet alt plan NAME...')
+
+        alts = [self.alternative(name, lib) for name in args]
+
+        self.flush_journal(lib)
+        try:
+            for alt in alts:
+                alt.plan(full=options.full or options.verify)
+        finally:
+            self.close_state()
+
+    #-------------------------------------------------------------------
+    #
+    # Function close_state
+    #
+    # Close the transcode cache and save the throughput measurements.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def close_state(self):
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        if self._throughput is not None:
+            self._throughput.close()
+            self._throughput = None
+        if self._capabilities is not None:
+            self._capabilities.close()
+            self._capabilities = None
+        self._membership = None
+
+    #-------------------------------------------------------------------
+    #
+    # Function throughput
+    #
+    # Get the throughput measurements shared by the alternatives.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Throughput
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def throughput(self):
+        if self._throughput is None:
+            self._throughput = Throughput(
+                os.path.join(beets.config.config_dir(), JOURNAL_FILE))
+        return self._throughput
+
+    #-------------------------------------------------------------------
+    #
+    # Function capabilities
+    #
+    # Get the installed pipeline programs shared by the alternatives.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Capabilities
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def capabilities(self):
+        if self._capabilities is None:
+            self._capabilities = Capabilities(
+                os.path.join(beets.config.config_dir(), JOURNAL_FILE))
+        return self._capabilities
+
+    #-------------------------------------------------------------------
+    #
+    # Function convert_plugin
+    #
+    # Get the convert plugin whose encoder and settings the transcoding
+    # directories use.  It is only created once an alternative needs
+    # it.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: convert.ConvertPlugin
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def convert_plugin(self):
+        if self._convert_plugin is None:
+            from beetsplug import convert
+            self._convert_plugin = convert.ConvertPlugin()
+        return self._convert_plugin
+
+    #-------------------------------------------------------------------
+    #
+    # Function library_writer
+    #
+    # Get the writer that stores the collection paths of all
+    # alternatives.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #
+    # Returns
+    # -------
+    #    @return: LibraryWriter
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def library_writer(self, lib):
+        if self._writer is None or self._writer.lib is not lib:
+            self._writer = LibraryWriter(lib)
+        self._writer.stats = self._stats
+        return self._writer
+
+    #-------------------------------------------------------------------
+    #
+    # Function membership
+    #
+    # Get the Membership that matches the queries of all alternatives
+    # in one library scan.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #
+    # Returns
+    # -------
+    #    @return: Membership
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def membership(self, lib):
+        if self._membership is None or self._membership.lib is not lib:
+            self._membership = Membership(lib)
+        return self._membership
+
+    #-------------------------------------------------------------------
+    #
+    # Function cache_cmd
+    #
+    # Show the size of the transcode cache, or remove files from it.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #    @param: options
+    #    @param: args - [] or ['prune'] or ['clear']
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def cache_cmd(self, lib, options, args):
+        if args not in ([], ['prune'], ['clear']):
+            raise UserError(u'usage: beet alt cache [prune|clear]')
+
+        cache = self.open_cache()
+        try:
+            if args:
+                count, size = cache.prune(0 if args[0] == 'clear' else None)
+                print_(u'Removed {0} files ({1})'
+                       .format(count, human_bytes(size)))
+            count, size = cache.stats()
+            print_(u'{0}: {1} files, {2} of {3}'.format(
+                displayable_path(cache.directory), count,
+                human_bytes(size), human_bytes(cache.max_size)))
+        finally:
+            cache.close()
+
+    #-------------------------------------------------------------------
+    #
+    # Function open_cache
+    #
+    # Open the transcode cache configured by `cache_dir` and
+    # `cache_size`.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: TranscodeCache
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def open_cache(self):
+        if self.config['cache_dir'].get():
+            directory = self.config['cache_dir'].as_filename()
+        else:
+            directory = os.path.join(beets.config.config_dir(), CACHE_DIR)
+        return TranscodeCache(bytestring_path(directory),
+                              parse_size(self.config['cache_size'].get()))
+
+    #-------------------------------------------------------------------
+    #
+    # Function transcode_cache
+    #
+    # Get the transcode cache shared by the alternatives being updated.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: TranscodeCache or None if `cache_size` is zero
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def transcode_cache(self):
+        if not parse_size(self.config['cache_size'].get()):
+            return None
+        if self._cache is None:
+            self._cache = self.open_cache()
+        return self._cache
+
+    #-------------------------------------------------------------------
+    #
+    # Function db_change
+    #
+    # Remember a changed item or album for the journal.
+    #
+    # Changes made by the plugin itself while updating only touch the
+    # alternative paths and are ignored.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #    @param: model - The changed Item or Album
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def db_change(self, lib, model):
+        if self._updating:
+            return
+        if isinstance(model, Album):
+            self._dirty_albums.add(model.id)
+        else:
+            self._dirty_items.add(model.id)
+
+    #-------------------------------------------------------------------
+    #
+    # Function item_removed
+    #
+    # Remember the alternative paths of a removed item.  They can not
+    # be looked up anymore once the item is gone from the library.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def item_removed(self, item):
+        for key in item.keys():
+            if key.startswith('alt.'):
+                self._orphans.add((key, item[key]))
+
+    #-------------------------------------------------------------------
+    #
+    # Function flush_journal
+    #
+    # Write the buffered changes to the journal of every alternative.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def flush_journal(self, lib):
+        if not (self._dirty_items or self._dirty_albums or self._orphans):
+            return
+
+        names = [name for name, _ in self._alternative_views()]
+        journal = self.journal()
+        try:
+            journal.record(names, self._dirty_items, self._dirty_albums,
+                           self._orphans)
+        finally:
+            journal.close()
+        self._dirty_items = set()
+        self._dirty_albums = set()
+        self._orphans = set()
+
+    #-------------------------------------------------------------------
+    #
+    # Function journal
+    #
+    # Open the journal of changed items in the beets configuration
+    # directory.  The caller closes it.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Journal
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def journal(self):
+        return Journal(os.path.join(beets.config.config_dir(), JOURNAL_FILE))
+
+    #-------------------------------------------------------------------
+    #
+    # Function _alternative_views
+    #
+    # Iterate over the configured alternatives.
+    #
+    # Alternatives are configured as a list of mappings with a 'name'
+    # under the 'alternatives' option.  Without that list, every other
+    # key of the plugin configuration is taken as the name of an
+    # alternative, which is how the plugin used to be configured.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Generator of (name, view)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def _alternative_views(self):
+        alternatives = self.config['alternatives']
+        if not alternatives.get():
+            for name in self.config.keys():
+                if name not in OPTIONS:
+                    yield name, self.config[name]
+            return
+
+        for index, alternative in enumerate(alternatives.get(list)):
+            if 'name' not in alternative:
+                self._log.warning("Alternative configuration is missing name")
+                continue
+            yield alternative['name'], alternatives[index]
+
+    #-------------------------------------------------------------------
+    #
+    # Function registry
+    #
+    # Get the compiled alternatives.  Queries are parsed and paths are
+    # resolved once; the registry is compiled again only if the
+    # configuration changed.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: lib - Library whose directory relative directories are
+    #                  based on, or None for the configured directory
+    #
+    # Returns
+    # -------
+    #    @return: dict of name -> AlternativeSpec
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def registry(self, lib=None):
+        if lib is not None:
+            libdir = lib.directory
+        else:
+            libdir = bytestring_path(beets.config['directory'].as_filename())
+        alt_dir = bytestring_path(self.config['alt_dir'].as_str())
+        basedir = os.path.join(libdir, alt_dir)
+        key = json.dumps({
+            'alternatives': self.config.flatten(),
+            'paths': beets.config['paths'].flatten(),
+            'basedir': repr(basedir),
+        }, sort_keys=True, default=repr)
+        if self._registry is None or key != self._registry_key:
+            self._registry = OrderedDict()
+            for name, view in self._alternative_views():
+                spec = self.compile_alternative(name, view, basedir)
+                if spec is not None:
+                    self._registry[name] = spec
+            self._registry_key = key
+        return self._registry
+
+    #-------------------------------------------------------------------
+    #
+    # Function build_queries
+    #
+    # Compile the registry for the configured library directory ahead
+    # of its first use.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def build_queries(self):
+        self.registry()
+
+    #-------------------------------------------------------------------
+    #
+    # Function compile_alternative
+    #
+    # Parse the queries and directories of an alternative.  Each
+    # alternative has an item and an album query, the album query
+    # defaults to the item query.  Several queries are combined with
+    # OR.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name
+    #    @param: view - View of the alternative
+    #    @param: basedir - Base of relative directories
+    #
+    # Returns
+    # -------
+    #    @return: AlternativeSpec or None if a query is invalid
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def compile_alternative(self, name, view, basedir):
+        queries = []
+        try:
+            for key, Model, in (('query', Item), ('album_query', Album)):
+                if key == 'album_query' and key not in view:
+                    key = 'query'
+                qs = view[key].get() if key in view else None
+                if qs is None:
+                    query_and_sort = None, None
+                elif isinstance(qs, six.string_types):
+                    query_and_sort = parse_query_string(qs, Model)
+                elif len(qs) == 1:
+                    query_and_sort = parse_query_string(qs[0], Model)
+                else:
+                    # multiple queries and sorts
+                    parsed, sorts = zip(*(parse_query_string(q, Model)
+                                          for q in qs))
+                    query = OrQuery(parsed)
+                    final_sorts = []
+                    for s in sorts:
+                        if s:
+                            if isinstance(s, MultipleSort):
+                                final_sorts += s.sorts
+                            else:
+                                final_sorts.append(s)
+                    if not final_sorts:
+                        sort = None
+                    elif len(final_sorts) == 1:
+                        sort, = final_sorts
+                    else:
+                        sort = MultipleSort(final_sorts)
+                    query_and_sort = query, sort
+                queries.extend(query_and_sort)
+        except Exception as exc:
+            self._log.warning("invalid query in alternative {}: {}",
+                              name, exc)
+            return None
+
+        directories = []
+        for index, directory_view in enumerate(self._directory_views(view)):
+            if index:
+                path_key = u'alt.{0}.{1}'.format(name, index)
+            else:
+                path_key = u'alt.{0}'.format(name)
+            directories.append(self.compile_directory(
+                name, directory_view, path_key, basedir))
+
+        fingerprint = json.dumps({
+            'alternative': view.flatten(),
+            'paths': beets.config['paths'].flatten(),
+            'alt_dir': self.config['alt_dir'].get(),
+        }, sort_keys=True, default=repr)
+        fingerprint = hashlib.sha1(fingerprint.encode('utf8')).hexdigest()
+        return AlternativeSpec(name, *queries,
+                               directories=tuple(directories),
+                               fingerprint=fingerprint)
+
+    #-------------------------------------------------------------------
+    #
+    # Function compile_directory
+    #
+    # Resolve the formats, paths and location of a directory.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name - Name of the alternative
+    #    @param: view - View of the directory
+    #    @param: path_key - Flexible attribute storing the paths
+    #    @param: basedir - Base of relative directories
+    #
+    # Returns
+    # -------
+    #    @return: DirectorySpec
+    #
+    # Raises
+    # ------
+    #    @raises: confuse.ConfigError
+    #
+    #-------------------------------------------------------------------
+    def compile_directory(self, name, view, path_key, basedir):
+        formats = ()
+        if view['formats'].exists():
+            formats = tuple(view['formats'].as_str().split())
+        if 'paths' in view:
+            path_formats = get_path_formats(view['paths'])
+        else:
+            path_formats = get_path_formats(beets.config['paths'])
+        if 'directory' in view:
+            directory = bytestring_path(view['directory'].as_str())
+        else:
+            directory = bytestring_path(name)
+        if not os.path.isabs(syspath(directory)):
+            directory = os.path.normpath(os.path.join(basedir, directory))
+        return DirectorySpec(path_key, formats, tuple(path_formats),
+                             directory, view)
+
+    #-------------------------------------------------------------------
+    #
+    # Function alternative
+    #
+    # Create the collection for an alternative with one External for
+    # each of its directories.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name
+    #    @param: lib
+    #
+    # Returns
+    # -------
+    #    @return: AlternativeFiles
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    def alternative(self, name, lib):
+        spec = self.registry(lib).get(name)
+        if spec is None:
+            raise UserError(u"Alternative collection '{0}' not found."
+                            .format(name))
+
+        if self._stats is None:
+            self._stats = Stats()
+        if self._art_cache is None:
+            self._art_cache = ArtCache()
+        externals = []
+        for directory in spec.directories:
+            if directory.formats == (u'link',):
+                externals.append(SymlinkView(self._log, lib, spec,
+                                             directory))
+            elif directory.formats and directory.formats[0] not in \
+                    (u'hardlink', u'reflink'):
+                externals.append(ExternalConvert(
+                    self._log, lib, spec, directory,
+                    cache=self.transcode_cache(),
+                    convert_plugin=self.convert_plugin()))
+                if externals[-1].auto_pipeline:
+                    externals[-1].capabilities = self.capabilities()
+            else:
+                externals.append(External(self._log, lib, spec, directory))
+            externals[-1].throughput = self.throughput()
+            externals[-1].stats = self._stats
+            externals[-1].art_cache = self._art_cache
+            externals[-1].writer = self.library_writer(lib)
+            externals[-1].membership = self.membership(lib)
+
+        journal = self.journal() if self.config['auto'].get(bool) else None
+        return AlternativeFiles(self._log, name, lib, externals, journal,
+                                spec.fingerprint)
+
+    #-------------------------------------------------------------------
+    #
+    # Function _directory_views
+    #
+    # Iterate over the directories of an alternative.  An alternative
+    # without a 'directories' list is its own single directory.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: view - View of the alternative
+    #
+    # Returns
+    # -------
+    #    @return: Generator of directory views
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def _directory_views(self, view):
+        if 'directories' not in view:
+            yield view
+            return
+
+        for index, directory_data in enumerate(view['directories'].get(list)):
+            if 'directory' not in directory_data:
+                self._log.warning(
+                    "Alternative configuration is missing directory")
+                continue
+            yield view['directories'][index]
+
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# An alternative collection, made of one or more directories.
+#
+# Updating uses the journal to look only at the items that changed
+# since the last update, unless the configuration of the alternative
+# changed or a full update is requested.
+#
+# Inputs
+# ------
+#    @param: log
+#    @param: name
+#    @param: lib
+#    @param: externals - One External per directory
+#    @param: journal - Journal or None if changes are not tracked
+#    @param: fingerprint - Hash of the alternative's configuration
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class AlternativeFiles(object):
+    def __init__(self, log, name, lib, externals, journal, fingerprint):
+        self._log = log
+        self.name = name
+        self.lib = lib
+        self.externals = externals
+        self.journal = journal
+        self.fingerprint = fingerprint
+        # Set by start()
+        self._seq = None
+        self._done = False
+
+    #-------------------------------------------------------------------
+    #
+    # Function update
+    #
+    # Update every directory of the alternative.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: create - Answer to External.ask_create() or None
+    #    @param: full - Ignore the journal and match the whole library
+    #    @param: verify - Check the external files against the manifest
+    #    @param: rebuild - Rebuild symlink views instead of updating them
+    #    @param: resume - Keep the files an interrupted update finished
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def update(self, create=None, full=False, verify=False, rebuild=False,
+               resume=False):
+        update_alternatives([self], create=create, full=full,
+                            verify=verify, rebuild=rebuild, resume=resume)
+
+    #-------------------------------------------------------------------
+    #
+    # Function start
+    #
+    # Apply the changes to every directory of the alternative and
+    # submit the added items to the fanout.  finish() completes the
+    # update once the fanout is done.  May run in a worker thread.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: fanout - FanOut
+    #    @param: seq, ids - Result of pending()
+    #    @param: create - Result of ask_create()
+    #    @param: verify - Check the external files against the manifest
+    #    @param: rebuild - Rebuild symlink views instead of updating them
+    #    @param: resume - Keep the files an interrupted update finished
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def start(self, fanout, seq, ids, create=None, verify=False,
+              rebuild=False, resume=False):
+        journal = self.journal
+        self._seq = seq
+        self._done = True
+        for external in self.externals:
+            if rebuild and isinstance(external, SymlinkView):
+                external.rebuild(journal=journal)
+            elif not external.update(create=create.get(external), ids=ids,
+                                     journal=journal, verify=verify,
+                                     converter=fanout.converter(external),
+                                     resume=resume):
+                self._done = False
+
+    #-------------------------------------------------------------------
+    #
+    # Function ask_create
+    #
+    # Ask whether the missing removable directories are created, before
+    # start() runs in a worker thread.  Symlink views are always
+    # created.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: create - Answer given on the command line or None
+    #
+    # Returns
+    # -------
+    #    @return: {External: bool} of the missing directories
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def ask_create(self, create=None):
+        return dict((external, external.ask_create(create))
+                    for external in self.externals
+                    if not isinstance(external, SymlinkView)
+                    and not os.path.isdir(syspath(external.directory)))
+
+    #-------------------------------------------------------------------
+    #
+    # Function directories
+    #
+    # Get the directories the alternative writes to.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Set of directories
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def directories(self):
+        return set(external.directory for external in self.externals)
+
+    #-------------------------------------------------------------------
+    #
+    # Function finish
+    #
+    # Clear the journal entries the update handled.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def finish(self):
+        journal = self.journal
+        if journal is not None and self._done:
+            journal.clear(self.name, self._seq)
+            journal.set_fingerprint(self.name, self.fingerprint)
+
+    #-------------------------------------------------------------------
+    #
+    # Function close
+    #
+    # Close the manifests and the journal.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def close(self):
+        for external in self.externals:
+            external.close_manifest()
+            if external.membership is not None:
+                external.membership.discard(external)
+        if self.journal is not None:
+            self.journal.close()
+
+    #-------------------------------------------------------------------
+    #
+    # Function plan
+    #
+    # Print what update() would do for every directory.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: full - Ignore the journal and match the whole library
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def plan(self, full=False):
+        try:
+            _, ids = self.pending(full)
+            for external in self.externals:
+                summary = external.plan(ids=ids, journal=self.journal)
+                print_(u'{0}:'.format(displayable_path(external.directory)))
+                print_(u'  add: {add} ({transcode} transcoded, {0})'
+                       .format(human_bytes(summary['bytes']), **summary))
+                for key in ('move', 'write', 'embed_art', 'remove'):
+                    print_(u'  {0}: {1}'.format(key.replace('_', ' '),
+                                                summary[key]))
+
+                # Transcodes run in parallel, copies are bound by the
+                # device
+                seconds = summary['transcode_time'] / cpu_count() + \
+                    summary['copy_time']
+                if summary['unmeasured']:
+                    print_(u'  estimated time: {0} ({1} files without '
+                           u'measurements)'
+                           .format(u'more than ' + human_seconds(seconds)
+                                   if seconds else u'unknown',
+                                   summary['unmeasured']))
+                else:
+                    print_(u'  estimated time: {0}'
+                           .format(human_seconds(seconds)))
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+
+    #-------------------------------------------------------------------
+    #
+    # Function pending
+    #
+    # Get the journaled items that need to be checked.  If all items
+    # need to be checked the directories are registered with their
+    # Membership, so that they are matched in one scan.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: full - Ignore the journal
+    #
+    # Returns
+    # -------
+    #    @return: (seq, ids) - The last journal entry and the item ids,
+    #             ids is None if all items need to be checked
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def pending(self, full=False):
+        journal = self.journal
+        seq = None
+        if journal is not None:
+            seq, item_ids, album_ids = journal.pending(self.name)
+        if journal is None or full or \
+                journal.fingerprint(self.name) != self.fingerprint:
+            for external in self.externals:
+                if external.membership is not None:
+                    external.membership.register(external)
+            return seq, None
+        ids = self.expand_ids(item_ids, album_ids)
+        self._log.debug(u'{0}: {1} journaled items'
+                        .format(self.name, len(ids)))
+        return seq, ids
+
+    #-------------------------------------------------------------------
+    #
+    # Function expand_ids
+    #
+    # Add the items of dirty albums to the dirty items.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item_ids
+    #    @param: album_ids
+    #
+    # Returns
+    # -------
+    #    @return: Set of item ids
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def expand_ids(self, item_ids, album_ids):
+        ids = set(item_ids)
+        for album_id in album_ids:
+            album = self.lib.get_album(album_id)
+            if album is not None:
+                ids.update(item.id for item in album.items())
+        return ids
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# Factory Class
+#
+# It is a sublcass of the BeetsPlugin class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class File(object):
+    def __init__(self):
+        print("Me")
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# Factory Class
+#
+# It is a sublcass of the BeetsPlugin class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class MP3File(File):
+    pass
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# Factory Class
+#
+# It is a sublcass of the BeetsPlugin class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class FLACFile(File):
+    pass
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# Factory Class
+#
+# It is a sublcass of the BeetsPlugin class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class AACFile(File):
+    pass
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# Factory Class
+#
+# It is a sublcass of the BeetsPlugin class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class APEFile(File):
+    pass
+
+#-----------------------------------------------------------------------
+#
+# Class AlternativeFiles
+#
+# Factory Class
+#
+# It is a sublcass of the BeetsPlugin class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class WAVFile(File):
+    pass
+
+#-----------------------------------------------------------------------
+#
+# Class Program
+#
+# A stage of a Pipeline.  Subclasses name an executable and the
+# arguments it is run with as decoder (reads the source file, writes
+# WAV), filter (WAV to WAV) or encoder (reads WAV, writes the
+# destination file).  '$source' and '$dest' are replaced by the files
+# or by '-' where the stage reads from or writes to a pipe, '$options'
+# by the options given in the pipeline configuration.  Stages that
+# can not play a role leave it None.
+#
+# The formats a program decodes and encodes, and its version, are
+# found by probe() and kept by Capabilities.  speed ranks programs
+# that handle the same formats when no measurements exist.
+#
+# Inputs
+# ------
+#    @param: options - Extra arguments
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class Program(object):
+
+    name = None
+    decoder = None
+    filter = None
+    encoder = None
+    version_args = ['--version']
+    decodes = frozenset()
+    encodes = frozenset()
+    speed = 1
+
+    def __init__(self, options=()):
+        self.options = list(options)
+
+    #-------------------------------------------------------------------
+    #
+    # Function probe
+    #
+    # Find out what the installed program can do.  This runs the
+    # program, use Capabilities.probe() to get the cached result.
+    #
+    # Inputs
+    # ------
+    #    @param: cls
+    #    @param: path - The executable
+    #
+    # Returns
+    # -------
+    #    @return: (version, decodes, encodes)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    @classmethod
+    def probe(cls, path):
+        return (cls.version(path), frozenset(cls.decodes),
+                frozenset(cls.encodes))
+
+    @classmethod
+    def version(cls, path):
+        for line in program_output([path] + cls.version_args).splitlines():
+            if line.strip():
+                return line.strip()
+        return u''
+
+    #-------------------------------------------------------------------
+    #
+    # Function encoder_options
+    #
+    # Get the options that make the encoder write a format.
+    #
+    # Inputs
+    # ------
+    #    @param: cls
+    #    @param: fmt
+    #
+    # Returns
+    # -------
+    #    @return: [argument]
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    @classmethod
+    def encoder_options(cls, fmt):
+        return []
+
+    #-------------------------------------------------------------------
+    #
+    # Function programs
+    #
+    # Get all subclasses, also those of subclasses, parents first.
+    #
+    # Inputs
+    # ------
+    #    @param: cls
+    #
+    # Returns
+    # -------
+    #    @return: [Program class]
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    @classmethod
+    def programs(cls):
+        found = []
+        for program in cls.__subclasses__():
+            for subclass in [program] + program.programs():
+                if subclass not in found:
+                    found.append(subclass)
+        return found
+
+    #-------------------------------------------------------------------
+    #
+    # Function named
+    #
+    # Create a stage from the program's name.
+    #
+    # Inputs
+    # ------
+    #    @param: cls
+    #    @param: name - Name of the program, e.g. 'sox'
+    #    @param: options
+    #
+    # Returns
+    # -------
+    #    @return: Program
+    #
+    # Raises
+    # ------
+    #    @raises: UserError - No program has this name
+    #
+    #-------------------------------------------------------------------
+    @classmethod
+    def named(cls, name, options=()):
+        for program in cls.programs():
+            if program.name == name:
+                return program(options)
+        raise UserError(u'unknown pipeline program: {0}'.format(name))
+
+    #-------------------------------------------------------------------
+    #
+    # Function args
+    #
+    # Get the command line of the stage.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: role - 'decoder', 'filter' or 'encoder'
+    #    @param: source - Path or '-'
+    #    @param: dest - Path or '-'
+    #
+    # Returns
+    # -------
+    #    @return: [argument]
+    #
+    # Raises
+    # ------
+    #    @raises: UserError - The program can not play the role
+    #
+    #-------------------------------------------------------------------
+    def args(self, role, source, dest):
+        template = getattr(self, role)
+        if template is None:
+            raise UserError(u'{0} can not be used as {1}'
+                            .format(self.name, role))
+        args = [self.name]
+        for arg in template:
+            if arg == '$options':
+                args.extend(self.options)
+            elif arg == '$source':
+                args.append(source)
+            elif arg == '$dest':
+                args.append(dest)
+            else:
+                args.append(arg)
+        return args
+
+    def __str__(self):
+        return u' '.join([self.name] + self.options)
+
+#-----------------------------------------------------------------------
+#
+# Class LAMEProgram
+#
+# The LAME MP3 encoder.  It also decodes MP3 files.
+#
+# It is a sublcass of the Program class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class LAMEProgram(Program):
+    name = 'lame'
+    decoder = ['--quiet', '--decode', '$options', '$source', '$dest']
+    encoder = ['--quiet', '$options', '$source', '$dest']
+    decodes = encodes = frozenset(['mp3'])
+    speed = 3
+
+#-----------------------------------------------------------------------
+#
+# Class FFMPEGProgram
+#
+# FFmpeg, which decodes and encodes most formats.  The options of a
+# filter are usually an audio filter, like '-af loudnorm'.
+#
+# It is a sublcass of the Program class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class FFMPEGProgram(Program):
+    name = 'ffmpeg'
+    decoder = ['-v', 'error', '-i', '$source', '-vn', '$options',
+               '-f', 'wav', '$dest']
+    filter = ['-v', 'error', '-f', 'wav', '-i', '$source', '$options',
+              '-f', 'wav', '$dest']
+    encoder = ['-v', 'error', '-f', 'wav', '-i', '$source', '$options',
+               '-y', '$dest']
+    version_args = ['-version']
+    speed = 2
+
+    @classmethod
+    def probe(cls, path):
+        codecs = []
+        for args in (['-decoders'], ['-encoders']):
+            names = set()
+            for line in program_output([path, '-hide_banner'] +
+                                       args).splitlines():
+                fields = line.split()
+                # ' A....D flac  FLAC (Free Lossless Audio Codec)'
+                if len(fields) > 1 and len(fields[0]) == 6 and \
+                        fields[0].startswith('A'):
+                    names.add(fields[1])
+            codecs.append(names)
+        decodes = frozenset(fmt for fmt, (decoder, _) in FFMPEG_CODECS.items()
+                            if decoder in codecs[0])
+        encodes = frozenset(fmt for fmt, (_, encoder) in FFMPEG_CODECS.items()
+                            if encoder in codecs[1])
+        return cls.version(path), decodes, encodes
+
+    @classmethod
+    def encoder_options(cls, fmt):
+        # The extension of m4a files does not tell AAC from ALAC
+        return ['-c:a', FFMPEG_CODECS[fmt][1]]
+
+#-----------------------------------------------------------------------
+#
+# Class MACProgram
+#
+# The Monkey's Audio (APE) codec.
+#
+# It is a sublcass of the Program class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class MACProgram(Program):
+    name = 'mac'
+    decoder = ['$source', '$dest', '-d']
+    encoder = ['$source', '$dest', '$options']
+    # It prints its version when run without arguments
+    version_args = []
+    decodes = encodes = frozenset(['ape'])
+    speed = 3
+
+#-----------------------------------------------------------------------
+#
+# Class MPG321Program
+#
+# The mpg321 MP3 decoder.
+#
+# It is a sublcass of the Program class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class MPG321Program(Program):
+    name = 'mpg321'
+    decoder = ['--quiet', '$options', '-w', '$dest', '$source']
+    decodes = frozenset(['mp3'])
+
+#-----------------------------------------------------------------------
+#
+# Class MPG123Program
+#
+# The mpg123 MP3 decoder.
+#
+# It is a sublcass of the Program class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class MPG123Program(Program):
+    name = 'mpg123'
+    decoder = ['--quiet', '$options', '-w', '$dest', '$source']
+    decodes = frozenset(['mp3'])
+    speed = 3
+
+#-----------------------------------------------------------------------
+#
+# Class SOXProgram
+#
+# SoX.  Its options are effects, like 'rate 44100' to resample or
+# 'gain -n' to normalize.
+#
+# It is a sublcass of the Program class.
+#
+# Inputs
+# ------
+#    @param: ...
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class SOXProgram(Program):
+    name = 'sox'
+    decoder = ['$source', '-t', 'wav', '$dest', '$options']
+    filter = ['-t', 'wav', '$source', '-t', 'wav', '$dest', '$options']
+    encoder = ['-t', 'wav', '$source', '$dest', '$options']
+    speed = 2
+
+    @classmethod
+    def probe(cls, path):
+        formats = frozenset()
+        for line in program_output([path, '-h']).splitlines():
+            if line.startswith('AUDIO FILE FORMATS:'):
+                formats = frozenset(line.split(':', 1)[1].split())
+        formats &= frozenset(FFMPEG_CODECS)
+        return cls.version(path), formats, formats
+
+#-----------------------------------------------------------------------
+#
+# Class Pipeline
+#
+# Transcodes a file with a chain of programs connected by pipes, like
+# 'mac | sox rate 44100 | lame -V2'.  The first program decodes the
+# source file, the last one encodes to the destination and the ones
+# in between filter the audio.  Every stage is a process of its own,
+# so they run in parallel, and the audio never goes through a
+# temporary file.
+#
+# Inputs
+# ------
+#    @param: stages - [Program], at least a decoder and an encoder
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: UserError - There are less than two stages or a program
+#                         can not play its role
+#
+#-----------------------------------------------------------------------
+class Pipeline(object):
+    def __init__(self, stages):
+        if len(stages) < 2:
+            raise UserError(u'a pipeline needs a decoder and an encoder')
+        roles = ['decoder'] + ['filter'] * (len(stages) - 2) + ['encoder']
+        self.stages = list(zip(stages, roles))
+        for program, role in self.stages:
+            # Fail on the configuration instead of the first file
+            program.args(role, '-', '-')
+        self.command = u' | '.join(six.text_type(program)
+                                   for program in stages).encode('utf-8')
+
+    #-------------------------------------------------------------------
+    #
+    # Function parse
+    #
+    # Create a pipeline from its configuration.
+    #
+    # Inputs
+    # ------
+    #    @param: cls
+    #    @param: value - Programs and their options separated by '|'
+    #
+    # Returns
+    # -------
+    #    @return: Pipeline
+    #
+    # Raises
+    # ------
+    #    @raises: UserError
+    #
+    #-------------------------------------------------------------------
+    @classmethod
+    def parse(cls, value):
+        stages = []
+        for stage in value.split(u'|'):
+            args = shlex.split(stage)
+            if not args:
+                raise UserError(u'empty stage in pipeline: {0}'
+                                .format(value))
+            stages.append(Program.named(args[0], args[1:]))
+        return cls(stages)
+
+    #-------------------------------------------------------------------
+    #
+    # Function fastest
+    #
+    # Choose the fastest pipeline of the installed programs for a pair
+    # of formats.  Measured speeds decide once every candidate has been
+    # measured, the programs' speed ranks until then.
+    #
+    # Inputs
+    # ------
+    #    @param: cls
+    #    @param: capabilities - Capabilities
+    #    @param: source - Format of the source file, e.g. 'flac'
+    #    @param: target - Format to encode to
+    #    @param: throughput - Throughput or None
+    #
+    # Returns
+    # -------
+    #    @return: Pipeline or None if no programs can do it
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    @classmethod
+    def fastest(cls, capabilities, source, target, throughput=None):
+        decoders = []
+        encoders = []
+        for program in Program.programs():
+            info = capabilities.probe(program)
+            if info is None:
+                continue
+            if program.decoder is not None and source in info.decodes:
+                decoders.append(program)
+            if program.encoder is not None and target in info.encodes:
+                encoders.append(program)
+        candidates = [(decoder.speed + encoder.speed,
+                       cls([decoder(),
+                            encoder(encoder.encoder_options(target))]))
+                      for decoder in decoders for encoder in encoders]
+        if not candidates:
+            return None
+
+        rates = [throughput.rate(pipeline.command.decode('utf-8'))
+                 if throughput is not None else None
+                 for _, pipeline in candidates]
+        if all(rate and rate.elapsed for rate in rates):
+            candidates = [(rate.seconds / rate.elapsed, pipeline)
+                          for rate, (_, pipeline) in zip(rates, candidates)]
+        # max() keeps the first of equally fast candidates
+        return max(candidates, key=lambda c: c[0])[1]
+
+    #-------------------------------------------------------------------
+    #
+    # Function run
+    #
+    # Transcode a file.  All stages are started at once, each reading
+    # the output of the one before.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: source
+    #    @param: dest
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: subprocess.CalledProcessError - A stage failed
+    #    @raises: UserError - A program is not installed
+    #
+    #-------------------------------------------------------------------
+    def run(self, source, dest):
+        processes = []
+        try:
+            self._start(processes, source, dest)
+            for process, _, _ in processes:
+                process.wait()
+            # Stages before the one that failed stop with a broken pipe.
+            # A shell reports that as 128 + SIGPIPE.
+            failed = [p for p in processes if p[0].returncode]
+            failed.sort(key=lambda p: p[0].returncode in
+                        (-signal.SIGPIPE, 128 + signal.SIGPIPE))
+            if failed:
+                process, args, errors = failed[0]
+                errors.seek(0)
+                raise subprocess.CalledProcessError(process.returncode,
+                                                    args, errors.read())
+        except BaseException:
+            for process, _, _ in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            raise
+        finally:
+            for process, _, errors in processes:
+                if process.stdout is not None:
+                    process.stdout.close()
+                errors.close()
+
+    def _start(self, processes, source, dest):
+        stdin = None
+        with open(os.devnull, 'wb') as devnull:
+            for index, (program, role) in enumerate(self.stages):
+                last = index == len(self.stages) - 1
+                args = program.args(role,
+                                    syspath(source) if index == 0 else '-',
+                                    syspath(dest) if last else '-')
+                errors = tempfile.TemporaryFile()
+                try:
+                    process = subprocess.Popen(
+                        args, stdin=stdin, stderr=errors,
+                        stdout=devnull if last else subprocess.PIPE,
+                        close_fds=True)
+                except OSError as exc:
+                    errors.close()
+                    raise UserError(u"couldn't invoke '{0}': {1}"
+                                    .format(program.name, exc))
+                processes.append((process, args, errors))
+                if stdin is not None:
+                    # Only the stages hold the ends of the pipe, so a
+                    # stage that stops ends the others
+                    stdin.close()
+                stdin = process.stdout
+
+#-----------------------------------------------------------------------
+#
+# Class Journal
+#
+# Persistent record of the library changes that have not been synced
+# to the alternatives yet.
+#
+# The 'database_change' and 'item_removed' listeners buffer the ids of
+# every changed item and album and the alternative paths of removed
+# items.  The buffer is written to the journal when the command exits,
+# so that 'beet alt update' only has to look at those ids instead of
+# re-matching the whole library.
+#
+# Inputs
+# ------
+#    @param: path - Location of the SQLite journal database
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class Journal(object):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dirty (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            alternative TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            UNIQUE (alternative, kind, id)
+        );
+        CREATE TABLE IF NOT EXISTS orphans (
+            path_key TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (path_key, path)
+        );
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            alternative TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Used by start() in a worker thread, one thread at a time
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    #-------------------------------------------------------------------
+    #
+    # Function record
+    #
+    # Mark items and albums as dirty for every alternative in names
+    # and remember the alternative paths of removed items.
+    #
+    # Re-recording an id moves it to the end of the journal so that
+    # a change made while an update is running is not cleared by it.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: names - Names of the alternatives to mark
+    #    @param: item_ids
+    #    @param: album_ids
+    #    @param: orphans - Iterable of (path_key, path) tuples
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def record(self, names, item_ids=(), album_ids=(), orphans=()):
+        rows = [(name, kind, id)
+                for name in names
+                for kind, ids in (('item', item_ids), ('album', album_ids))
+                for id in ids]
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO dirty (alternative, kind, id) '
+                'VALUES (?, ?, ?)', rows)
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO orphans (path_key, path) '
+                'VALUES (?, ?)', orphans)
+
+    #-------------------------------------------------------------------
+    #
+    # Function pending
+    #
+    # Get the dirty ids recorded for an alternative.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name - Name of the alternative
+    #
+    # Returns
+    # -------
+    #    @return: seq - Last journal entry read, to be passed to clear()
+    #    @return: item_ids - Set of dirty item ids
+    #    @return: album_ids - Set of dirty album ids
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def pending(self, name):
+        seq = 0
+        ids = {'item': set(), 'album': set()}
+        rows = self._connection.execute(
+            'SELECT seq, kind, id FROM dirty WHERE alternative = ?', (name,))
+        for row_seq, kind, id in rows:
+            seq = max(seq, row_seq)
+            ids[kind].add(id)
+        return seq, ids['item'], ids['album']
+
+    #-------------------------------------------------------------------
+    #
+    # Function clear
+    #
+    # Forget the entries of an alternative up to and including seq.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name - Name of the alternative
+    #    @param: seq - Value returned by pending()
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def clear(self, name, seq):
+        with self._connection:
+            self._connection.execute(
+                'DELETE FROM dirty WHERE alternative = ? AND seq <= ?',
+                (name, seq))
+
+    #-------------------------------------------------------------------
+    #
+    # Function orphans
+    #
+    # Get the paths of removed items for one alternative directory.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: path_key - Flexible attribute of the directory
+    #
+    # Returns
+    # -------
+    #    @return: List of paths
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def orphans(self, path_key):
+        rows = self._connection.execute(
+            'SELECT path FROM orphans WHERE path_key = ?', (path_key,))
+        return [path for path, in rows]
+
+    def discard_orphan(self, path_key, path):
+        with self._connection:
+            self._connection.execute(
+                'DELETE FROM orphans WHERE path_key = ? AND path = ?',
+                (path_key, path))
+
+    #-------------------------------------------------------------------
+    #
+    # Function fingerprint
+    #
+    # Get the configuration fingerprint of an alternative's last
+    # complete update.  The journal is only trusted if the fingerprint
+    # still matches; otherwise paths or queries may have changed for
+    # items that are not in the journal.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name - Name of the alternative
+    #
+    # Returns
+    # -------
+    #    @return: fingerprint
+    #    @return: None - The alternative was never updated
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def fingerprint(self, name):
+        row = self._connection.execute(
+            'SELECT fingerprint FROM fingerprints WHERE alternative = ?',
+            (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_fingerprint(self, name, fingerprint):
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO fingerprints '
+                '(alternative, fingerprint) VALUES (?, ?)',
+                (name, fingerprint))
+
+#-----------------------------------------------------------------------
+#
+# Class Manifest
+#
+# Record of the files synced to one collection directory: the source
+# mtime and size, the destination path, mtime and size and the mtime
+# of the album art at the time of the last sync.
+#
+# Actions are planned from the manifest so that the external files are
+# not stat()ed on every update.  The manifest lives in the root of the
+# collection; it disappears with the files if the device is wiped.
+# Paths are stored as BLOBs because they need not be valid UTF-8.
+#
+# It also keeps a snapshot of the items with a path in the collection
+# as an IdSet.  The snapshot is removed while an update runs and saved
+# again at its end, so that an interrupted update leaves none behind.
+#
+# The library writer, if any, is flushed before every commit.  The
+# manifest then never records a finished file whose path the library
+# has not stored yet, even if the update is killed right after.
+#
+# Inputs
+# ------
+#    @param: path - Location of the SQLite manifest database
+#    @param: path_key - Flexible attribute of the directory
+#    @param: writer - LibraryWriter of the collection or None
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class Manifest(object):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path_key TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            path BLOB NOT NULL,
+            source_mtime REAL NOT NULL,
+            source_size INTEGER NOT NULL,
+            dest_mtime REAL NOT NULL,
+            dest_size INTEGER NOT NULL,
+            art_mtime REAL,
+            PRIMARY KEY (path_key, item_id)
+        );
+        CREATE TABLE IF NOT EXISTS destinations (
+            path_key TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            path BLOB NOT NULL,
+            PRIMARY KEY (path_key, item_id)
+        );
+        CREATE TABLE IF NOT EXISTS pending (
+            path_key TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            path BLOB NOT NULL,
+            tmp BLOB NOT NULL,
+            PRIMARY KEY (path_key, item_id)
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            path_key TEXT PRIMARY KEY,
+            ids BLOB NOT NULL
+        );
+    """
+
+    def __init__(self, path, path_key, writer=None):
+        self.path = path
+        self.path_key = path_key
+        self.writer = writer
+        self._entries = {}
+        self._destinations = {}
+        self._loaded = False
+        self._changes = 0
+        # Opened by start() in a worker thread and closed by the caller
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(self.SCHEMA)
+            # Paths used to be stored as text
+            for table, column in [('files', 'path'),
+                                  ('destinations', 'path'),
+                                  ('pending', 'path'), ('pending', 'tmp')]:
+                self._connection.execute(
+                    'UPDATE {0} SET {1} = CAST({1} AS BLOB) '
+                    'WHERE typeof({1}) = \'text\''.format(table, column))
+
+    def close(self):
+        self.commit()
+        self._connection.close()
+
+    #-------------------------------------------------------------------
+    #
+    # Function commit
+    #
+    # Write the changes to disk.  Changes are committed every
+    # CHECKPOINT_INTERVAL changes, so an update that is killed only
+    # loses the last few of them.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: force - Commit even if few changes are pending
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def commit(self, force=True):
+        if not force:
+            self._changes += 1
+            if self._changes < CHECKPOINT_INTERVAL:
+                return
+        if self.writer is not None:
+            self.writer.flush()
+        self._connection.commit()
+        self._changes = 0
+
+    #-------------------------------------------------------------------
+    #
+    # Function load
+    #
+    # Read all entries at once.  Cheaper than single lookups when the
+    # whole collection is checked.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def load(self):
+        rows = self._connection.execute(
+            'SELECT item_id, path, source_mtime, source_size, dest_mtime, '
+            'dest_size, art_mtime FROM files WHERE path_key = ?',
+            (self.path_key,))
+        self._entries = dict((row[0], self._entry(row[1:])) for row in rows)
+        rows = self._connection.execute(
+            'SELECT item_id, key, path FROM destinations WHERE path_key = ?',
+            (self.path_key,))
+        self._destinations = dict((row[0], (row[1], bytes(row[2])))
+                                  for row in rows)
+        self._loaded = True
+
+    #-------------------------------------------------------------------
+    #
+    # Function get
+    #
+    # Get the entry of an item.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item_id
+    #
+    # Returns
+    # -------
+    #    @return: ManifestEntry
+    #    @return: None - The item is not in the manifest
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def get(self, item_id):
+        if self._loaded or item_id in self._entries:
+            return self._entries.get(item_id)
+        row = self._connection.execute(
+            'SELECT path, source_mtime, source_size, dest_mtime, '
+            'dest_size, art_mtime FROM files '
+            'WHERE path_key = ? AND item_id = ?',
+            (self.path_key, item_id)).fetchone()
+        entry = self._entry(row) if row else None
+        self._entries[item_id] = entry
+        return entry
+
+    def _entry(self, row):
+        return ManifestEntry(bytes(row[0]), *row[1:])
+
+    #-------------------------------------------------------------------
+    #
+    # Function set
+    #
+    # Record the state of an item's external file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item_id
+    #    @param: path
+    #    @param: source_mtime
+    #    @param: source_size
+    #    @param: dest_mtime
+    #    @param: dest_size
+    #    @param: art_mtime - None if the item has no album art
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def set(self, item_id, path, source_mtime, source_size, dest_mtime,
+            dest_size, art_mtime):
+        entry = ManifestEntry(path, source_mtime, source_size, dest_mtime,
+                              dest_size, art_mtime)
+        self._entries[item_id] = entry
+        self._connection.execute(
+            'INSERT OR REPLACE INTO files (path_key, item_id, path, '
+            'source_mtime, source_size, dest_mtime, dest_size, art_mtime) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.path_key, item_id, sqlite3.Binary(path),
+             source_mtime, source_size, dest_mtime, dest_size, art_mtime))
+        self.commit(force=False)
+
+    def remove(self, item_id):
+        self._entries[item_id] = None
+        self._connection.execute(
+            'DELETE FROM files WHERE path_key = ? AND item_id = ?',
+            (self.path_key, item_id))
+        self._destinations[item_id] = None
+        self._connection.execute(
+            'DELETE FROM destinations WHERE path_key = ? AND item_id = ?',
+            (self.path_key, item_id))
+        self.commit(force=False)
+
+    def remove_path(self, path):
+        path = sqlite3.Binary(path)
+        for item_id, in self._connection.execute(
+                'SELECT item_id FROM files WHERE path_key = ? AND path = ?',
+                (self.path_key, path)).fetchall():
+            self.remove(item_id)
+
+    #-------------------------------------------------------------------
+    #
+    # Function destination
+    #
+    # Get the destination rendered for an item by a previous update.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item_id
+    #
+    # Returns
+    # -------
+    #    @return: (key, path) or None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def destination(self, item_id):
+        if self._loaded or item_id in self._destinations:
+            return self._destinations.get(item_id)
+        row = self._connection.execute(
+            'SELECT key, path FROM destinations '
+            'WHERE path_key = ? AND item_id = ?',
+            (self.path_key, item_id)).fetchone()
+        destination = (row[0], bytes(row[1])) if row else None
+        self._destinations[item_id] = destination
+        return destination
+
+    #-------------------------------------------------------------------
+    #
+    # Function set_destinations
+    #
+    # Save rendered destinations.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: destinations - dict of item id -> (key, path)
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def set_destinations(self, destinations):
+        self._destinations.update(destinations)
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO destinations (path_key, item_id, key, '
+            'path) VALUES (?, ?, ?, ?)',
+            ((self.path_key, item_id, key, sqlite3.Binary(path))
+             for item_id, (key, path) in destinations.items()))
+
+    #-------------------------------------------------------------------
+    #
+    # Function add_pending
+    #
+    # Remember that an item is being written to the collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item_id
+    #    @param: path - Destination of the item
+    #    @param: tmp - Name the file is written under until it is
+    #                  complete
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def add_pending(self, item_id, path, tmp):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO pending (path_key, item_id, path, tmp) '
+            'VALUES (?, ?, ?, ?)',
+            (self.path_key, item_id, sqlite3.Binary(path),
+             sqlite3.Binary(tmp)))
+
+    def remove_pending(self, item_id):
+        self._connection.execute(
+            'DELETE FROM pending WHERE path_key = ? AND item_id = ?',
+            (self.path_key, item_id))
+        self.commit(force=False)
+
+    def clear_pending(self):
+        self._connection.execute(
+            'DELETE FROM pending WHERE path_key = ?', (self.path_key,))
+        self.commit()
+
+    #-------------------------------------------------------------------
+    #
+    # Function pending
+    #
+    # Get the items that were being written when an update was
+    # interrupted.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: [(item_id, path, tmp)]
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def pending(self):
+        rows = self._connection.execute(
+            'SELECT item_id, path, tmp FROM pending WHERE path_key = ? '
+            'ORDER BY item_id', (self.path_key,))
+        return [(row[0], bytes(row[1]), bytes(row[2]))
+                for row in rows]
+
+    #-------------------------------------------------------------------
+    #
+    # Function snapshot
+    #
+    # Get the items that had a path in the collection after the last
+    # update.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: IdSet or None if there is no snapshot
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def snapshot(self):
+        row = self._connection.execute(
+            'SELECT ids FROM snapshots WHERE path_key = ?',
+            (self.path_key,)).fetchone()
+        if row is None:
+            return None
+        return IdSet(data=row[0])
+
+    #-------------------------------------------------------------------
+    #
+    # Function set_snapshot
+    #
+    # Save or remove the snapshot.  The change is committed at once.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids - IdSet or None to remove the snapshot
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def set_snapshot(self, ids):
+        if ids is None:
+            self._connection.execute(
+                'DELETE FROM snapshots WHERE path_key = ?', (self.path_key,))
+        else:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO snapshots (path_key, ids) '
+                'VALUES (?, ?)',
+                (self.path_key, sqlite3.Binary(ids.tobytes())))
+        self.commit()
+
+#-----------------------------------------------------------------------
+#
+# Class TranscodeCache
+#
+# Transcoded files, keyed by the audio data of the source file and the
+# encoder.  A transcode from the cache only needs its tags written,
+# which makes renamed tracks, wiped devices and alternatives sharing a
+# format cheap.
+#
+# The least recently used files are removed when the cache grows over
+# its maximum size.  An index in the cache directory keeps track of
+# the files.  It may be used from the converter threads.  The lock
+# only guards the index; files are copied outside of it, and a file
+# that is being fetched is not evicted.
+#
+# Inputs
+# ------
+#    @param: directory
+#    @param: max_size - In bytes
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class TranscodeCache(object):
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            ext TEXT,
+            size INTEGER,
+            atime REAL)""",
+    ]
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        util.mkdirall(os.path.join(directory, CACHE_INDEX))
+        self._lock = threading.Lock()
+        self._digests = {}
+        # key -> number of fetches copying the file
+        self._pinned = {}
+        self._conn = sqlite3.connect(
+            syspath(os.path.join(directory, CACHE_INDEX)),
+            check_same_thread=False)
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    #-------------------------------------------------------------------
+    #
+    # Function key
+    #
+    # Get the cache key for transcoding a file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: path - The source file
+    #    @param: command - The encoder command template
+    #    @param: ext - The extension of the target format
+    #
+    # Returns
+    # -------
+    #    @return: Hex digest
+    #
+    # Raises
+    # ------
+    #    @raises: OSError, IOError
+    #
+    #-------------------------------------------------------------------
+    def key(self, path, command, ext):
+        st = os.stat(syspath(path))
+        memo = (path, st.st_mtime, st.st_size)
+        with self._lock:
+            digest = self._digests.get(memo)
+        if digest is None:
+            digest = audio_digest(path)
+            with self._lock:
+                self._digests[memo] = digest
+
+        key = hashlib.sha1(digest.encode('ascii'))
+        key.update(b'\0' + command + b'\0' + ext)
+        return key.hexdigest()
+
+    #-------------------------------------------------------------------
+    #
+    # Function path
+    #
+    # Get the location of a cached file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: key
+    #    @param: ext
+    #
+    # Returns
+    # -------
+    #    @return: path
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def path(self, key, ext):
+        key = key.encode('ascii')
+        return os.path.join(self.directory, key[:2], key + b'.' + ext)
+
+    #-------------------------------------------------------------------
+    #
+    # Function contains
+    #
+    # Check whether a transcode is cached.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: key
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def contains(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    #-------------------------------------------------------------------
+    #
+    # Function fetch
+    #
+    # Copy a cached transcode to dest.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: key
+    #    @param: ext
+    #    @param: dest
+    #
+    # Returns
+    # -------
+    #    @return: False if the transcode is not cached
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error, util.FilesystemError
+    #
+    #-------------------------------------------------------------------
+    def fetch(self, key, ext, dest):
+        path = self.path(key, ext)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return False
+            if not os.path.isfile(syspath(path)):
+                self._forget(key)
+                return False
+            self._conn.execute('UPDATE entries SET atime = ? WHERE key = ?',
+                               (time.time(), key))
+            self._conn.commit()
+            # Not evicted while it is copied
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            copy_file(path, dest, u'reflink')
+        except EnvironmentError:
+            if os.path.isfile(syspath(path)):
+                raise
+            # Removed by another process, e.g. `beet alt cache clear`
+            with self._lock:
+                self._forget(key)
+            return False
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if not self._pinned[key]:
+                    del self._pinned[key]
+        return True
+
+    #-------------------------------------------------------------------
+    #
+    # Function _forget
+    #
+    # Drop a file that is missing from the index.  The caller holds
+    # the lock.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: key
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def _forget(self, key):
+        self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self._conn.commit()
+
+    #-------------------------------------------------------------------
+    #
+    # Function store
+    #
+    # Add a transcoded file to the cache.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: key
+    #    @param: ext
+    #    @param: src - The transcoded file
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error, util.FilesystemError
+    #
+    #-------------------------------------------------------------------
+    def store(self, key, ext, src):
+        size = os.path.getsize(syspath(src))
+        if size > self.max_size:
+            return
+
+        path = self.path(key, ext)
+        with self._lock:
+            util.mkdirall(path)
+        copy_file(src, path, u'reflink')
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (key, ext.decode('ascii'), size, time.time()))
+            self._evict(self.max_size)
+            self._conn.commit()
+
+    #-------------------------------------------------------------------
+    #
+    # Function stats
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: (number of files, total size)
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def stats(self):
+        with self._lock:
+            count, size = self._conn.execute(
+                'SELECT COUNT(*), SUM(size) FROM entries').fetchone()
+        return count, size or 0
+
+    #-------------------------------------------------------------------
+    #
+    # Function prune
+    #
+    # Forget files that are missing from the cache directory and remove
+    # the least recently used files above a size.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: max_size - Defaults to the maximum size of the cache
+    #
+    # Returns
+    # -------
+    #    @return: (number of files, total size) removed
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        with self._lock:
+            rows = self._conn.execute('SELECT key, ext FROM entries')
+            missing = [(key,) for key, ext in rows
+                       if not os.path.isfile(syspath(
+                           self.path(key, ext.encode('ascii'))))]
+            self._conn.executemany('DELETE FROM entries WHERE key = ?',
+                                   missing)
+            removed = self._evict(max_size)
+            self._conn.commit()
+        return removed
+
+    #-------------------------------------------------------------------
+    #
+    # Function _evict
+    #
+    # Remove the least recently used files until the cache fits into
+    # max_size.  Files that are being fetched are kept.  The caller
+    # holds the lock and commits.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: max_size
+    #
+    # Returns
+    # -------
+    #    @return: (number of files, total size) removed
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def _evict(self, max_size):
+        total = self._conn.execute(
+            'SELECT SUM(size) FROM entries').fetchone()[0] or 0
+        count = removed = 0
+        rows = self._conn.execute(
+            'SELECT key, ext, size FROM entries ORDER BY atime').fetchall()
+        for key, ext, size in rows:
+            if total - removed <= max_size:
+                break
+            if key in self._pinned:
+                continue
+            path = self.path(key, ext.encode('ascii'))
+            if os.path.isfile(syspath(path)):
+                util.remove(path)
+                util.prune_dirs(os.path.dirname(path), root=self.directory)
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            count += 1
+            removed += size
+        return count, removed
+
+#-----------------------------------------------------------------------
+#
+# Class Throughput
+#
+# Measured speed of the encoders and of copying files, stored in the
+# journal database.  Used to estimate how long an update takes.
+#
+# Measurements are summed per kind: the encoder command, or the copy
+# method for files that are not transcoded.  They may be added from the
+# converter threads.
+#
+# Inputs
+# ------
+#    @param: path - Location of the database
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class Throughput(object):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS throughput (
+            kind TEXT PRIMARY KEY,
+            seconds REAL NOT NULL,
+            size INTEGER NOT NULL,
+            elapsed REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.executescript(self.SCHEMA)
+        self._totals = dict(
+            (kind, Measurement(seconds, size, elapsed))
+            for kind, seconds, size, elapsed in self._connection.execute(
+                'SELECT kind, seconds, size, elapsed FROM throughput'))
+
+    #-------------------------------------------------------------------
+    #
+    # Function close
+    #
+    # Save the new measurements.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def close(self):
+        with self._connection:
+            for kind, m in self._pending.items():
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO throughput VALUES (?, 0, 0, 0)',
+                    (kind,))
+                self._connection.execute(
+                    'UPDATE throughput SET seconds = seconds + ?, '
+                    'size = size + ?, elapsed = elapsed + ? WHERE kind = ?',
+                    (m.seconds, m.size, m.elapsed, kind))
+        self._connection.close()
+        self._pending = {}
+
+    #-------------------------------------------------------------------
+    #
+    # Function measure
+    #
+    # Add a measurement.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: kind - Encoder command or 'copy'
+    #    @param: seconds - Length of the audio
+    #    @param: size - Size of the written file
+    #    @param: elapsed - Wall-clock time it took
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def measure(self, kind, seconds, size, elapsed):
+        with self._lock:
+            for totals in (self._pending, self._totals):
+                m = totals.get(kind, Measurement(0.0, 0, 0.0))
+                totals[kind] = Measurement(m.seconds + seconds,
+                                           m.size + size,
+                                           m.elapsed + elapsed)
+
+    #-------------------------------------------------------------------
+    #
+    # Function rate
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: kind
+    #
+    # Returns
+    # -------
+    #    @return: Measurement totals or None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def rate(self, kind):
+        with self._lock:
+            return self._totals.get(kind)
+
+#-----------------------------------------------------------------------
+#
+# Class Capabilities
+#
+# The version and formats of the installed pipeline programs, see
+# Program.probe().  Probing runs the programs, so the results are kept
+# in the plugin's database until the executable changes.  Each program
+# is looked up at most once per run.  It may be used from the
+# converter threads.
+#
+# Inputs
+# ------
+#    @param: path - Location of the SQLite database
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class Capabilities(object):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS programs (
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            mtime REAL NOT NULL,
+            version TEXT NOT NULL,
+            decodes TEXT NOT NULL,
+            encodes TEXT NOT NULL,
+            PRIMARY KEY (name, path)
+        );
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._found = {}
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.executescript(self.SCHEMA)
+        self._programs = dict(
+            ((name, path), ProgramInfo(path, mtime, version,
+                                       frozenset(decodes.split()),
+                                       frozenset(encodes.split())))
+            for name, path, mtime, version, decodes, encodes
+            in self._connection.execute(
+                'SELECT name, path, mtime, version, decodes, encodes '
+                'FROM programs'))
+
+    #-------------------------------------------------------------------
+    #
+    # Function close
+    #
+    # Save the new results.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def close(self):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO programs VALUES (?, ?, ?, ?, ?, ?)',
+                ((name, info.path, info.mtime, info.version,
+                  u' '.join(sorted(info.decodes)),
+                  u' '.join(sorted(info.encodes)))
+                 for name, info in self._pending))
+        self._connection.close()
+        self._pending = []
+
+    #-------------------------------------------------------------------
+    #
+    # Function probe
+    #
+    # Get what an installed program can do.  The program only runs if
+    # its executable is new or changed since it was last probed.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: program - Program subclass
+    #
+    # Returns
+    # -------
+    #    @return: ProgramInfo or None if it is not installed
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def probe(self, program):
+        with self._lock:
+            if program.name in self._found:
+                return self._found[program.name]
+            info = None
+            path = find_program(program.name)
+            if path is not None:
+                mtime = os.path.getmtime(path)
+                info = self._programs.get((program.name, path))
+                if info is None or info.mtime != mtime:
+                    info = ProgramInfo(path, mtime, *program.probe(path))
+                    self._programs[(program.name, path)] = info
+                    self._pending.append((program.name, info))
+            self._found[program.name] = info
+            return info
+
+#-----------------------------------------------------------------------
+#
+# Class Stats
+#
+# Time spent per phase of an update, with counters like the bytes read
+# and written and the transcode time per format.
+#
+# Phases that run in the converter threads are summed over all
+# threads, so they can add up to more than the wall time.  Comparing
+# them with the wall time shows whether an update waited for the
+# encoders or for the device.
+#
+# Inputs
+# ------
+#    @param: None
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        # name -> [calls, seconds]
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        # format -> seconds
+        self.transcodes = OrderedDict()
+
+    #-------------------------------------------------------------------
+    #
+    # Function phase
+    #
+    # Time the enclosed block.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name
+    #
+    # Returns
+    # -------
+    #    @return: Context manager
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    #-------------------------------------------------------------------
+    #
+    # Function timed
+    #
+    # Time producing every value of an iterable.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: name
+    #    @param: iterable
+    #
+    # Returns
+    # -------
+    #    @return: Generator of the values
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def timed(self, name, iterable):
+        values = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                value = next(values)
+            except StopIteration:
+                self.add(name, time.time() - start, calls=0)
+                return
+            self.add(name, time.time() - start)
+            yield value
+
+    def add(self, name, seconds, calls=1):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += calls
+            phase[1] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def transcoded(self, fmt, seconds):
+        with self._lock:
+            self.transcodes[fmt] = self.transcodes.get(fmt, 0.0) + seconds
+
+    #-------------------------------------------------------------------
+    #
+    # Function report
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: dict that can be dumped as JSON
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def report(self):
+        with self._lock:
+            return {
+                'wall_time': time.time() - self.start,
+                'phases': OrderedDict(
+                    (name, {'calls': calls, 'seconds': seconds})
+                    for name, (calls, seconds) in self.phases.items()),
+                'counters': OrderedDict(self.counters),
+                'transcode_seconds': OrderedDict(self.transcodes),
+            }
+
+    #-------------------------------------------------------------------
+    #
+    # Function print_summary
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def print_summary(self):
+        report = self.report()
+        print_(u'{0:<16}{1:>10}{2:>12}'.format(u'phase', u'calls',
+                                               u'seconds'))
+        for name, phase in report['phases'].items():
+            print_(u'{0:<16}{1:>10}{2:>12.3f}'.format(
+                name, phase['calls'], phase['seconds']))
+        counters = report['counters']
+        print_(u'read {0}, wrote {1}'.format(
+            human_bytes(counters.get('bytes_read', 0)),
+            human_bytes(counters.get('bytes_written', 0))))
+        for name, value in counters.items():
+            if not name.startswith('bytes_'):
+                print_(u'{0}: {1}'.format(name.replace('_', ' '), value))
+        copying = report['phases'].get('copy')
+        if copying and copying['seconds']:
+            print_(u'copied at {0}/s'.format(human_bytes(
+                counters.get('bytes_copied', 0) / copying['seconds'])))
+        for fmt, seconds in report['transcode_seconds'].items():
+            print_(u'transcoding to {0}: {1:.3f} seconds'.format(fmt,
+                                                                 seconds))
+        print_(u'wall time: {0:.3f} seconds'.format(report['wall_time']))
+
+    #-------------------------------------------------------------------
+    #
+    # Function dump
+    #
+    # Write the report to a JSON file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: path
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: IOError
+    #
+    #-------------------------------------------------------------------
+    def dump(self, path):
+        with open(syspath(path), 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+#-----------------------------------------------------------------------
+#
+# Class LibraryWriter
+#
+# Stores the items whose collection paths changed in batches.  Every
+# Item.store() is a transaction of its own, which makes storing the
+# paths of a large sync slow.  The items are kept until STORE_BATCH of
+# them are waiting or the oldest waited STORE_INTERVAL seconds, and
+# are then stored in one transaction.
+#
+# The writer is shared by all directories.  Stores from several
+# threads are serialized.
+#
+# Inputs
+# ------
+#    @param: lib
+#    @param: batch - Number of items stored together
+#    @param: interval - Longest time an item waits in seconds
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class LibraryWriter(object):
+    def __init__(self, lib, batch=STORE_BATCH, interval=STORE_INTERVAL):
+        self.lib = lib
+        self.batch = batch
+        self.interval = interval
+        self.stats = Stats()
+        self._items = []
+        self._since = None
+        self._lock = threading.Lock()
+
+    #-------------------------------------------------------------------
+    #
+    # Function store
+    #
+    # Queue an item to be stored.  Only its changed fields are written,
+    # so different copies of the same item can be queued.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def store(self, item):
+        with self._lock:
+            if not self._items:
+                self._since = time.time()
+            self._items.append(item)
+            if len(self._items) >= self.batch or \
+                    time.time() - self._since >= self.interval:
+                self._flush()
+
+    #-------------------------------------------------------------------
+    #
+    # Function flush
+    #
+    # Store all queued items.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        items, self._items = self._items, []
+        if not items:
+            return
+        with self.stats.phase('store'), self.lib.transaction():
+            for item in items:
+                item.store()
+
+#-----------------------------------------------------------------------
+#
+# Class IdSet
+#
+# A set of item ids stored as a bitset: bit n of the byte array is set
+# if id n is in the set.  The whole library fits into a few hundred
+# kilobytes instead of a set of Python ints.  Union, intersection and
+# difference turn both bitsets into one large Python int each, combine
+# those with a single bitwise operation and convert the result back to
+# bytes, so no id is looked at one by one.
+#
+# Inputs
+# ------
+#    @param: ids - Initial ids
+#    @param: data - Bytes of a bitset, see tobytes()
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class IdSet(object):
+    def __init__(self, ids=(), data=None):
+        self._bits = bytearray(data or b'')
+        for id in ids:
+            self.add(id)
+
+    def add(self, id):
+        index = id >> 3
+        if index >= len(self._bits):
+            # Grow geometrically, ids are added in ascending order
+            size = max(index + 1, 2 * len(self._bits))
+            self._bits.extend(bytearray(size - len(self._bits)))
+        self._bits[index] |= 1 << (id & 7)
+
+    def discard(self, id):
+        index = id >> 3
+        if index < len(self._bits):
+            self._bits[index] &= ~(1 << (id & 7)) & 0xff
+
+    def __contains__(self, id):
+        index = id >> 3
+        return index < len(self._bits) and \
+            bool(self._bits[index] & (1 << (id & 7)))
+
+    def __iter__(self):
+        for index, byte in enumerate(self._bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (index << 3) | bit
+
+    def __len__(self):
+        return bin(self._int(len(self._bits))).count('1')
+
+    def __bool__(self):
+        return any(self._bits)
+
+    __nonzero__ = __bool__
+
+    def __or__(self, other):
+        return self._combine(other, lambda a, b: a | b)
+
+    def __and__(self, other):
+        return self._combine(other, lambda a, b: a & b)
+
+    def __sub__(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def copy(self):
+        return IdSet(data=self._bits)
+
+    def tobytes(self):
+        return bytes(self._bits.rstrip(b'\0'))
+
+    #-------------------------------------------------------------------
+    #
+    # Function _combine
+    #
+    # Apply a bitwise operation to both sets.  The bytes are read as
+    # one integer each, so the operation runs in a single step.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: other - IdSet
+    #    @param: op - Function of two ints
+    #
+    # Returns
+    # -------
+    #    @return: IdSet
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def _combine(self, other, op):
+        size = max(len(self._bits), len(other._bits))
+        value = op(self._int(size), other._int(size))
+        result = IdSet()
+        if size:
+            result._bits = bytearray(
+                binascii.unhexlify('%0*x' % (2 * size, value)))
+        return result
+
+    def _int(self, size):
+        bits = self._bits + bytearray(size - len(self._bits))
+        return int(binascii.hexlify(bits), 16) if bits else 0
+
+#-----------------------------------------------------------------------
+#
+# Class Membership
+#
+# Matches the queries of several directories against the whole library
+# in one scan.  Directories are registered before their update starts.
+# The first one that asks for its matched items scans the library for
+# all registered directories: one statement evaluates the queries that
+# have an SQL equivalent and a single pass over the items and albums
+# matches the others.  Directories of the same alternative share the
+# query evaluation.  The items with a path in a directory are selected
+# the same way for the directories without a snapshot, see
+# External.member_ids().  Directories may ask from several threads.
+#
+# Inputs
+# ------
+#    @param: lib
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: sqlite3.Error
+#
+#-----------------------------------------------------------------------
+class Membership(object):
+    def __init__(self, lib):
+        self.lib = lib
+        # Registered directories that were not matched yet
+        self._unmatched = []
+        # Registered directories whose paths were not selected yet
+        self._unselected = []
+        # external -> IdSet of matched items
+        self._matched = {}
+        # external -> IdSet of items with a path
+        self._paths = {}
+        # The first directory that asks scans, the others wait for it
+        self._lock = threading.RLock()
+
+    #-------------------------------------------------------------------
+    #
+    # Function register
+    #
+    # Include a directory in the next scan.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: external
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def register(self, external):
+        with self._lock:
+            if external not in self._unmatched and \
+                    external not in self._matched:
+                self._unmatched.append(external)
+            if external not in self._unselected and \
+                    external not in self._paths:
+                self._unselected.append(external)
+
+    #-------------------------------------------------------------------
+    #
+    # Function invalidate
+    #
+    # Forget the selected paths of a directory whose paths changed
+    # after the scan.  They are selected again when it asks for them.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: external
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def invalidate(self, external):
+        with self._lock:
+            self._paths.pop(external, None)
+
+    #-------------------------------------------------------------------
+    #
+    # Function discard
+    #
+    # Drop a directory that was registered but did not ask for its ids,
+    # e.g. because it was skipped.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: external
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def discard(self, external):
+        with self._lock:
+            self._matched.pop(external, None)
+            self._paths.pop(external, None)
+            if external in self._unmatched:
+                self._unmatched.remove(external)
+            if external in self._unselected:
+                self._unselected.remove(external)
+
+    #-------------------------------------------------------------------
+    #
+    # Function matched
+    #
+    # Get the items a directory matches.  Each result is handed out
+    # once.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: external
+    #
+    # Returns
+    # -------
+    #    @return: IdSet
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def matched(self, external):
+        with self._lock:
+            if external not in self._matched:
+                self.register(external)
+                externals, self._unmatched = self._unmatched, []
+                self._matched.update(self._match_sql(externals))
+                self._matched.update(self._match_python(
+                    [e for e in externals if e not in self._matched]))
+            return self._matched.pop(external)
+
+    #-------------------------------------------------------------------
+    #
+    # Function paths
+    #
+    # Get the items with a path in a directory.  Each result is handed
+    # out once.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: external
+    #
+    # Returns
+    # -------
+    #    @return: IdSet
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def paths(self, external):
+        with self._lock:
+            if external not in self._paths:
+                self.register(external)
+                externals, self._unselected = self._unselected, []
+                self._paths.update(self._select_paths(externals))
+            return self._paths.pop(external)
+
+    #-------------------------------------------------------------------
+    #
+    # Function _match_sql
+    #
+    # Evaluate the queries with an SQL equivalent in one statement with
+    # one result column per distinct query.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: externals
+    #
+    # Returns
+    # -------
+    #    @return: dict external -> IdSet, without the directories whose
+    #             queries have no SQL equivalent
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def _match_sql(self, externals):
+        # (item clause, album clause, subvals) -> column
+        columns = OrderedDict()
+        external_columns = {}
+        for external in externals:
+            item_clause, item_subvals = sql_clause(external.query, Item)
+            album_clause, album_subvals = sql_clause(external.album_query,
+                                                     Album)
+            if item_clause is None or album_clause is None:
+                continue
+            key = (item_clause, album_clause,
+                   tuple(item_subvals) + tuple(album_subvals))
+            external_columns[external] = columns.setdefault(key,
+                                                            len(columns))
+        if not columns:
+            return {}
+
+        selects = []
+        subvals = []
+        for item_clause, album_clause, values in columns:
+            selects.append(u'(({0}) OR album_id IN (SELECT id FROM albums '
+                           u'WHERE {1}))'.format(item_clause, album_clause))
+            subvals.extend(values)
+        sql = u'SELECT id, {0} FROM items ORDER BY id'.format(
+            u', '.join(selects))
+        ids = [IdSet() for _ in columns]
+        with self.lib.transaction() as tx:
+            for row in tx.query(sql, subvals):
+                for column, match in enumerate(row[1:]):
+                    if match:
+                        ids[column].add(row[0])
+        return dict((external, ids[column].copy())
+                    for external, column in external_columns.items())
+
+    #-------------------------------------------------------------------
+    #
+    # Function _match_python
+    #
+    # Match the queries in one pass over the albums and one over the
+    # items.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: externals
+    #
+    # Returns
+    # -------
+    #    @return: dict external -> IdSet
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def _match_python(self, externals):
+        matched = dict((external, IdSet()) for external in externals)
+        if not externals:
+            return matched
+
+        album_ids = dict((external, set()) for external in externals)
+        if any(e.album_query is not None for e in externals):
+            for album in self.lib.albums():
+                for external in externals:
+                    if external.album_query is not None and \
+                            external.album_query.match(album):
+                        album_ids[external].add(album.id)
+
+        for item in self.lib.items():
+            for external in externals:
+                if item.album_id in album_ids[external] or \
+                        external.matches(item):
+                    matched[external].add(item.id)
+        return matched
+
+    #-------------------------------------------------------------------
+    #
+    # Function _select_paths
+    #
+    # Select the items with a path in each directory in one statement.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: externals
+    #
+    # Returns
+    # -------
+    #    @return: dict external -> IdSet
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def _select_paths(self, externals):
+        paths = dict((external.path_key, IdSet()) for external in externals)
+        if not paths:
+            return {}
+        keys = list(paths)
+        sql = (u'SELECT entity_id, key FROM item_attributes WHERE key IN '
+               u'({0}) ORDER BY entity_id'
+               .format(u', '.join(u'?' * len(keys))))
+        with self.lib.transaction() as tx:
+            for item_id, key in tx.query(sql, keys):
+                paths[key].add(item_id)
+        return dict((external, paths[external.path_key])
+                    for external in externals)
+
+#-----------------------------------------------------------------------
+#
+# Class ArtCache
+#
+# Cover images ready to be embedded, shared by all directories and
+# converter threads.  Every track of an album embeds the same cover,
+# so it is read and resized once instead of once per track.
+#
+# Images are kept per path, modification time and maximum width.  Only
+# the most recently used ones are kept; tracks of an album are usually
+# processed together.
+#
+# Inputs
+# ------
+#    @param: size - Number of images to keep
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class ArtCache(object):
+    def __init__(self, size=ART_CACHE_SIZE):
+        self.size = size
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    #-------------------------------------------------------------------
+    #
+    # Function image
+    #
+    # Get the image to embed for a cover file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: log
+    #    @param: artpath
+    #    @param: maxwidth - Resize wider images, 0 to keep the size
+    #
+    # Returns
+    # -------
+    #    @return: Image or None if the file can not be embedded
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def image(self, log, artpath, maxwidth=0):
+        try:
+            mtime = os.path.getmtime(syspath(artpath))
+        except OSError as exc:
+            log.warning(u'could not read image file: {0}'.format(exc))
+            return None
+        key = (artpath, mtime, maxwidth)
+        with self._lock:
+            if key in self._images:
+                image = self._images.pop(key)
+                self._images[key] = image
+                return image
+
+        image = self._load(log, artpath, maxwidth)
+        with self._lock:
+            self._images[key] = image
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+        return image
+
+    #-------------------------------------------------------------------
+    #
+    # Function _load
+    #
+    # Read and resize a cover file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: log
+    #    @param: artpath
+    #    @param: maxwidth
+    #
+    # Returns
+    # -------
+    #    @return: Image or None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def _load(self, log, artpath, maxwidth):
+        path = artpath
+        if maxwidth:
+            from beets.util.artresizer import ArtResizer
+            path = bytestring_path(
+                ArtResizer.shared.resize(maxwidth, syspath(artpath)))
+        try:
+            with open(syspath(path), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as exc:
+            log.warning(u'could not read image file: {0}'.format(exc))
+            return None
+        finally:
+            if path != artpath:
+                util.remove(path)
+
+        image = Image(data, type=ImageType.front)
+        # Some formats only support PNG and JPEG
+        if image.mime_type not in ('image/jpeg', 'image/png'):
+            log.info(u'not embedding image of unsupported type: {0}'
+                     .format(image.mime_type))
+            return None
+        return image
+
+
+#-----------------------------------------------------------------------
+#
+# Class IdQuery
+#
+# Matches the items or albums with the given ids.
+#
+# A single `id IN (...)` test, an OrQuery of many ids exceeds the
+# expression depth SQLite allows.
+#
+# It is a sublcass of the Query class.
+#
+# Inputs
+# ------
+#    @param: ids
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class IdQuery(Query):
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    def clause(self):
+        return ('id IN ({0})'.format(','.join('?' * len(self.ids))),
+                sorted(self.ids))
+
+    def match(self, model):
+        return model.id in self.ids
+
+#-----------------------------------------------------------------------
+#
+# Class External
+#
+# One directory of an alternative collection whose files are copies of
+# the library files.
+#
+# Inputs
+# ------
+#    @param: log
+#    @param: lib
+#    @param: alternative - AlternativeSpec
+#    @param: spec - DirectorySpec of the directory
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class External(object):
+
+    ADD = 1
+    REMOVE = 2
+    WRITE = 3
+    MOVE = 4
+    NOOP = 5
+    EMBED_ART = 6
+
+    def __init__(self, log, lib, alternative, spec):
+        self._log = log
+        self.name = alternative.name
+        self.lib = lib
+        self.path_key = spec.path_key
+        self.query = alternative.query
+        self.album_query = alternative.album_query
+        self.manifest = None
+        self.verify = False
+        self.throughput = None
+        self.stats = Stats()
+        self.art_cache = ArtCache()
+        self.writer = LibraryWriter(lib)
+        self.membership = None
+        # IdSet of the items with a path in the collection, see
+        # member_ids()
+        self.members = None
+        self._art_mtimes = {}
+        # item id -> (key, path), see destination()
+        self._destinations = {}
+        self._new_destinations = {}
+        self._save_destinations = False
+        # Held by converter threads while creating directories
+        self._fs_lock = threading.Lock()
+        self.parse_config(spec)
+
+    #-------------------------------------------------------------------
+    #
+    # Function parse_config
+    #
+    # Take the paths and directory from the compiled configuration and
+    # read the other options.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: spec - DirectorySpec
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: confuse.ConfigError
+    #
+    #-------------------------------------------------------------------
+    def parse_config(self, spec):
+        config = spec.config
+        self.path_formats = list(spec.path_formats)
+        self.path_templates = self.compile_path_formats(self.path_formats)
+        if spec.formats in ((u'hardlink',), (u'reflink',)):
+            self.copy_method = spec.formats[0]
+        elif 'copy' in config:
+            self.copy_method = config['copy'].as_choice(COPY_METHODS)
+        else:
+            self.copy_method = u'copy'
+        if 'album_art_maxwidth' in config:
+            self.art_maxwidth = config['album_art_maxwidth'].get(int)
+        else:
+            self.art_maxwidth = \
+                beets.config['convert']['album_art_maxwidth'].get(int)
+        if 'removable' in config:
+            self.removable = config['removable'].get(bool)
+        else:
+            self.removable = True
+        if 'io_limit' in config:
+            self.io_limit = config['io_limit'].get(int)
+        else:
+            self.io_limit = 0
+        dir = self.directory = spec.directory
+
+        # Settings Item.destination() depends on besides the template
+        self._destination_settings = repr((
+            dir,
+            [(regex.pattern, repl)
+             for regex, repl in self.lib.replacements or ()],
+            beets.config['asciify_paths'].get(),
+            beets.config['path_sep_replace'].get(),
+            beets.config['max_filename_length'].get(),
+        ))
+
+    #-------------------------------------------------------------------
+    #
+    # Function compile_path_formats
+    #
+    # Parse the queries and templates of the path formats once.  Also
+    # find the fields every template reads and whether its result can be
+    # kept across updates: it may only call pure template functions and
+    # read stored fields, not computed ones.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: path_formats - [(query, template string)]
+    #
+    # Returns
+    # -------
+    #    @return: [PathTemplate], the default format last
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def compile_path_formats(self, path_formats):
+        getters = set(Item._getters()) | set(Album._getters())
+        templates = []
+        default = None
+        for query, path_format in path_formats:
+            if isinstance(path_format, Template):
+                template = path_format
+            else:
+                template = Template(path_format)
+            _, fields, functions = template.expr.translate()
+            fields = tuple(sorted(fields))
+            persistent = functions <= PURE_FUNCTIONS and not any(
+                field in getters or
+                (not ALBUM_FALLBACK and field not in Item._fields)
+                for field in fields)
+            if query == PF_KEY_DEFAULT:
+                if default is None:
+                    default = PathTemplate(None, template, fields, persistent)
+                continue
+            query, _ = parse_query_string(query, Item)
+            templates.append(PathTemplate(query, template, fields,
+                                          persistent))
+        if default is None:
+            # Item.destination() complains about the missing default
+            return None
+        templates.append(default)
+        return templates
+
+    #-------------------------------------------------------------------
+    #
+    # Function matches
+    #
+    # Check whether an item belongs to the collection, either by
+    # itself or through its album.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: album - The item's album or None
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def matches(self, item, album=None):
+        if self.query is not None and self.query.match(item):
+            return True
+        return (album is not None and self.album_query is not None
+                and self.album_query.match(album))
+
+    #-------------------------------------------------------------------
+    #
+    # Function matched_item_action
+    #
+    # Determine what needs to be done for an item of the collection.
+    #
+    # The state of the external file is taken from the manifest, so
+    # that the external device is not touched.  Items without a valid
+    # manifest entry, and all items when verifying, are checked on the
+    # filesystem instead.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: (item, actions)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def matched_item_action(self, item):
+        path = self.get_path(item)
+        entry = None
+        if path and self.manifest is not None and not self.verify:
+            entry = self.manifest.get(item.id)
+        if entry is None or entry.path != path:
+            return self.stat_item_action(item, path)
+
+        actions = []
+        dest = self.destination(item)
+        if path != dest and not util.samefile(path, dest):
+            actions.extend([self.MOVE, self.WRITE])
+        elif self.source_changed(item, entry):
+            actions.append(self.WRITE)
+        art_mtime = self.art_mtime(item)
+        if art_mtime and (entry.art_mtime is None
+                          or art_mtime > entry.art_mtime):
+            actions.append(self.EMBED_ART)
+        return (item, actions)
+
+    #-------------------------------------------------------------------
+    #
+    # Function stat_item_action
+    #
+    # Determine what needs to be done for an item by looking at the
+    # external file.  Files that differ from their manifest entry were
+    # changed behind our back and are replaced.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: path - The item's path in the collection or None
+    #
+    # Returns
+    # -------
+    #    @return: (item, actions)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def stat_item_action(self, item, path):
+        actions = []
+        try:
+            stat = self.stat(path) if path else None
+        except OSError:
+            stat = None
+        if stat is None:
+            actions.append(self.ADD)
+            return (item, actions)
+
+        entry = self.manifest.get(item.id) if self.manifest else None
+        if (entry is not None and entry.path == path and
+                (entry.dest_size != stat.st_size
+                 or int(entry.dest_mtime) != int(stat.st_mtime))):
+            actions.append(self.ADD)
+            return (item, actions)
+
+        dest = self.destination(item)
+        if not util.samefile(path, dest):
+            actions.extend([self.MOVE, self.WRITE])
+        elif stat.st_mtime < os.path.getmtime(syspath(item.path)) or \
+                self.verify:
+            # Changes made only to the library leave the file's mtime
+            # alone.  They are found by comparing the tags.
+            actions.append(self.WRITE)
+        art_mtime = self.art_mtime(item)
+        if art_mtime and stat.st_mtime < art_mtime:
+            actions.append(self.EMBED_ART)
+        return (item, actions)
+
+    #-------------------------------------------------------------------
+    #
+    # Function stat
+    #
+    # Stat a file of the collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: path
+    #
+    # Returns
+    # -------
+    #    @return: os.stat_result
+    #
+    # Raises
+    # ------
+    #    @raises: OSError
+    #
+    #-------------------------------------------------------------------
+    def stat(self, path):
+        stat = os.stat(syspath(path))
+        if not os.path.isfile(syspath(path)):
+            raise OSError(u'not a file: {0}'.format(displayable_path(path)))
+        return stat
+
+    #-------------------------------------------------------------------
+    #
+    # Function source_changed
+    #
+    # Check whether the library file was modified since it was synced.
+    #
+    # The modification time stored in the library has a resolution of
+    # one second and is reset when the item is changed without writing
+    # the file.  The file is only looked at in those cases.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: entry - The item's ManifestEntry
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: OSError
+    #
+    #-------------------------------------------------------------------
+    def source_changed(self, item, entry):
+        mtime = int(item.mtime)
+        if mtime and mtime != int(entry.source_mtime):
+            return mtime > entry.source_mtime
+        return os.path.getmtime(syspath(item.path)) > entry.source_mtime
+
+    #-------------------------------------------------------------------
+    #
+    # Function art_mtime
+    #
+    # Get the modification time of the album art of the item.  It is
+    # looked up once per album and run.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: mtime
+    #    @return: None - The item has no album art
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def art_mtime(self, item):
+        if item.album_id not in self._art_mtimes:
+            mtime = None
+            album = item.get_album()
+            if album and album.artpath:
+                try:
+                    mtime = os.path.getmtime(syspath(album.artpath))
+                except OSError:
+                    pass
+            self._art_mtimes[item.album_id] = mtime
+        return self._art_mtimes[item.album_id]
+
+    #-------------------------------------------------------------------
+    #
+    # Function record
+    #
+    # Record the state of an item's external file in the manifest.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: path - The item's path in the collection
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def record(self, item, path):
+        if self.manifest is None:
+            return
+        try:
+            source = os.stat(syspath(item.path))
+            dest = self.stat(path)
+        except OSError:
+            self.manifest.remove(item.id)
+            return
+        self.manifest.set(item.id, path, source.st_mtime, source.st_size,
+                          dest.st_mtime, dest.st_size, self.art_mtime(item))
+
+    #-------------------------------------------------------------------
+    #
+    # Function items_actions
+    #
+    # Generate the actions for the collection.
+    #
+    # Without ids the whole library is matched against the queries.
+    # With ids only those items are looked at; this is the incremental
+    # update driven by the journal.
+    #
+    # Membership is decided by SQLite whenever the queries can be
+    # expressed in SQL, so that only the items of the collection and
+    # the items to remove from it are loaded.  The whole library is
+    # matched by the shared Membership if there is one.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids - Item ids to check or None for all items
+    #
+    # Returns
+    # -------
+    #    @return: Generator of (item, actions)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def items_actions(self, ids=None):
+        stats = self.stats
+        if ids is None and self.membership is not None:
+            for item_actions in self.members_actions():
+                yield item_actions
+            return
+
+        with stats.phase('match'):
+            matched_ids = self.matched_ids(ids)
+        if matched_ids is None:
+            # Matching and planning are interleaved
+            for item_actions in stats.timed('match', self.match_items(ids)):
+                yield item_actions
+            return
+
+        with stats.phase('match'):
+            path_ids = self.path_ids(ids)
+        for item in stats.timed('load', self.items_by_id(matched_ids |
+                                                         path_ids)):
+            if item.id in matched_ids:
+                with stats.phase('plan'):
+                    item_actions = self.matched_item_action(item)
+                yield item_actions
+            else:
+                yield (item, [self.REMOVE])
+
+    #-------------------------------------------------------------------
+    #
+    # Function members_actions
+    #
+    # Generate the actions for the whole library from the matched items
+    # and the items that had a path in the collection, both as IdSets.
+    # Items that are in neither set are not looked at.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Generator of (item, actions)
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def members_actions(self):
+        stats = self.stats
+        with stats.phase('match'):
+            matched_ids = self.membership.matched(self)
+            removed_ids = self.member_ids() - matched_ids
+        for item in stats.timed('load', self.items_by_id(matched_ids |
+                                                         removed_ids)):
+            if item.id in matched_ids:
+                with stats.phase('plan'):
+                    item_actions = self.matched_item_action(item)
+                yield item_actions
+                continue
+            removed_ids.discard(item.id)
+            if self.get_path(item):
+                yield (item, [self.REMOVE])
+            else:
+                # The id was reused by a new item
+                self.members.discard(item.id)
+        # Removed from the library
+        for item_id in removed_ids:
+            self.members.discard(item_id)
+
+    #-------------------------------------------------------------------
+    #
+    # Function match_items
+    #
+    # Generate the actions by matching the queries in Python.  Used
+    # when a query has no SQL equivalent.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids - Item ids to check or None for all items
+    #
+    # Returns
+    # -------
+    #    @return: Generator of (item, actions)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def match_items(self, ids=None):
+        if ids is None:
+            matched_ids = set()
+            if self.album_query is not None:
+                for album in self.lib.albums():
+                    if self.album_query.match(album):
+                        matched_items = album.items()
+                        matched_ids.update(item.id for item in matched_items)
+
+            for item in self.lib.items():
+                if item.id in matched_ids or self.matches(item):
+                    yield self.matched_item_action(item)
+                elif self.get_path(item):
+                    yield (item, [self.REMOVE])
+            return
+
+        for id in sorted(ids):
+            item = self.lib.get_item(id)
+            if item is None:
+                # Removed from the library, handled by remove_orphans()
+                continue
+            if self.matches(item, item.get_album()):
+                yield self.matched_item_action(item)
+            elif self.get_path(item):
+                yield (item, [self.REMOVE])
+
+    #-------------------------------------------------------------------
+    #
+    # Function matched_ids
+    #
+    # Select the ids of the items that match the item query or belong
+    # to an album matching the album query, in a single statement.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids - Restrict the result to these ids or None
+    #
+    # Returns
+    # -------
+    #    @return: Set of item ids
+    #    @return: None - A query can not be expressed in SQL
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def matched_ids(self, ids=None):
+        item_clause, item_subvals = sql_clause(self.query, Item)
+        album_clause, album_subvals = sql_clause(self.album_query, Album)
+        if item_clause is None or album_clause is None:
+            return None
+
+        sql = (u'SELECT id FROM items WHERE (({0}) OR album_id IN '
+               u'(SELECT id FROM albums WHERE {1}))'
+               .format(item_clause, album_clause))
+        return self.select_ids(sql, item_subvals + album_subvals, 'id', ids)
+
+    #-------------------------------------------------------------------
+    #
+    # Function path_ids
+    #
+    # Select the ids of the items that have a path in this collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids - Restrict the result to these ids or None
+    #
+    # Returns
+    # -------
+    #    @return: Set of item ids
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def path_ids(self, ids=None):
+        sql = u'SELECT entity_id FROM item_attributes WHERE (key = ?)'
+        return self.select_ids(sql, [self.path_key], 'entity_id', ids)
+
+    #-------------------------------------------------------------------
+    #
+    # Function select_ids
+    #
+    # Run a statement selecting ids, optionally restricted to a set of
+    # ids.  The restriction is sent in chunks to stay below SQLite's
+    # limit on the number of parameters.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: sql - SELECT of a single column ending in a WHERE clause
+    #    @param: subvals
+    #    @param: column - Name of the selected column
+    #    @param: ids - Restrict the result to these ids or None
+    #
+    # Returns
+    # -------
+    #    @return: Set of ids
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def select_ids(self, sql, subvals, column, ids=None):
+        with self.lib.transaction() as tx:
+            if ids is None:
+                return set(id for id, in tx.query(sql, subvals))
+
+            selected = set()
+            ids = sorted(ids)
+            for start in range(0, len(ids), SQL_CHUNK):
+                chunk = ids[start:start + SQL_CHUNK]
+                restricted = u'{0} AND {1} IN ({2})'.format(
+                    sql, column, u', '.join(u'?' * len(chunk)))
+                rows = tx.query(restricted, list(subvals) + chunk)
+                selected.update(id for id, in rows)
+            return selected
+
+    #-------------------------------------------------------------------
+    #
+    # Function items_by_id
+    #
+    # Load items by id, in chunks.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids
+    #
+    # Returns
+    # -------
+    #    @return: Generator of items
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def items_by_id(self, ids):
+        ids = sorted(ids)
+        for start in range(0, len(ids), SQL_CHUNK):
+            query = IdQuery(ids[start:start + SQL_CHUNK])
+            for item in self.lib.items(query):
+                yield item
+
+    #-------------------------------------------------------------------
+    #
+    # Function plan
+    #
+    # Work out what update() would do without changing anything.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: ids - Item ids to check or None for all items
+    #    @param: journal - Journal holding removed items or None
+    #
+    # Returns
+    # -------
+    #    @return: dict with the number of items per action, the bytes
+    #             to write and the estimated seconds for transcoding
+    #             and copying.  'unmeasured' counts the added items
+    #             without a time estimate.
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def plan(self, ids=None, journal=None):
+        summary = dict.fromkeys(['add', 'transcode', 'move', 'write',
+                                 'embed_art', 'remove', 'bytes',
+                                 'unmeasured'], 0)
+        summary['transcode_time'] = summary['copy_time'] = 0.0
+        names = {self.ADD: 'add', self.MOVE: 'move', self.WRITE: 'write',
+                 self.EMBED_ART: 'embed_art', self.REMOVE: 'remove'}
+
+        if not os.path.isdir(syspath(self.directory)):
+            ids = None
+        self.open_manifest(readonly=True)
+        try:
+            if ids is None:
+                self.manifest.load()
+            if journal is not None:
+                summary['remove'] += len(journal.orphans(self.path_key))
+
+            for item, actions in self.items_actions(ids):
+                for action in actions:
+                    if action in names:
+                        summary[names[action]] += 1
+                if self.ADD not in actions:
+                    continue
+                size, elapsed, transcode = self.estimate(item)
+                summary['bytes'] += int(size)
+                if transcode:
+                    summary['transcode'] += 1
+                if elapsed is None:
+                    summary['unmeasured'] += 1
+                elif transcode:
+                    summary['transcode_time'] += elapsed
+                else:
+                    summary['copy_time'] += elapsed
+        finally:
+            self.close_manifest()
+        return summary
+
+    #-------------------------------------------------------------------
+    #
+    # Function estimate
+    #
+    # Estimate the size of the added file and how long adding it takes,
+    # from the measured throughput.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: (bytes, seconds or None, transcoded)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def estimate(self, item):
+        try:
+            size = os.path.getsize(syspath(item.path))
+        except OSError:
+            size = 0
+        rate = None
+        if self.throughput is not None:
+            rate = self.throughput.rate(self.copy_method) or \
+                self.throughput.rate(u'copy')
+        if not rate or not rate.size:
+            return size, None, False
+        return size, size * rate.elapsed / rate.size, False
+
+    #-------------------------------------------------------------------
+    #
+    # Function measure
+    #
+    # Record the throughput of adding an item and add it to the stats.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: kind - Encoder command or copy method
+    #    @param: item
+    #    @param: dest - The written file
+    #    @param: start - time.time() when adding started
+    #    @param: fmt - Target format of a transcode, None for a copy
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: OSError
+    #
+    #-------------------------------------------------------------------
+    def measure(self, kind, item, dest, start, fmt=None):
+        elapsed = time.time() - start
+        size = os.path.getsize(syspath(dest))
+        self.stats.add('transcode' if fmt else kind, elapsed)
+        if fmt or kind == u'copy':
+            self.stats.count('bytes_read',
+                             os.path.getsize(syspath(item.path)))
+            self.stats.count('bytes_written', size)
+        if kind == u'copy':
+            self.stats.count('bytes_copied', size)
+            self._log.debug(u'copied {0} in {1:.3f}s ({2}/s)'.format(
+                human_bytes(size), elapsed,
+                human_bytes(size / elapsed if elapsed else 0)))
+        if fmt:
+            self.stats.transcoded(fmt, elapsed)
+        if self.throughput is not None:
+            self.throughput.measure(kind, item.length or 0, size, elapsed)
+
+    #-------------------------------------------------------------------
+    #
+    # Function ask_create
+    #
+    # Ask the user whether a missing removable collection should be
+    # created.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: create - Answer given on the command line or None
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def ask_create(self, create=None):
+        if not self.removable:
+            return True
+        if create is not None:
+            return create
+
+        msg = u"Collection at '{0}' does not exists. " \
+              "Maybe you forgot to mount it.\n" \
+              "Do you want to create the collection? (y/n)" \
+              .format(displayable_path(self.directory))
+        return input_yn(msg, require=True)
+
+    #-------------------------------------------------------------------
+    #
+    # Function remove_orphans
+    #
+    # Remove the external files of items that were removed from the
+    # library.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: journal
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def remove_orphans(self, journal):
+        for stored in journal.orphans(self.path_key):
+            path = stored.encode('utf8')
+            print_(u'-{0}'.format(displayable_path(path)))
+            if os.path.lexists(syspath(path)):
+                with self.stats.phase('remove'):
+                    util.remove(path)
+                    util.prune_dirs(path, root=self.directory)
+            if self.manifest is not None:
+                self.manifest.remove_path(path)
+            journal.discard_orphan(self.path_key, stored)
+
+    #-------------------------------------------------------------------
+    #
+    # Function open_manifest
+    #
+    # Open the manifest in the root of the collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: verify - Check the external files instead of trusting
+    #                     the manifest
+    #    @param: readonly - Use an empty manifest instead of creating
+    #                       a missing one
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def open_manifest(self, verify=False, readonly=False):
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if readonly and not os.path.isfile(syspath(path)):
+            path = b':memory:'
+        elif not readonly:
+            util.mkdirall(path)
+        self.manifest = Manifest(syspath(path), self.path_key, self.writer)
+        self.verify = verify
+        self._save_destinations = not readonly
+        self._art_mtimes = {}
+        self.members = None if verify else self.manifest.snapshot()
+        if self.members is not None and not readonly:
+            # Saved again by close_manifest()
+            self.manifest.set_snapshot(None)
+
+    def close_manifest(self):
+        # The manifest must not record paths the library does not have
+        self.writer.flush()
+        if self.manifest is not None:
+            if self._save_destinations and self._new_destinations:
+                self.manifest.set_destinations(self._new_destinations)
+            if self._save_destinations and self.members is not None:
+                self.manifest.set_snapshot(self.members)
+            self.manifest.close()
+        self._new_destinations = {}
+        self.manifest = None
+        self.members = None
+
+    #-------------------------------------------------------------------
+    #
+    # Function member_ids
+    #
+    # Get the items with a path in the collection.  They are taken from
+    # the manifest's snapshot or, without one, selected from the
+    # library.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: IdSet, kept up to date by set_path() and
+    #             remove_path()
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def member_ids(self):
+        if self.members is None:
+            if self.membership is not None:
+                self.members = self.membership.paths(self)
+            else:
+                self.members = IdSet(sorted(self.path_ids()))
+        return self.members
+
+    #-------------------------------------------------------------------
+    #
+    # Function update
+    #
+    # Sync the directory with the library.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: create - Answer to ask_create() or None
+    #    @param: ids - Item ids to check or None for all items
+    #    @param: journal - Journal holding removed items or None
+    #    @param: verify - Check the external files instead of trusting
+    #                     the manifest
+    #    @param: converter - Shared converter for added items or None.
+    #                        The caller passes the results to added()
+    #                        and closes the manifest.
+    #    @param: resume - Keep the files an interrupted update finished
+    #
+    # Returns
+    # -------
+    #    @return: False if the creation of the collection was declined
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def update(self, create=None, ids=None, journal=None, verify=False,
+               converter=None, resume=False):
+        if not os.path.isdir(syspath(self.directory)):
+            if not self.ask_create(create):
+                print_(u'Skipping creation of {0}'
+                       .format(displayable_path(self.directory)))
+                return False
+            # Nothing is there yet, the journal does not help
+            ids = None
+
+        self.open_manifest(verify)
+        shared = converter is not None
+        try:
+            self.finish_pending(resume)
+            if journal is not None:
+                self.remove_orphans(journal)
+            if ids is None:
+                self.manifest.load()
+
+            if not shared:
+                converter = self.converter()
+            moves = []
+            for (item, actions) in self.items_actions(ids):
+                dest = self.destination(item)
+                path = self.get_path(item)
+                if self.MOVE in actions:
+                    # Moved once all moves are known
+                    moves.append((item, actions, path, dest))
+                    continue
+                self.apply(item, actions, path, dest, converter)
+            for item, actions, path, dest in self.move_directories(moves):
+                self.apply(item, actions, path, dest, converter)
+            # The pending items must be known before converting starts
+            self.manifest.commit()
+
+            if not shared:
+                for item, dest in converter.as_completed():
+                    self.added(item, dest)
+        finally:
+            if not shared:
+                if converter is not None:
+                    converter.shutdown()
+                self.close_manifest()
+        return True
+
+    #-------------------------------------------------------------------
+    #
+    # Function apply
+    #
+    # Execute the actions for an item and record the result in the
+    # manifest.  Files that disappeared from the collection are added
+    # again.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: actions
+    #    @param: path - The item's current path in the collection
+    #    @param: dest - The item's destination in the collection
+    #    @param: converter
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: util.FilesystemError, FileOperationError
+    #
+    #-------------------------------------------------------------------
+    def apply(self, item, actions, path, dest, converter):
+        try:
+            path = self.execute(item, actions, path, dest, converter)
+        except (util.FilesystemError, FileOperationError,
+                EnvironmentError):
+            if path and os.path.isfile(syspath(path)):
+                raise
+            # The manifest was out of date
+            print_(u'+{0}'.format(displayable_path(dest)))
+            self.submit(converter, item, dest)
+            return
+        if self.ADD in actions or self.REMOVE in actions:
+            return
+        if actions or self.manifest.get(item.id) is None:
+            self.record(item, path)
+
+    #-------------------------------------------------------------------
+    #
+    # Function move_directories
+    #
+    # Rename whole directories instead of moving their files one by
+    # one.  A directory is renamed if all files in it move to the same
+    # new directory under the same name and that directory does not
+    # exist yet.  This is the case for every album after the directory
+    # part of a path template changed.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: moves - [(item, actions, path, dest)] of items with a
+    #                    MOVE action
+    #
+    # Returns
+    # -------
+    #    @return: Generator of (item, actions, path, dest).  The items
+    #             of renamed directories are stored with their new path
+    #             and their MOVE action is dropped.
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def move_directories(self, moves):
+        groups = OrderedDict()
+        for move in moves:
+            _, _, path, dest = move
+            if path and os.path.basename(path) == os.path.basename(dest):
+                key = (os.path.dirname(path), os.path.dirname(dest))
+            else:
+                key = None
+            groups.setdefault(key, []).append(move)
+
+        for key, group in groups.items():
+            if key is None or not self.move_directory(key[0], key[1],
+                                                      group):
+                for move in group:
+                    yield move
+                continue
+            for item, actions, path, dest in group:
+                self.set_path(item, dest)
+                self.store(item)
+                yield (item, [a for a in actions if a != self.MOVE],
+                       dest, dest)
+
+    #-------------------------------------------------------------------
+    #
+    # Function move_directory
+    #
+    # Rename a directory if it only holds the given files.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: source - Directory to rename
+    #    @param: dest - New name of the directory
+    #    @param: group - [(item, actions, path, dest)] of the files
+    #                    moving from source to dest
+    #
+    # Returns
+    # -------
+    #    @return: bool - Whether the directory was renamed
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def move_directory(self, source, dest, group):
+        # Only directories below the collection's root
+        root = os.path.join(os.path.normpath(self.directory), b'')
+        if not os.path.normpath(source).startswith(root):
+            return False
+        names = set(os.path.basename(path) for _, _, path, _ in group)
+        with self._fs_lock:
+            try:
+                if os.path.lexists(syspath(dest)) or \
+                        set(os.listdir(syspath(source))) != names:
+                    return False
+                util.mkdirall(dest)
+                with self.stats.phase('move'):
+                    os.rename(syspath(source), syspath(dest))
+            except OSError:
+                return False
+        print_(u'>{0} -> {1}'.format(displayable_path(source),
+                                     displayable_path(dest)))
+        with self.stats.phase('move'):
+            util.prune_dirs(os.path.dirname(source), root=self.directory)
+        self.stats.count('directory_moves')
+        return True
+
+    #-------------------------------------------------------------------
+    #
+    # Function added
+    #
+    # Store the path of an item the converter added to the collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: dest
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def added(self, item, dest):
+        self.set_path(item, dest)
+        self.store(item)
+        self.record(item, dest)
+        self.manifest.remove_pending(item.id)
+
+    #-------------------------------------------------------------------
+    #
+    # Function submit
+    #
+    # Submit an item to the converter and remember it in the manifest
+    # until it is added.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: converter
+    #    @param: item
+    #    @param: dest
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def submit(self, converter, item, dest):
+        self.manifest.add_pending(item.id, dest, partial_path(dest))
+        converter.submit(item)
+
+    #-------------------------------------------------------------------
+    #
+    # Function finish_pending
+    #
+    # Clean up after an interrupted update.  Partial files are removed.
+    # Files that were complete but not stored yet are added to the
+    # collection if resume is set, they are converted again otherwise.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: resume
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def finish_pending(self, resume=False):
+        pending = self.manifest.pending()
+        if not pending:
+            return
+        finished = []
+        for item_id, path, tmp in pending:
+            if os.path.lexists(syspath(tmp)):
+                self._log.debug(u'removing partial file {0}'
+                                .format(displayable_path(tmp)))
+                util.remove(tmp)
+            item = self.lib.get_item(item_id)
+            if item is None or self.get_path(item) or \
+                    not os.path.isfile(syspath(path)) or \
+                    self.destination(item) != path:
+                continue
+            finished.append((item, path))
+
+        if resume:
+            for item, path in finished:
+                self._log.debug(u'resumed {0}'
+                                .format(displayable_path(path)))
+                self.added(item, path)
+                self.stats.count('resumed')
+            if finished:
+                print_(u'Kept {0} files of an interrupted update'
+                       .format(len(finished)))
+                # Matching reads the stored paths
+                self.writer.flush()
+                if self.members is None and self.membership is not None:
+                    self.membership.invalidate(self)
+        elif finished:
+            print_(u'{0} files of an interrupted update are converted '
+                   u'again, use --resume to keep them'.format(len(finished)))
+        self.manifest.clear_pending()
+
+    #-------------------------------------------------------------------
+    #
+    # Function store
+    #
+    # Store the item in the library.  The store is batched with others,
+    # see LibraryWriter.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: sqlite3.Error
+    #
+    #-------------------------------------------------------------------
+    def store(self, item):
+        self.writer.store(item)
+
+    #-------------------------------------------------------------------
+    #
+    # Function execute
+    #
+    # Run the actions for one item.  Added items are submitted to the
+    # converter, tags are only written if the file's tags differ.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: actions
+    #    @param: path - The item's current path in the collection
+    #    @param: dest - The item's destination in the collection
+    #    @param: converter
+    #
+    # Returns
+    # -------
+    #    @return: The item's path after the actions
+    #
+    # Raises
+    # ------
+    #    @raises: util.FilesystemError, FileOperationError
+    #
+    #-------------------------------------------------------------------
+    def execute(self, item, actions, path, dest, converter):
+        for action in actions:
+            if action == self.MOVE:
+                print_(u'>{0} -> {1}'.format(displayable_path(path),
+                                             displayable_path(dest)))
+                with self.stats.phase('move'):
+                    util.mkdirall(dest)
+                    util.move(path, dest)
+                    util.prune_dirs(os.path.dirname(path),
+                                    root=self.directory)
+                self.set_path(item, dest)
+                self.store(item)
+                path = dest
+            elif action == self.WRITE:
+                if self.shares_source(item, path):
+                    continue
+                with self.stats.phase('compare_tags'):
+                    match = self.tags_match(item, path)
+                if match:
+                    self._log.debug(u'tags up to date: {0}'
+                                    .format(displayable_path(path)))
+                    self.stats.count('tags_unchanged')
+                    continue
+                print_(u'*{0}'.format(displayable_path(path)))
+                with self.stats.phase('write_tags'):
+                    item.write(path=path)
+            elif action == self.EMBED_ART:
+                print_(u'~{0}'.format(displayable_path(path)))
+                self.embed_art(item, path)
+            elif action == self.ADD:
+                print_(u'+{0}'.format(displayable_path(dest)))
+                self.submit(converter, item, dest)
+            elif action == self.REMOVE:
+                print_(u'-{0}'.format(displayable_path(path)))
+                self.remove_item(item)
+                self.store(item)
+                if self.manifest is not None:
+                    self.manifest.remove(item.id)
+        return path
+
+    #-------------------------------------------------------------------
+    #
+    # Function tags_match
+    #
+    # Check whether the file already has the tags Item.write() would
+    # write.  Files that cannot be read never match.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: path
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def tags_match(self, item, path):
+        try:
+            mediafile = MediaFile(syspath(path))
+        except (UnreadableFileError, EnvironmentError):
+            return False
+        for field in TAG_FIELDS:
+            if not tag_equal(item.get(field), getattr(mediafile, field, None)):
+                return False
+        return True
+
+    #-------------------------------------------------------------------
+    #
+    # Function destination
+    #
+    # Get the path of the item in this collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: path
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def destination(self, item):
+        if self.path_templates is None:
+            return item.destination(basedir=self.directory,
+                                    path_formats=self.path_formats)
+        for path_template in self.path_templates:
+            if path_template.query is None or \
+                    path_template.query.match(item):
+                break
+
+        key = hashlib.sha1(repr((
+            self._destination_settings,
+            path_template.template.original,
+            os.path.splitext(item.path)[1],
+            [item.get(field) for field in path_template.fields],
+        )).encode('utf8')).hexdigest()
+        cached = self._destinations.get(item.id)
+        if cached is None and path_template.persistent and \
+                self.manifest is not None:
+            cached = self.manifest.destination(item.id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        dest = item.destination(
+            basedir=self.directory,
+            path_formats=[(PF_KEY_DEFAULT, path_template.template)])
+        self._destinations[item.id] = (key, dest)
+        if path_template.persistent:
+            self._new_destinations[item.id] = (key, dest)
+        return dest
+
+    #-------------------------------------------------------------------
+    #
+    # Function set_path
+    #
+    # Store the external path in the item's flexible attribute.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: path
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def set_path(self, item, path):
+        item[self.path_key] = six.text_type(path, 'utf8')
+        if self.members is not None:
+            self.members.add(item.id)
+
+    #-------------------------------------------------------------------
+    #
+    # Function remove_path
+    #
+    # Remove the item's path in the collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def remove_path(self, item):
+        del item[self.path_key]
+        if self.members is not None:
+            self.members.discard(item.id)
+
+    #-------------------------------------------------------------------
+    #
+    # Function get_path
+    #
+    # Get the external path from the item's flexible attribute.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: path
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def get_path(self, item):
+        try:
+            return item[self.path_key].encode('utf8')
+        except KeyError:
+            return None
+
+    #-------------------------------------------------------------------
+    #
+    # Function remove_item
+    #
+    # Delete the external file and forget its path.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def remove_item(self, item):
+        path = self.get_path(item)
+        with self.stats.phase('remove'):
+            util.remove(path)
+            util.prune_dirs(path, root=self.directory)
+        self.remove_path(item)
+
+    #-------------------------------------------------------------------
+    #
+    # Function converter
+    #
+    # Create the worker that adds files to the collection.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #
+    # Returns
+    # -------
+    #    @return: Worker
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def converter(self):
+        def _convert(item):
+            return item, self.convert(item)
+        return Worker(_convert, cost=self.job_cost)
+
+    #-------------------------------------------------------------------
+    #
+    # Function convert
+    #
+    # Copy one item into the collection.  The file is written under its
+    # partial_path() and renamed once it is complete.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: source - Unused, see ExternalConvert.convert()
+    #
+    # Returns
+    # -------
+    #    @return: dest
+    #
+    # Raises
+    # ------
+    #    @raises: EnvironmentError
+    #
+    #-------------------------------------------------------------------
+    def convert(self, item, source=None):
+        dest = self.destination(item)
+        tmp = partial_path(dest)
+        with self._fs_lock:
+            util.mkdirall(dest)
+        start = time.time()
+        try:
+            method = copy_file(item.path, tmp, self.copy_method,
+                               atomic=False)
+            self.measure(method, item, tmp, start)
+            os.rename(syspath(tmp), syspath(dest))
+        except BaseException:
+            if os.path.lexists(syspath(tmp)):
+                os.remove(syspath(tmp))
+            raise
+        return dest
+
+    #-------------------------------------------------------------------
+    #
+    # Function job_cost
+    #
+    # Estimate how long adding the item takes, relative to other items.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: float
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def job_cost(self, item):
+        return (item.length or 0) * COPY_COST
+
+    #-------------------------------------------------------------------
+    #
+    # Function shares_source
+    #
+    # Check whether the external file is a hard link of the library
+    # file.  Writing to it would change the library file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: path
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def shares_source(self, item, path):
+        return self.copy_method == u'hardlink' and \
+            util.samefile(item.path, path)
+
+    #-------------------------------------------------------------------
+    #
+    # Function embed_art
+    #
+    # Embed the album art into the external file.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: path
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def embed_art(self, item, path):
+        if self.shares_source(item, path):
+            return
+        album = item.get_album()
+        if album and album.artpath:
+            self._log.debug("Embedding art from {} into {}".format(
+                displayable_path(album.artpath),
+                displayable_path(path)))
+            with self.stats.phase('embed_art'):
+                image = self.art_cache.image(self._log, album.artpath,
+                                             self.art_maxwidth)
+                if image is not None:
+                    item.try_write(path=path, tags={'images': [image]})
+
+#-----------------------------------------------------------------------
+#
+# Class ExternalConvert
+#
+# A collection directory that transcodes files whose format is not in
+# the configured formats.
+#
+# It is a sublcass of the External class.
+#
+# Inputs
+# ------
+#    @param: ...
+#    @param: cache - TranscodeCache or None
+#    @param: convert_plugin - ConvertPlugin whose encoder and settings
+#                             are used, a new one if None
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class ExternalConvert(External):
+    def __init__(self, log, lib, alternative, spec, cache=None,
+                 convert_plugin=None):
+        from beetsplug import convert
+        super(ExternalConvert, self).__init__(log, lib, alternative, spec)
+        if convert_plugin is None:
+            convert_plugin = convert.ConvertPlugin()
+        self._encode = convert_plugin.encode
+        self._embed = convert_plugin.config['embed'].get(bool)
+        self.formats = [f.lower() for f in spec.formats]
+        self.formats = [convert.ALIASES.get(f, f) for f in self.formats]
+        self.convert_cmd, self.ext = convert.get_format(self.formats[0])
+        self.pipeline = None
+        self.auto_pipeline = False
+        if 'pipeline' in spec.config:
+            pipeline = spec.config['pipeline'].as_str()
+            if pipeline == u'auto':
+                self.auto_pipeline = True
+            else:
+                self.pipeline = Pipeline.parse(pipeline)
+        self.capabilities = None
+        # Source format -> chosen pipeline, see pipeline_for()
+        self._pipelines = {}
+        self.cache = cache
+
+    #-------------------------------------------------------------------
+    #
+    # Function convert
+    #
+    # Transcode or copy one item into the collection.  Transcodes are
+    # taken from and added to the cache.  The file is written under
+    # its partial_path() and renamed once it is complete.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: source - Decoded audio to encode instead of the item's
+    #                     file, or None
+    #
+    # Returns
+    # -------
+    #    @return: dest
+    #
+    # Raises
+    # ------
+    #    @raises: subprocess.CalledProcessError
+    #
+    #-------------------------------------------------------------------
+    def convert(self, item, source=None):
+        dest = self.destination(item)
+        tmp = partial_path(dest)
+        with self._fs_lock:
+            util.mkdirall(dest)
+        if os.path.lexists(syspath(tmp)):
+            os.remove(syspath(tmp))
+
+        try:
+            self._convert_to(item, source, tmp)
+            if self._embed:
+                self.embed_art(item, tmp)
+            os.rename(syspath(tmp), syspath(dest))
+        except BaseException:
+            if os.path.lexists(syspath(tmp)):
+                os.remove(syspath(tmp))
+            raise
+        return dest
+
+    #-------------------------------------------------------------------
+    #
+    # Function _convert_to
+    #
+    # Write the transcode or copy of an item, see convert().
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #    @param: source - Decoded audio or None
+    #    @param: dest - Path to write to
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: subprocess.CalledProcessError
+    #
+    #-------------------------------------------------------------------
+    def _convert_to(self, item, source, dest):
+        if self.should_transcode(item):
+            # Decoded audio is always encoded with the convert command
+            pipeline = self.pipeline_for(item) if source is None else None
+            command = pipeline.command if pipeline is not None \
+                else self.convert_cmd
+            key = None
+            if self.cache is not None:
+                key = self.cache.key(item.path, command, self.ext)
+            with self.stats.phase('cache'):
+                fetched = key is not None and \
+                    self.cache.fetch(key, self.ext, dest)
+            if fetched:
+                self._log.debug(u'cached {0}'.format(displayable_path(dest)))
+                self.stats.count('cache_hits')
+                with self.stats.phase('write_tags'):
+                    item.try_write(path=dest)
+            else:
+                start = time.time()
+                if pipeline is not None:
+                    self._log.debug(u'pipeline {0}'
+                                    .format(displayable_path(dest)))
+                    pipeline.run(item.path, dest)
+                else:
+                    self._encode(self.convert_cmd, source or item.path,
+                                 dest)
+                self.measure(command.decode('utf-8', 'replace'),
+                             item, dest, start, fmt=self.formats[0])
+                if key is not None:
+                    with self.stats.phase('cache'):
+                        self.cache.store(key, self.ext, dest)
+                if source is not None:
+                    # Decoded audio carries no tags
+                    with self.stats.phase('write_tags'):
+                        item.try_write(path=dest)
+        else:
+            self._log.debug(u'copying {0}'.format(displayable_path(dest)))
+            start = time.time()
+            method = copy_file(item.path, dest, self.copy_method,
+                               atomic=False)
+            self.measure(method, item, dest, start)
+
+    #-------------------------------------------------------------------
+    #
+    # Function cached
+    #
+    # Check whether the transcode of an item is in the cache.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: OSError, IOError
+    #
+    #-------------------------------------------------------------------
+    def cached(self, item):
+        if self.cache is None:
+            return False
+        return self.cache.contains(
+            self.cache.key(item.path, self.command(item), self.ext))
+
+    #-------------------------------------------------------------------
+    #
+    # Function pipeline_for
+    #
+    # Get the pipeline that transcodes an item.  With 'pipeline: auto'
+    # the fastest installed programs for the item's format are chosen
+    # once per format.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: Pipeline or None to use the convert command
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def pipeline_for(self, item):
+        if not self.auto_pipeline or self.capabilities is None:
+            return self.pipeline
+        source = item.format.lower()
+        source = FORMAT_NAMES.get(source, source)
+        if source not in self._pipelines:
+            pipeline = Pipeline.fastest(self.capabilities, source,
+                                        self.formats[0], self.throughput)
+            self._log.debug(u'{0} to {1}: {2}'.format(
+                source, self.formats[0],
+                pipeline.command.decode('utf-8') if pipeline
+                else u'convert command'))
+            self._pipelines[source] = pipeline
+        return self._pipelines[source]
+
+    #-------------------------------------------------------------------
+    #
+    # Function command
+    #
+    # Get the command that transcodes an item.  It names the transcode
+    # in the cache and the throughput measurements.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: bytes
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def command(self, item):
+        pipeline = self.pipeline_for(item)
+        if pipeline is not None:
+            return pipeline.command
+        return self.convert_cmd
+
+    #-------------------------------------------------------------------
+    #
+    # Function estimate
+    #
+    # Estimate the size of the added file and how long adding it takes.
+    # Transcodes are estimated from the measured throughput of the
+    # encoder command.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: (bytes, seconds or None, transcoded)
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def estimate(self, item):
+        if not self.should_transcode(item):
+            return super(ExternalConvert, self).estimate(item)
+        rate = None
+        if self.throughput is not None:
+            rate = self.throughput.rate(
+                self.command(item).decode('utf-8', 'replace'))
+        if not rate or not rate.seconds:
+            # The source size is the best guess we have
+            size = super(ExternalConvert, self).estimate(item)[0]
+            return size, None, True
+        length = item.length or 0
+        return (length * rate.size / rate.seconds,
+                length * rate.elapsed / rate.seconds, True)
+
+    #-------------------------------------------------------------------
+    #
+    # Function job_cost
+    #
+    # Estimate how long adding the item takes, relative to other items.
+    # Transcodes are weighted by the target format's encoder.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: float
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def job_cost(self, item):
+        if not self.should_transcode(item):
+            return super(ExternalConvert, self).job_cost(item)
+        return (item.length or 0) * TRANSCODE_COST.get(self.formats[0], 1.0)
+
+    #-------------------------------------------------------------------
+    #
+    # Function destination
+    #
+    # Get the path of the item in this collection, with the extension
+    # of the target format if the item is transcoded.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: path
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def destination(self, item):
+        dest = super(ExternalConvert, self).destination(item)
+        if self.should_transcode(item):
+            return os.path.splitext(dest)[0] + b'.' + self.ext
+        else:
+            return dest
+
+    #-------------------------------------------------------------------
+    #
+    # Function should_transcode
+    #
+    # Check whether the item's format is not one of the collection's
+    # formats.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: item
+    #
+    # Returns
+    # -------
+    #    @return: bool
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def should_transcode(self, item):
+        return item.format.lower() not in self.formats
 
-#-----------------------------------------------------------------------
-#
-# Class AlternativeFiles
-#
-# Factory Class
-#
-# It is a sublcass of the BeetsPlugin class.
-#
-# Inputs
-# ------
-#    @param: ...
-#
-# Returns
-# -------
-#    @return: ...
-#
-# Raises
-# ------
-#    @raises: ...
-#
-#-----------------------------------------------------------------------
-class SOXProgram(Program):
-    pass
 
 #-----------------------------------------------------------------------
 #
-# Class External
+# Class SymlinkView
 #
-# This creates the actual plugin...
+# A collection directory of symbolic links to the library files.
 #
-# It is a sublcass of the BeetsPlugin class.
+# It is a sublcass of the External class.
 #
 # Inputs
 # ------
@@ -676,558 +7185,653 @@ class SOXProgram(Program):
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-#class External(object):
+class SymlinkView(External):
 
-#    ADD = 1
-#    REMOVE = 2
-#    WRITE = 3
-#    MOVE = 4
-#    NOOP = 5
-#    EMBED_ART = 6
-
-#    def __init__(self, log, name, lib, config):
-#        self._log = log
-#        self.name = name
-#        self.lib = lib
-#        self.path_key = 'alt.{0}'.format(name)
-#        self.parse_config(config)
+    def __init__(self, log, lib, alternative, spec):
+        super(SymlinkView, self).__init__(log, lib, alternative, spec)
+        if self.query is None and self.album_query is None:
+            self.query = TrueQuery()
 
     #-------------------------------------------------------------------
     #
-    # Function parse_config
+    # Function update
     #
-    # ...
+    # Sync the links with the library.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: create - Ignored, views are always created
+    #    @param: ids - Item ids to check or None for all items
+    #    @param: journal - Journal holding removed items or None
+    #    @param: verify - Check the links instead of trusting the
+    #                     manifest
+    #    @param: converter - Ignored, links are created right away
+    #    @param: resume - Ignored, links are never left half done
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: True
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def parse_config(self, config):
-#        if 'paths' in config:
-#            path_config = config['paths']
-#        else:
-#            path_config = beets.config['paths']
-#        self.path_formats = get_path_formats(path_config)
-#        query = config['query'].as_str()
-#        self.query, _ = parse_query_string(query, Item)
-#        self.removable = config.get(dict).get('removable', True)
-#        if 'directory' in config:
-#            dir = config['directory'].as_str()
-#        else:
-#            dir = self.name
-#        dir = bytestring_path(dir)
-#        if not os.path.isabs(syspath(dir)):
-#            dir = os.path.join(self.lib.directory, dir)
-#        self.directory = dir
+    def update(self, create=None, ids=None, journal=None, verify=False,
+               converter=None, resume=False):
+        if not os.path.isdir(syspath(self.directory)):
+            ids = None
+
+        self.open_manifest(verify)
+        try:
+            if journal is not None:
+                self.remove_orphans(journal)
+            if ids is None:
+                self.manifest.load()
+
+            for (item, actions) in self.items_actions(ids):
+                dest = self.destination(item)
+                path = self.get_path(item)
+                for action in actions:
+                    if action == self.MOVE:
+                        print_(u'>{0} -> {1}'.format(displayable_path(path),
+                                                     displayable_path(dest)))
+                        self.remove_item(item)
+                        self.create_symlink(item)
+                        self.set_path(item, dest)
+                    elif action == self.ADD:
+                        print_(u'+{0}'.format(displayable_path(dest)))
+                        self.create_symlink(item)
+                        self.set_path(item, dest)
+                    elif action == self.REMOVE:
+                        print_(u'-{0}'.format(displayable_path(path)))
+                        self.remove_item(item)
+                        self.manifest.remove(item.id)
+                    else:
+                        continue
+                    self.store(item)
+
+                if self.REMOVE in actions:
+                    continue
+                if actions or self.manifest.get(item.id) is None:
+                    self.record(item, self.get_path(item))
+        finally:
+            self.close_manifest()
+        return True
 
     #-------------------------------------------------------------------
     #
-    # Function match_item_action
+    # Function stat
     #
-    # ...
+    # Stat a link of the view.  The link target must exist.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: path
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: os.stat_result of the link itself
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: OSError
     #
     #-------------------------------------------------------------------
-#    def matched_item_action(self, item):
-#        path = self.get_path(item)
-#        actions = []
-#        if path and os.path.isfile(syspath(path)):
-#            dest = self.destination(item)
-#            if not util.samefile(path, dest):
-#                actions.extend([self.MOVE, self.WRITE])
-#            elif (os.path.getmtime(syspath(dest))
-#                    < os.path.getmtime(syspath(item.path))):
-#                actions.append(self.WRITE)
-#            album = item.get_album()
-#            if (album and album.artpath and
-#                    (os.path.getmtime(syspath(path))
-#                     < os.path.getmtime(syspath(album.artpath)))):
-#                actions.append(self.EMBED_ART)
-#        else:
-#            actions.append(self.ADD)
-#        return (item, actions)
+    def stat(self, path):
+        os.stat(syspath(path))
+        return os.lstat(syspath(path))
 
     #-------------------------------------------------------------------
     #
-    # Function items_action
+    # Function rebuild
     #
-    # ...
+    # Build the whole view in a temporary sibling directory and swap it
+    # with the current one.  Readers see either the old or the new
+    # view, never a partial one.  A view that holds files other than
+    # links is not rebuilt, since they would be lost.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: journal - Journal holding removed items or None
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: None
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: OSError, UserError
     #
     #-------------------------------------------------------------------
-#    def items_actions(self):
-#        matched_ids = set()
-#        for album in self.lib.albums():
-#            if self.query.match(album):
-#                matched_items = album.items()
-#                matched_ids.update(item.id for item in matched_items)
-#
-#        for item in self.lib.items():
-#            if item.id in matched_ids or self.query.match(item):
-#                yield self.matched_item_action(item)
-#            elif self.get_path(item):
-#                yield (item, [self.REMOVE])
+    def rebuild(self, journal=None):
+        directory = os.path.normpath(self.directory)
+        util.mkdirall(directory)
+        if os.path.isdir(syspath(directory)):
+            path = foreign_file(directory)
+            if path is not None:
+                raise UserError(
+                    u'{0} holds files that are not links, such as {1}. '
+                    u'Move them away or update without --rebuild.'
+                    .format(displayable_path(directory),
+                            displayable_path(path)))
+            mode = os.stat(syspath(directory)).st_mode & 0o7777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o777 & ~umask
+        tmp = bytestring_path(tempfile.mkdtemp(
+            prefix=b'.' + os.path.basename(directory) + b'.',
+            dir=syspath(os.path.dirname(directory))))
+        os.chmod(syspath(tmp), mode)
+
+        try:
+            self.manifest = Manifest(syspath(os.path.join(tmp, MANIFEST_FILE)),
+                                     self.path_key, self.writer)
+            self._save_destinations = True
+            linked = self.build_links(directory, tmp)
+            self.close_manifest()
+
+            with self.stats.phase('swap'):
+                if os.path.isdir(syspath(directory)):
+                    exchange_paths(directory, tmp)
+                else:
+                    os.rename(syspath(tmp), syspath(directory))
+        finally:
+            self.close_manifest()
+            if os.path.isdir(syspath(tmp)):
+                with self.stats.phase('remove'):
+                    kept = remove_links(tmp)
+                for path in kept:
+                    self._log.warning(u'kept {0}'
+                                      .format(displayable_path(path)))
+
+        if journal is not None:
+            for stored in journal.orphans(self.path_key):
+                journal.discard_orphan(self.path_key, stored)
+        print_(u'Rebuilt {0} with {1} links'
+               .format(displayable_path(directory), linked))
 
     #-------------------------------------------------------------------
     #
-    # Function ask_create
+    # Function build_links
     #
-    # ...
+    # Create the links of all matched items below a new root and store
+    # their paths.  Items that left the view lose their path.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: directory - The view's directory
+    #    @param: root - Directory to create the links in instead
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: Number of links created
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: OSError
     #
     #-------------------------------------------------------------------
-#    def ask_create(self, create=None):
-#        if not self.removable:
-#            return True
-#        if create is not None:
-#            return create
-#
-#        msg = u"Collection at '{0}' does not exists. " \
-#              "Maybe you forgot to mount it.\n" \
-#              "Do you want to create the collection? (y/n)" \
-#              .format(displayable_path(self.directory))
-#        return input_yn(msg, require=True)
+    def build_links(self, directory, root):
+        with self.stats.phase('match'):
+            if self.membership is not None:
+                matched_ids = self.membership.matched(self)
+                path_ids = self.member_ids()
+            else:
+                matched_ids = self.matched_ids()
+                if matched_ids is None:
+                    matched_ids = set(item.id for item, actions
+                                      in self.match_items()
+                                      if self.REMOVE not in actions)
+                path_ids = self.path_ids()
+
+        directories = set([root])
+        linked = 0
+        for item in self.stats.timed('load', self.items_by_id(matched_ids)):
+            dest = self.destination(item)
+            link = os.path.join(root, os.path.relpath(dest, directory))
+            with self.stats.phase('link'):
+                parent = os.path.dirname(link)
+                if parent not in directories:
+                    if not os.path.isdir(syspath(parent)):
+                        os.makedirs(syspath(parent))
+                    directories.add(parent)
+                try:
+                    os.symlink(syspath(item.path), syspath(link))
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+                    self._log.warning(u'{0}: duplicate destination'
+                                      .format(displayable_path(dest)))
+                    continue
+            linked += 1
+
+            if self.get_path(item) != dest:
+                self.set_path(item, dest)
+                self.store(item)
+            source = os.stat(syspath(item.path))
+            stat = os.lstat(syspath(link))
+            self.manifest.set(item.id, dest, source.st_mtime, source.st_size,
+                              stat.st_mtime, stat.st_size,
+                              self.art_mtime(item))
+
+        for item in self.items_by_id(path_ids - matched_ids):
+            self.remove_path(item)
+            self.store(item)
+        return linked
 
     #-------------------------------------------------------------------
     #
-    # Function update
+    # Function estimate
     #
-    # ...
+    # Links take neither space nor time worth estimating.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: item
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: (0, 0.0, False)
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def update(self, create=None):
-#        if (not os.path.isdir(syspath(self.directory))
-#                and not self.ask_create(create)):
-#            print_(u'Skipping creation of {0}'
-#                   .format(displayable_path(self.directory)))
-#            return
-
-#        converter = self.converter()
-#        for (item, actions) in self.items_actions():
-#            dest = self.destination(item)
-#            path = self.get_path(item)
-#            for action in actions:
-#                if action == self.MOVE:
-#                    print_(u'>{0} -> {1}'.format(displayable_path(path),
-#                                                 displayable_path(dest)))
-#                    util.mkdirall(dest)
-#                    util.move(path, dest)
-#                    util.prune_dirs(os.path.dirname(path), root=self.directory)
-#                    self.set_path(item, dest)
-#                    item.store()
-#                    path = dest
-#                elif action == self.WRITE:
-#                    print_(u'*{0}'.format(displayable_path(path)))
-#                    item.write(path=path)
-#                elif action == self.EMBED_ART:
-#                    print_(u'~{0}'.format(displayable_path(path)))
-#                    self.embed_art(item, path)
-#                elif action == self.ADD:
-#                    print_(u'+{0}'.format(displayable_path(dest)))
-#                    converter.submit(item)
-#                elif action == self.REMOVE:
-#                    print_(u'-{0}'.format(displayable_path(path)))
-#                    self.remove_item(item)
-#                    item.store()
-
-#        for item, dest in converter.as_completed():
-#            self.set_path(item, dest)
-#            item.store()
-#        converter.shutdown()
+    def estimate(self, item):
+        return 0, 0.0, False
 
     #-------------------------------------------------------------------
     #
-    # Function destination
+    # Function create_symlink
     #
-    # ...
+    # Link the destination of the item to the library file, replacing
+    # a dangling link.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: item
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: None
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def destination(self, item):
-#        return item.destination(basedir=self.directory,
-#                                path_formats=self.path_formats)
+    def create_symlink(self, item):
+        dest = self.destination(item)
+        with self.stats.phase('link'):
+            util.mkdirall(dest)
+            if os.path.islink(syspath(dest)):
+                util.remove(dest)
+            util.link(item.path, dest)
+
+#-----------------------------------------------------------------------
+#
+# Class FanOut
+#
+# Adds items to the directories of one or more alternatives in one
+# pass through a single worker pool.
+#
+# The directories submit their added items through converter().  Once
+# every directory is planned, as_completed() runs one job per item.
+# If more than one directory transcodes the item, its file is decoded
+# once to a temporary WAV file and every encoder reads that file
+# instead of decoding the source again.
+#
+# A directory has at most its io_limit jobs in the pool.  Without one
+# it gets half of the workers if jobs for several directories are
+# queued, so a slow device cannot hold up the others.
+#
+# Inputs
+# ------
+#    @param: max_workers - Defaults to the number of CPUs
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class FanOut(object):
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers or cpu_count()
+        # item id -> [(external, item)]
+        self._jobs = OrderedDict()
+        # directory -> io_limit
+        self._limits = {}
+        self._worker = None
+        # Directories are planned concurrently
+        self._lock = threading.Lock()
 
     #-------------------------------------------------------------------
     #
-    # Function set_path
+    # Function converter
     #
-    # ...
+    # Get the converter an External submits its added items to.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: item
-    #    @param: path
+    #    @param: external
     #
     # Returns
     # -------
-    #    @return: item
+    #    @return: FanOutConverter
     #
     # Raises
     # ------
     #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def set_path(self, item, path):
-#        item[self.path_key] = six.text_type(path, 'utf8')
+    def converter(self, external):
+        return FanOutConverter(self, external)
 
     #-------------------------------------------------------------------
     #
-    # Function get_path
+    # Function add
     #
-    # ...
+    # Queue an item for a directory.
     #
     # Inputs
     # ------
     #    @param: self
+    #    @param: external
     #    @param: item
     #
     # Returns
     # -------
-    #    @return: item
     #    @return: None
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
- #   def get_path(self, item):
- #       try:
- #           return item[self.path_key].encode('utf8')
- #       except KeyError:
- #           return None
+    def add(self, external, item):
+        with self._lock:
+            self._jobs.setdefault(item.id, []).append((external, item))
+            self._limits[external.directory] = external.io_limit
 
     #-------------------------------------------------------------------
     #
-    # Function remove_item
+    # Function as_completed
     #
-    # ...
+    # Convert the queued items.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: Generator of (external, item, dest)
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: Any exception raised while converting
     #
     #-------------------------------------------------------------------
- #   def remove_item(self, item):
- #       path = self.get_path(item)
- #       util.remove(path)
- #       util.prune_dirs(path, root=self.directory)
- #       del item[self.path_key]
+    def as_completed(self):
+        self._worker = Worker(self._convert, max_workers=self._max_workers,
+                              cost=self._cost, groups=self._groups,
+                              limit=self._limit)
+        for targets in self._jobs.values():
+            self._worker.submit(targets)
+        self._jobs.clear()
+        for results in self._worker.as_completed():
+            for result in results:
+                yield result
 
     #-------------------------------------------------------------------
     #
-    # Function converter
+    # Function shutdown
     #
-    # ...
+    # Drop the remaining jobs.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: None
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
- #   def converter(self):
- #       def _convert(item):
- #           dest = self.destination(item)
- #           util.mkdirall(dest)
- #           util.copy(item.path, dest, replace=True)
- #           return item, dest
- #       return Worker(_convert)
+    def shutdown(self):
+        self._jobs.clear()
+        if self._worker is not None:
+            self._worker.shutdown()
 
     #-------------------------------------------------------------------
     #
-    # Function embed_art
+    # Function _cost
     #
-    # ...
+    # Estimate the cost of converting an item for all its directories.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: item
-    #    @param: patch
+    #    @param: targets - [(external, item)]
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: float
     #
     # Raises
     # ------
     #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def embed_art(self, item, path):
-#        album = item.get_album()
-#        if album and album.artpath:
-#            self._log.debug("Embedding art from {} into {}".format(
-#                displayable_path(album.artpath),
-#                displayable_path(path)))
-#            art.embed_item(self._log, item, album.artpath,
-#                           itempath=path)
-
-#-----------------------------------------------------------------------
-#
-# Class ExternalConvert
-#
-# This ...
-#
-# It is a sublcass of the ... class.
-#
-# Inputs
-# ------
-#    @param: ...
-#
-# Returns
-# -------
-#    @return: ...
-#
-# Raises
-# ------
-#    @raises: ...
-#
-#-----------------------------------------------------------------------
-#class ExternalConvert(External):
-#    def __init__(self, log, name, formats, lib, config):
-#        super(ExternalConvert, self).__init__(log, name, lib, config)
-#        convert_plugin = convert.ConvertPlugin()
-#        self._encode = convert_plugin.encode
-#        self._embed = convert_plugin.config['embed'].get(bool)
-#        self.formats = [f.lower() for f in formats]
-#        self.formats = [convert.ALIASES.get(f, f) for f in formats]
-#        self.convert_cmd, self.ext = convert.get_format(self.formats[0])
+    def _cost(self, targets):
+        return sum(external.job_cost(item) for external, item in targets)
 
     #-------------------------------------------------------------------
     #
-    # Function converter
+    # Function _groups
     #
-    # ...
+    # Get the directories a job writes to.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: targets - [(external, item)]
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: Set of directories
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def converter(self):
-#        fs_lock = threading.Lock()
-
-        #-------------------------------------------------------------------
-        #
-        # Function _convert
-        #
-        # ...
-        #
-        # Inputs
-        # ------
-        #    @param: self
-        #    @param: name
-        #    @param: lib
-        #
-        # Returns
-        # -------
-        #    @return: ...
-        #    @return: ...
-        #
-        # Raises
-        # ------
-        #    @raises: KeyError
-        #
-        #-------------------------------------------------------------------
-#        def _convert(item):
-#            dest = self.destination(item)
-#            with fs_lock:
-#                util.mkdirall(dest)
+    def _groups(self, targets):
+        return set(external.directory for external, _ in targets)
 
-#            if self.should_transcode(item):
-#                self._encode(self.convert_cmd, item.path, dest)
-#            else:
-#                self._log.debug(u'copying {0}'.format(displayable_path(dest)))
-#                util.copy(item.path, dest, replace=True)
-#            if self._embed:
-#                self.embed_art(item, dest)
-#            return item, dest
-#        return Worker(_convert)
+    #-------------------------------------------------------------------
+    #
+    # Function _limit
+    #
+    # Get the number of jobs a directory may have in the pool.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: directory
+    #
+    # Returns
+    # -------
+    #    @return: int, 0 for no limit
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def _limit(self, directory):
+        limit = self._limits.get(directory)
+        if limit or len(self._limits) < 2:
+            return limit
+        return max(1, self._max_workers // 2)
 
     #-------------------------------------------------------------------
     #
-    # Function destination
+    # Function _convert
     #
-    # ...
+    # Convert an item for all its directories, decoding it at most once.
+    # Transcodes from the cache do not need the decoded file.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: targets - [(external, item)]
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: [(external, item, dest)]
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: subprocess.CalledProcessError, EnvironmentError
     #
     #-------------------------------------------------------------------
-#    def destination(self, item):
-#        dest = super(ExternalConvert, self).destination(item)
-#        if self.should_transcode(item):
-#            return os.path.splitext(dest)[0] + b'.' + self.ext
-#        else:
-#            return dest
+    def _convert(self, targets):
+        # Pipelines decode the file themselves
+        transcoding = [e for e, item in targets
+                       if isinstance(e, ExternalConvert)
+                       and e.should_transcode(item) and not e.cached(item)
+                       and e.pipeline_for(item) is None]
+        source = None
+        if len(transcoding) > 1:
+            source = self._decode(transcoding[0], targets[0][1])
+        try:
+            return [(external, item,
+                     external.convert(item, source if external in transcoding
+                                      else None))
+                    for external, item in targets]
+        finally:
+            if source is not None:
+                util.remove(source)
 
     #-------------------------------------------------------------------
     #
-    # Function should_transcode
+    # Function _decode
     #
-    # ...
+    # Decode the item's file to a temporary WAV file.
     #
     # Inputs
     # ------
     #    @param: self
+    #    @param: external - ExternalConvert whose encoder is used
     #    @param: item
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: Path of the temporary file
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: subprocess.CalledProcessError
     #
     #-------------------------------------------------------------------
-#    def should_transcode(self, item):
-#        return item.format.lower() not in self.formats
+    def _decode(self, external, item):
+        if 'wav' in beets.config['convert']['formats']:
+            from beetsplug import convert
+            command, ext = convert.get_format('wav')
+        else:
+            command, ext = DECODE_COMMAND, b'wav'
+        tmpdir = beets.config['convert']['tmpdir'].get()
+        if tmpdir:
+            tmpdir = beets.config['convert']['tmpdir'].as_filename()
+        fd, path = tempfile.mkstemp(suffix='.' + ext.decode('ascii'),
+                                    dir=tmpdir)
+        os.close(fd)
+        path = bytestring_path(path)
+        try:
+            with external.stats.phase('decode'):
+                external._encode(command, item.path, path)
+        except BaseException:
+            util.remove(path)
+            raise
+        return path
 
 
 #-----------------------------------------------------------------------
 #
-# Class SymlinkView
+# Class FanOutConverter
 #
-# This creates the actual plugin...
+# Submits the added items of one directory to a FanOut.
 #
-# It is a sublcass of the BeetsPlugin class.
+# Inputs
+# ------
+#    @param: fanout
+#    @param: external
+#
+# Returns
+# -------
+#    @return: ...
+#
+# Raises
+# ------
+#    @raises: ...
+#
+#-----------------------------------------------------------------------
+class FanOutConverter(object):
+    def __init__(self, fanout, external):
+        self._fanout = fanout
+        self._external = external
+
+    def submit(self, item):
+        self._fanout.add(self._external, item)
+
+#-----------------------------------------------------------------------
+#
+# Class Worker
+#
+# Runs a function on a thread pool and collects the results.
+#
+# Submitted jobs are queued and only started by as_completed(), most
+# expensive first, so that a long recording does not end up running
+# alone at the end of an update.  At most `window` jobs are handed to
+# the pool at a time.  Jobs that have not started yet are dropped when
+# the update is interrupted.
+#
+# The threads only wait for the encoder processes started by the
+# convert plugin, so there is no need for a process pool.
 #
 # Inputs
 # ------
-#    @param: ...
+#    @param: fn - Function to run for each submitted job
+#    @param: max_workers - Defaults to the number of CPUs
+#    @param: cost - Function estimating the cost of a job from its
+#                   arguments.  Jobs run in submission order without it.
+#    @param: window - Maximum number of jobs in the pool, defaults to
+#                     twice the number of workers
+#    @param: groups - Function returning the groups a job belongs to,
+#                     e.g. the devices it writes to
+#    @param: limit - Function returning the maximum number of jobs of
+#                    a group in the pool, 0 for no limit.  A job waits
+#                    while any of its groups is full, jobs of other
+#                    groups are handed to the pool meanwhile.
 #
 # Returns
 # -------
@@ -1238,178 +7842,207 @@ class SOXProgram(Program):
 #    @raises: ...
 #
 #-----------------------------------------------------------------------
-#class SymlinkView(External):
+class Worker(object):
+    def __init__(self, fn, max_workers=None, cost=None, window=None,
+                 groups=None, limit=None):
+        from concurrent import futures
+        max_workers = max_workers or cpu_count()
+        self._executor = futures.ThreadPoolExecutor(max_workers)
+        self._window = window or 2 * max_workers
+        self._fn = fn
+        self._cost = cost
+        self._groups = groups
+        self._limit = limit
+        # groups -> heap of jobs
+        self._queues = {}
+        self._count = 0
+        self._tasks = set()
+        # group -> jobs in the pool
+        self._running = {}
+        # future -> groups of its job
+        self._held = {}
+
     #-------------------------------------------------------------------
     #
-    # Function parse_config
+    # Function submit
     #
-    # ...
+    # Queue a job running fn with the given arguments.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
+    #    @param: *args
+    #    @param: **kwargs
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: None
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def parse_config(self, config):
-#        if 'query' not in config:
-#            config['query'] = u''  # This is a TrueQuery()
-#        super(SymlinkView, self).parse_config(config)
+    def submit(self, *args, **kwargs):
+        cost = self._cost(*args, **kwargs) if self._cost else 0
+        groups = tuple(self._groups(*args, **kwargs)) \
+            if self._groups else ()
+        # The counter keeps jobs of equal cost in submission order
+        heapq.heappush(self._queues.setdefault(groups, []),
+                       (-cost, self._count, args, kwargs))
+        self._count += 1
 
     #-------------------------------------------------------------------
     #
-    # Function update
+    # Function as_completed
     #
-    # ...
+    # Run the queued jobs and yield their results as they finish.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: name
-    #    @param: lib
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: Generator of results
     #
     # Raises
     # ------
-    #    @raises: KeyError
+    #    @raises: Any exception raised by fn
     #
     #-------------------------------------------------------------------
- #   def update(self, create=None):
- #       for (item, actions) in self.items_actions():
- #           dest = self.destination(item)
- #           path = self.get_path(item)
- #           for action in actions:
- #               if action == self.MOVE:
- #                   print_(u'>{0} -> {1}'.format(displayable_path(path),
- #                                                displayable_path(dest)))
- #                   self.remove_item(item)
- #                   self.create_symlink(item)
- #                   self.set_path(item, dest)
- #               elif action == self.ADD:
- #                   print_(u'+{0}'.format(displayable_path(dest)))
- #                   self.create_symlink(item)
- #                   self.set_path(item, dest)
- #               elif action == self.REMOVE:
- #                   print_(u'-{0}'.format(displayable_path(path)))
- #                   self.remove_item(item)
- #               else:
- #                   continue
- #               item.store()
+    def as_completed(self):
+        from concurrent import futures
+        try:
+            self._fill()
+            while self._tasks:
+                done, _ = futures.wait(self._tasks,
+                                       return_when=futures.FIRST_COMPLETED)
+                self._tasks.difference_update(done)
+                for f in done:
+                    for group in self._held.pop(f, ()):
+                        self._running[group] -= 1
+                self._fill()
+                for f in done:
+                    yield f.result()
+        except BaseException:
+            # Also reached when the caller abandons the generator
+            self.cancel()
+            raise
 
     #-------------------------------------------------------------------
     #
-    # Function create_symlink
+    # Function cancel
     #
-    # ...
+    # Drop all jobs that have not started yet.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: item
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: None
     #
     # Raises
     # ------
     #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def create_symlink(self, item):
-#        dest = self.destination(item)
-#        util.mkdirall(dest)
-#        util.link(item.path, dest)
+    def cancel(self):
+        self._queues.clear()
+        for f in self._tasks:
+            f.cancel()
+        self._tasks.clear()
+        self._running.clear()
+        self._held.clear()
 
-#-----------------------------------------------------------------------
-#
-# Class Worker
-#
-# This ...
-#
-# It is a sublcass of the ... class.
-#
-# Inputs
-# ------
-#    @param: ...
-#
-# Returns
-# -------
-#    @return: ...
-#
-# Raises
-# ------
-#    @raises: ...
-#
-#-----------------------------------------------------------------------
-#class Worker(futures.ThreadPoolExecutor):
-#    def __init__(self, fn, max_workers=None):
-#        super(Worker, self).__init__(max_workers or cpu_count())
-#        self._tasks = set()
-#        self._fn = fn
+    #-------------------------------------------------------------------
+    #
+    # Function shutdown
+    #
+    # Cancel the remaining jobs and release the threads.
+    #
+    # Inputs
+    # ------
+    #    @param: self
+    #    @param: wait - Wait for the running jobs to finish
+    #
+    # Returns
+    # -------
+    #    @return: None
+    #
+    # Raises
+    # ------
+    #    @raises: ...
+    #
+    #-------------------------------------------------------------------
+    def shutdown(self, wait=True):
+        self.cancel()
+        self._executor.shutdown(wait)
 
     #-------------------------------------------------------------------
     #
-    # Function submit
+    # Function _fill
     #
-    # ...
+    # Hand the most expensive queued jobs to the pool until the window
+    # is full.  Jobs of a full group are skipped.
     #
     # Inputs
     # ------
     #    @param: self
-    #    @param: *args
-    #    @param: **kwargs
     #
     # Returns
     # -------
-    #    @return: fut
+    #    @return: None
     #
     # Raises
     # ------
     #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def submit(self, *args, **kwargs):
-#        fut = super(Worker, self).submit(self._fn, *args, **kwargs)
-#        self._tasks.add(fut)
-#        return fut
+    def _fill(self):
+        while self._queues and len(self._tasks) < self._window:
+            ready = [(queue[0], groups)
+                     for groups, queue in self._queues.items()
+                     if not self._full(groups)]
+            if not ready:
+                return
+            _, groups = min(ready, key=lambda job: job[0][:2])
+            queue = self._queues[groups]
+            _, _, args, kwargs = heapq.heappop(queue)
+            if not queue:
+                del self._queues[groups]
+            f = self._executor.submit(self._fn, *args, **kwargs)
+            self._tasks.add(f)
+            if groups:
+                self._held[f] = groups
+                for group in groups:
+                    self._running[group] = self._running.get(group, 0) + 1
 
     #-------------------------------------------------------------------
     #
-    # Function as_completed
+    # Function _full
     #
-    # ...
+    # Check whether any of the groups has reached its limit.
     #
     # Inputs
     # ------
     #    @param: self
+    #    @param: groups
     #
     # Returns
     # -------
-    #    @return: ...
-    #    @return: ...
+    #    @return: bool
     #
     # Raises
     # ------
     #    @raises: ...
     #
     #-------------------------------------------------------------------
-#    def as_completed(self):
-#        for f in futures.as_completed(self._tasks):
-#            self._tasks.remove(f)
-#            yield f.result()
+    def _full(self, groups):
+        for group in groups:
+            limit = self._limit(group) if self._limit else 0
+            if limit and self._running.get(group, 0) >= limit:
+                return True
+        return False
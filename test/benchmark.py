@@ -0,0 +1,193 @@
+"""Benchmark the alternatives pipeline on synthetic libraries.
+
+Run from the test directory:
+
+    python benchmark.py --sizes 10000,100000 --output results.json
+
+Every phase is timed separately and reported as one JSON object per
+line with the library size, the phase, the number of items it handled
+and the elapsed seconds.  Phases that touch real files (tag writes and
+conversion) run on a sample of the library.
+"""
+from __future__ import print_function
+
+import sys
+import os
+import json
+import time
+import shutil
+from optparse import OptionParser
+from six import StringIO
+
+from helper import TestHelper
+
+from beets import plugins
+from beets.library import Item
+from beets.util import syspath, bytestring_path
+
+from beetsplug import alternatives
+from beetsplug import convert
+
+
+SIZES = [10000, 100000, 500000]
+
+# Items per album and albums per artist of the synthetic library
+ALBUM_SIZE = 10
+ARTIST_SIZE = 5
+
+
+class Benchmark(TestHelper):
+
+    def __init__(self, size, sample, output):
+        super(Benchmark, self).__init__('run')
+        self.size = size
+        self.sample = sample
+        self.output = output
+
+    def setUp(self):
+        # Unlike the tests we want the real thread pool
+        self._tempdirs = []
+        self._plugins = []
+        plugins._classes = set([alternatives.SmartAlternativesPlugin,
+                                convert.ConvertPlugin])
+        self.setup_beets()
+
+    def timed(self, phase, items, fn, *args):
+        # Keep the plugin's messages out of the results
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            start = time.time()
+            result = fn(*args)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+        self.output.write(json.dumps({
+            'size': self.size,
+            'phase': phase,
+            'items': items,
+            'seconds': round(elapsed, 4),
+        }) + '\n')
+        self.output.flush()
+        return result
+
+    def generate(self):
+        path = os.path.join(self.fixture_dir, b'min.mp3')
+        with self.lib.transaction():
+            for i in range(self.size):
+                album = i // ALBUM_SIZE
+                artist = album // ARTIST_SIZE
+                item = Item(
+                    path=path,
+                    title=u'track {0}'.format(i),
+                    track=i % ALBUM_SIZE + 1,
+                    album=u'album {0}'.format(album),
+                    artist=u'artist {0}'.format(artist),
+                    albumartist=u'artist {0}'.format(artist),
+                    year=1950 + artist % 70,
+                    format=u'FLAC' if album % 2 else u'MP3',
+                    length=180.0 + i % 120,
+                    mtime=1,
+                )
+                if artist % 2:
+                    item['onplayer'] = u'true'
+                item.add(self.lib)
+
+    def alternative(self, name, **config):
+        config.setdefault('directory', self.mkdtemp())
+        config.setdefault('query', u'onplayer:true')
+        config.setdefault('paths', {'default': u'$albumartist/$album/$title'})
+        self.config['alternatives'][name] = config
+        plugin = alternatives.SmartAlternativesPlugin()
+        plugin.build_queries()
+        self._plugins.append(plugin)
+        return plugin.alternative(name, self.lib)
+
+    def tearDown(self):
+        for plugin in self._plugins:
+            plugin.close_state()
+        super(Benchmark, self).tearDown()
+
+    def run(self):
+        self.timed('generate', self.size, self.generate)
+
+        # The encoder only copies the file
+        self.config['convert']['formats'] = {
+            'ogg': u'cp $source $dest',
+        }
+        alt = self.alternative('bench', formats=u'ogg mp3')
+        external = alt.externals[0]
+        matched = self.timed('match_sql', self.size, external.matched_ids)
+        self.timed('match_python', self.size,
+                   lambda: sum(1 for _ in external.match_items()))
+        self.timed('plan', self.size, external.plan)
+        self.timed('destinations', self.size, lambda: [
+            external.destination(item) for item in self.lib.items()])
+        self.timed('dispatch', len(matched), self.dispatch, external)
+
+        sample = list(self.lib.items(u'onplayer:true'))[:self.sample]
+        self.timed('conversion', len(sample), self.convert, external, sample)
+        paths = self.copy_files(sample)
+        self.timed('tag_compare', len(sample), lambda: [
+            external.tags_match(item, path)
+            for item, path in zip(sample, paths)])
+        self.timed('tag_writes', len(sample), lambda: [
+            item.write(path=path) for item, path in zip(sample, paths)])
+        if alt.journal is not None:
+            alt.journal.close()
+
+        view = self.alternative('view', formats=u'link')
+        self.timed('symlink_view', len(matched), view.update)
+
+    def dispatch(self, external):
+        worker = alternatives.Worker(lambda item: item,
+                                     cost=external.job_cost)
+        for item in external.items_by_id(external.matched_ids()):
+            worker.submit(item)
+        for _ in worker.as_completed():
+            pass
+        worker.shutdown()
+
+    def convert(self, external, items):
+        worker = external.converter()
+        for item in items:
+            worker.submit(item)
+        for _ in worker.as_completed():
+            pass
+        worker.shutdown()
+
+    def copy_files(self, items):
+        directory = bytestring_path(self.mkdtemp())
+        paths = []
+        for item in items:
+            path = os.path.join(directory, b'%d.mp3' % item.id)
+            shutil.copy(syspath(item.path), syspath(path))
+            paths.append(path)
+        return paths
+
+
+def main(args=None):
+    parser = OptionParser(usage=u'%prog [options]')
+    parser.add_option('--sizes', default=','.join(map(str, SIZES)),
+                      help='comma separated library sizes')
+    parser.add_option('--sample', type='int', default=200,
+                      help='items used for tag writes and conversion')
+    parser.add_option('--output', help='write the results to this file')
+    options, _ = parser.parse_args(args)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        for size in options.sizes.split(','):
+            benchmark = Benchmark(int(size), options.sample, output)
+            benchmark.setUp()
+            try:
+                benchmark.run()
+            finally:
+                benchmark.tearDown()
+                benchmark.doCleanups()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,22 @@
+import errno
 import os
 import os.path
+import json
+import shutil
+import subprocess
+import threading
+import time
+from unittest import TestCase
+
+from mock import patch
 
 from helper import TestHelper, control_stdin
 
+from beetsplug import alternatives
+
 from beets.mediafile import MediaFile
-from beets.util import bytestring_path
+from beets.library import Item
+from beets.util import bytestring_path, syspath
 
 
 class DocTest(TestHelper):
@@ -115,14 +127,233 @@ class ExternalCopyTest(TestHelper):
         for item in album.items():
             self.assertIsFile(item['alt.myexternal'])
 
+    def test_update_all(self):
+        self.config['alternatives']['other'] = {
+            'directory': self.mkdtemp(),
+            'query': u'other:true',
+            'io_limit': 1,
+        }
+        item = self.add_track(myexternal='true', other='true')
+        self.runcli('alt', 'update', '--all')
+        item.load()
+        self.assertIsFile(item['alt.myexternal'])
+        self.assertIsFile(item['alt.other'])
+
+        out = self.runcli('alt', 'update')
+        self.assertIn(u'usage: beet alt update [--all] NAME...', out)
+
+    def test_update_same_name_twice(self):
+        item = self.add_track(myexternal='true')
+        with patch.object(alternatives.AlternativeFiles, 'start',
+                          autospec=True,
+                          side_effect=alternatives.AlternativeFiles.start) \
+                as start:
+            self.runcli('alt', 'update', 'myexternal', 'myexternal')
+        self.assertEqual(start.call_count, 1)
+        item.load()
+        self.assertIsFile(item['alt.myexternal'])
+
+    def test_membership_snapshot(self):
+        item = self.add_track(myexternal='true')
+        self.runcli('alt', 'update', 'myexternal')
+        path = os.path.join(
+            bytestring_path(self.external_config['directory'].as_str()),
+            alternatives.MANIFEST_FILE)
+        manifest = alternatives.Manifest(syspath(path), 'alt.myexternal')
+        self.assertEqual(list(manifest.snapshot()), [item.id])
+        manifest.close()
+
+        item['myexternal'] = 'false'
+        item.store()
+        with patch.object(alternatives.Membership, '_select_paths') as select:
+            self.runcli('alt', 'update', '--full', 'myexternal')
+        self.assertFalse(select.called)
+        item.load()
+        self.assertNotIn('alt.myexternal', item)
+
+        manifest = alternatives.Manifest(syspath(path), 'alt.myexternal')
+        self.assertEqual(list(manifest.snapshot()), [])
+        manifest.close()
+
+    def test_killed_after_checkpoint(self):
+        items = [self.add_track(myexternal='true') for _ in range(3)]
+        path = os.path.join(
+            bytestring_path(self.external_config['directory'].as_str()),
+            alternatives.MANIFEST_FILE)
+        commit = alternatives.Manifest.commit
+        state = {}
+
+        def checkpoint(manifest, force=True):
+            commit(manifest, force)
+            if force or manifest._changes:
+                return
+            # What a kill right after the checkpoint leaves on disk
+            saved = alternatives.Manifest(syspath(path), 'alt.myexternal')
+            state['pending'] = [row[0] for row in saved.pending()]
+            state['done'] = [item.id for item in items
+                             if saved.get(item.id) is not None]
+            saved.close()
+            state['stored'] = [item.id for item in items
+                               if 'alt.myexternal' in
+                               self.lib.get_item(item.id)]
+            raise KeyboardInterrupt
+
+        with patch.object(alternatives, 'CHECKPOINT_INTERVAL', 2), \
+                patch.object(alternatives.Manifest, 'commit', checkpoint):
+            with self.assertRaises(KeyboardInterrupt):
+                self.runcli('alt', 'update', 'myexternal')
+        self.assertTrue(state['done'])
+        for item_id in state['done']:
+            self.assertTrue(item_id in state['stored'] or
+                            item_id in state['pending'])
+
+    def test_manifest_bytes_paths(self):
+        path = os.path.join(self.mkdtemp(), 'manifest.db')
+        manifest = alternatives.Manifest(path, 'alt.myexternal')
+        manifest.set(1, b'/music/\xff.mp3', 1.0, 1, 1.0, 1, None)
+        # Written as text by older versions
+        manifest._connection.execute(
+            "INSERT INTO files VALUES ('alt.myexternal', 2, "
+            "'/music/b.mp3', 1, 1, 1, 1, NULL)")
+        manifest.close()
+
+        manifest = alternatives.Manifest(path, 'alt.myexternal')
+        self.assertEqual(manifest.get(1).path, b'/music/\xff.mp3')
+        self.assertEqual(manifest.get(2).path, b'/music/b.mp3')
+        manifest.remove_path(b'/music/b.mp3')
+        self.assertIsNone(manifest.get(2))
+        manifest.close()
+
     def test_add_nonexistent(self):
         item = self.add_external_track('myexternal')
         path = item['alt.myexternal']
         os.remove(path)
 
+        self.runcli('alt', 'update', '--verify-fs', 'myexternal')
+        self.assertIsFile(item['alt.myexternal'])
+
+    def test_skip_write_for_matching_tags(self):
+        item = self.add_external_track('myexternal')
+        path = item['alt.myexternal']
+        mtime = os.path.getmtime(path)
+        item.write()
+        item.store()
+
+        out = self.runcli('alt', 'update', '--full', 'myexternal')
+        self.assertNotIn('*', out)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+        item['composer'] = 'JSB'
+        item.store()
+        item.write()
+        out = self.runcli('alt', 'update', 'myexternal')
+        self.assertIn('*', out)
+        self.assertEqual(MediaFile(path).composer, 'JSB')
+
+    def test_plan(self):
+        directory = self.external_config['directory'].as_str()
+        item = self.add_track(myexternal='true')
+        out = self.runcli('alt', 'plan', 'myexternal')
+        self.assertIn('add: 1 (0 transcoded', out)
+        self.assertIn('1 files without measurements', out)
+        self.assertEqual(os.listdir(directory), [])
+
+        self.runcli('alt', 'update', 'myexternal')
+        item.load()
+        item['title'] = 'a new title'
+        item.store()
+        self.add_track(myexternal='true', title='another track')
+        out = self.runcli('alt', 'plan', 'myexternal')
+        self.assertIn('add: 1 (0 transcoded', out)
+        self.assertIn('move: 1', out)
+        self.assertNotIn('without measurements', out)
+        item.load()
+        self.assertIsFile(item['alt.myexternal'])
+
+    def test_stats(self):
+        self.add_track(myexternal='true')
+        path = os.path.join(self.mkdtemp(), 'stats.json')
+        out = self.runcli('alt', 'update', '--stats', '--stats-json', path,
+                          'myexternal')
+        self.assertIn('wall time:', out)
+
+        with open(path) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['phases']['build_queries']['calls'], 1)
+        self.assertEqual(stats['phases']['copy']['calls'], 1)
+        self.assertEqual(stats['phases']['store']['calls'], 1)
+        self.assertGreater(stats['counters']['bytes_written'], 0)
+        self.assertEqual(stats['counters']['bytes_read'],
+                         stats['counters']['bytes_written'])
+
+    def test_paths_stored_in_batches(self):
+        items = [self.add_track(title=u'track {0}'.format(i),
+                                myexternal='true') for i in range(3)]
+        path = os.path.join(self.mkdtemp(), 'stats.json')
+        self.runcli('alt', 'update', '--stats-json', path, 'myexternal')
+        with open(path) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['phases']['store']['calls'], 1)
+        for item in items:
+            item.load()
+            self.assertIsFile(item['alt.myexternal'])
+
+        writer = alternatives.LibraryWriter(self.lib, batch=2)
+        for item in items:
+            item['stored'] = u'yes'
+            writer.store(item)
+        self.assertEqual(len(self.lib.items(u'stored:yes')), 2)
+        writer.flush()
+        self.assertEqual(len(self.lib.items(u'stored:yes')), 3)
+
+    def test_update_only_journaled(self):
+        item = self.add_external_track('myexternal')
+        path = item['alt.myexternal']
+        os.remove(path)
+
+        self.runcli('alt', 'update', '--full', 'myexternal')
+        self.assertIsNotFile(path)
+
+        item['title'] = 'a new title'
+        item.store()
         self.runcli('alt', 'update', 'myexternal')
+        item.load()
         self.assertIsFile(item['alt.myexternal'])
 
+    def test_verify_replaces_changed_file(self):
+        item = self.add_external_track('myexternal')
+        path = item['alt.myexternal']
+        with open(path, 'ab') as f:
+            f.write(b'garbage')
+
+        self.runcli('alt', 'update', '--full', 'myexternal')
+        self.assertFileTag(path, b'rbage')
+        self.runcli('alt', 'update', '--verify-fs', 'myexternal')
+        self.assertNotFileTag(path, b'rbage')
+
+    def test_verify_writes_library_changes(self):
+        item = self.add_external_track('myexternal')
+        item['genre'] = u'changed'
+        item.store()
+
+        self.runcli('alt', 'update', '--full', 'myexternal')
+        item.load()
+        self.assertNotEqual(
+            MediaFile(syspath(item['alt.myexternal'])).genre, u'changed')
+        self.runcli('alt', 'update', '--verify-fs', 'myexternal')
+        item.load()
+        self.assertEqual(MediaFile(syspath(item['alt.myexternal'])).genre,
+                         u'changed')
+
+    def test_remove_from_library(self):
+        item = self.add_external_track('myexternal')
+        path = item['alt.myexternal']
+        self.assertIsFile(path)
+
+        self.runcli('remove', '--force', 'myexternal:true')
+        self.runcli('alt', 'update', 'myexternal')
+        self.assertIsNotFile(path)
+
     def test_add_replace(self):
         item = self.add_external_track('myexternal')
         del item['alt.myexternal']
@@ -167,6 +398,107 @@ class ExternalCopyTest(TestHelper):
         self.assertIsNotFile(old_path)
         self.assertIsFile(new_path)
 
+    def test_move_album_directory(self):
+        self.external_config['paths'] = {'default': '$artist/$album/$title'}
+        items = [self.add_track(myexternal='true', title=u'track 1'),
+                 self.add_track(myexternal='true', title=u'track 2')]
+        self.add_track(myexternal='true', album=u'album 2')
+        self.runcli('alt', 'update', 'myexternal')
+        items[0].load()
+        old_dir = os.path.dirname(items[0]['alt.myexternal'])
+
+        self.external_config['paths'] = {'default': '$album/$title'}
+        out = self.runcli('alt', 'update', 'myexternal')
+        new_dir = os.path.join(self.external_config['directory'].as_str(),
+                               u'album 1')
+        self.assertEqual(len([line for line in out.splitlines()
+                              if line.startswith('>')]), 2)
+        self.assertIn(u'>{0} -> {1}'.format(old_dir, new_dir), out)
+        for item in items:
+            item.load()
+            self.assertEqual(os.path.dirname(item['alt.myexternal']),
+                             new_dir)
+            self.assertIsFile(item['alt.myexternal'])
+        self.assertFalse(os.path.exists(os.path.dirname(old_dir)))
+
+    def test_move_part_of_album_directory(self):
+        self.external_config['paths'] = {'default': '$artist/$album/$title'}
+        moved = self.add_track(myexternal='true', title=u'track 1')
+        kept = self.add_track(myexternal='true', title=u'track 2')
+        self.runcli('alt', 'update', 'myexternal')
+
+        moved.artist = u'another artist'
+        moved.store()
+        self.runcli('alt', 'update', 'myexternal')
+        for item in [moved, kept]:
+            item.load()
+            self.assertIsFile(item['alt.myexternal'])
+        self.assertIn(u'another artist', moved['alt.myexternal'])
+        self.assertNotIn(u'another artist', kept['alt.myexternal'])
+
+    def test_hardlink_format(self):
+        self.external_config['formats'] = u'hardlink'
+        item = self.add_external_track('myexternal')
+        self.assertTrue(os.path.samefile(item['alt.myexternal'], item.path))
+
+        item['title'] = u'a new title'
+        item.store()
+        self.runcli('alt', 'update', 'myexternal')
+        item.load()
+        self.assertIn(u'a new title', item['alt.myexternal'])
+        self.assertTrue(os.path.samefile(item['alt.myexternal'], item.path))
+
+    def test_copy_methods(self):
+        source = os.path.join(self.fixture_dir, b'min.mp3')
+        directory = bytestring_path(self.mkdtemp())
+        with open(source, 'rb') as f:
+            content = f.read()
+        for method in alternatives.COPY_METHODS:
+            dest = os.path.join(directory, method.encode('ascii'))
+            shutil.copy(source, os.path.join(directory, b'source'))
+            used = alternatives.copy_file(os.path.join(directory, b'source'),
+                                          dest, method)
+            self.assertIn(used, alternatives.COPY_METHODS)
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(os.stat(dest).st_nlink, 2)
+
+    def test_short_kernel_copy(self):
+        source = os.path.join(self.fixture_dir, b'min.mp3')
+        dest = os.path.join(bytestring_path(self.mkdtemp()), b'dest')
+        calls = []
+
+        def short(*args):
+            calls.append(args)
+            return 0 if len(calls) > 1 else 16
+
+        with patch('os.copy_file_range', side_effect=short, create=True):
+            with patch('os.sendfile', return_value=0, create=True):
+                alternatives.kernel_copy(source, dest)
+        with open(source, 'rb') as f:
+            content = f.read()
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_copy_file_is_atomic(self):
+        directory = bytestring_path(self.mkdtemp())
+        dest = os.path.join(directory, b'dest')
+        with open(dest, 'wb') as f:
+            f.write(b'old')
+
+        def fail(path, dest):
+            with open(dest, 'wb') as f:
+                f.write(b'partial')
+            raise IOError('disk full')
+
+        with patch('beetsplug.alternatives.kernel_copy', side_effect=fail):
+            self.assertRaises(IOError, alternatives.copy_file,
+                              os.path.join(self.fixture_dir, b'min.mp3'),
+                              dest)
+        self.assertEqual(os.listdir(directory), [b'dest'])
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+
     def test_move_after_tags_changed(self):
         item = self.add_external_track('myexternal')
         old_path = item['alt.myexternal']
@@ -262,6 +594,162 @@ class ExternalConvertTest(TestHelper):
         mediafile = MediaFile(converted_path)
         self.assertIsNotNone(mediafile.art)
 
+    def test_art_is_processed_once_per_album(self):
+        self.config['convert']['embed'] = True
+        album = self.add_album(myexternal='true', format='m4a')
+        album.artpath = os.path.join(self.fixture_dir, b'image.png')
+        album.store()
+        item = self.add_track(title=u'track 2', myexternal='true')
+        item.album_id = album.id
+        item.store()
+
+        load = alternatives.ArtCache._load
+        calls = []
+
+        def counting_load(cache, *args):
+            calls.append(args)
+            return load(cache, *args)
+
+        with patch.object(alternatives.ArtCache, '_load', counting_load):
+            self.runcli('alt', 'update', 'myexternal')
+        self.assertEqual(len(calls), 1)
+        for item in album.items():
+            self.assertIsNotNone(MediaFile(item['alt.myexternal']).art)
+
+    def test_decode_once_for_all_directories(self):
+        decoded = os.path.join(self.mkdtemp(), 'decoded')
+        self.config['convert']['formats']['wav'] = \
+            'bash -c "cp \'$source\' \'$dest\'; echo >> {0}"'.format(decoded)
+        self.config['alternatives'] = {'alternatives': [{
+            'name': 'multi',
+            'query': u'myexternal:true',
+            'directories': [
+                {'directory': self.mkdtemp(), 'formats': 'ogg'},
+                {'directory': self.mkdtemp(), 'formats': 'ogg'},
+            ],
+        }]}
+        item = self.add_track(myexternal='true', format='mp4')
+        self.runcli('alt', 'update', 'multi')
+        item.load()
+        self.assertFileTag(item['alt.multi'], b'ISOGG')
+        self.assertFileTag(item['alt.multi.1'], b'ISOGG')
+        with open(decoded) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_resume_interrupted_update(self):
+        encoded = os.path.join(self.mkdtemp(), 'encoded')
+        self.config['convert']['formats']['ogg'] = \
+            'bash -c "cp \'$source\' \'$dest\'; printf ISOGG >> \'$dest\';' \
+            'echo >> {0}"'.format(encoded)
+        item = self.add_track(myexternal='true', format='mp4')
+
+        with patch.object(alternatives.External, 'added',
+                          side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.runcli('alt', 'update', 'myexternal')
+        item.load()
+        self.assertNotIn('alt.myexternal', item)
+        directory = bytestring_path(self.external_config['directory'].get())
+        dest, = [os.path.join(root, name)
+                 for root, _, names in os.walk(directory)
+                 for name in names if name.endswith(b'.ogg')]
+        self.assertFileTag(dest, b'ISOGG')
+        partial = alternatives.partial_path(dest)
+        with open(syspath(partial), 'wb') as f:
+            f.write(b'partial')
+
+        out = self.runcli('alt', 'update', '--resume', 'myexternal')
+        self.assertIn('Kept 1 files', out)
+        item.load()
+        self.assertEqual(bytestring_path(item['alt.myexternal']), dest)
+        self.assertFalse(os.path.exists(syspath(partial)))
+        with open(encoded) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_interrupted_update_without_resume(self):
+        item = self.add_track(myexternal='true', format='mp4')
+        with patch.object(alternatives.External, 'added',
+                          side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.runcli('alt', 'update', 'myexternal')
+
+        out = self.runcli('alt', 'update', 'myexternal')
+        self.assertIn('use --resume', out)
+        item.load()
+        self.assertFileTag(item['alt.myexternal'], b'ISOGG')
+
+    def test_pipeline(self):
+        self.external_config['pipeline'] = \
+            u'sh | sh "cat; printf ISOGG" | sh'
+        item = self.add_track(myexternal='true', format='mp4')
+        self.runcli('alt', 'update', 'myexternal')
+        item.load()
+        self.assertFileTag(item['alt.myexternal'], b'ISOGG')
+
+    def test_pipeline_fails_with_stage(self):
+        pipeline = alternatives.Pipeline.parse(u'sh | sh "exit 3" | sh')
+        source = os.path.join(self.fixture_dir, b'min.mp3')
+        dest = os.path.join(bytestring_path(self.mkdtemp()), b'min.ogg')
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            pipeline.run(source, dest)
+        self.assertEqual(context.exception.returncode, 3)
+
+    def test_pipeline_configuration(self):
+        pipeline = alternatives.Pipeline.parse(
+            u'mac | sox rate 44100 | lame -V2')
+        self.assertEqual(pipeline.command, b'mac | sox rate 44100 | lame -V2')
+        for value in [u'lame', u'lame | mpg123', u'sox | | lame',
+                      u'mpg123 | nosuchprogram']:
+            with self.assertRaises(alternatives.UserError):
+                alternatives.Pipeline.parse(value)
+
+    def test_cache_reuses_transcode(self):
+        encoded = os.path.join(self.mkdtemp(), 'encoded')
+        self.config['convert']['formats']['ogg'] = \
+            'bash -c "cp \'$source\' \'$dest\'; printf ISOGG >> \'$dest\';' \
+            'echo >> {0}"'.format(encoded)
+        self.config['alternatives']['cache_dir'] = self.mkdtemp()
+        self.config['alternatives']['cache_size'] = '10M'
+        self.config['alternatives']['other'] = {
+            'directory': self.mkdtemp(),
+            'query': u'myexternal:true',
+            'formats': 'ogg',
+        }
+        item = self.add_track(myexternal='true', format='mp4')
+        self.runcli('alt', 'update', 'myexternal')
+        self.runcli('alt', 'update', 'other')
+        item.load()
+        self.assertFileTag(item['alt.other'], b'ISOGG')
+        with open(encoded) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+        out = self.runcli('alt', 'cache')
+        self.assertIn('1 files', out)
+        out = self.runcli('alt', 'cache', 'clear')
+        self.assertIn('Removed 1 files', out)
+        self.assertIn('0 files', out)
+
+    def test_decoded_source_records_convert_command(self):
+        self.external_config['pipeline'] = \
+            u'sh | sh "cat; printf ISOGG" | sh'
+        self.config['alternatives']['cache_dir'] = self.mkdtemp()
+        self.config['alternatives']['cache_size'] = '10M'
+        plugin = alternatives.SmartAlternativesPlugin()
+        plugin.build_queries()
+        external = plugin.alternative('myexternal', self.lib).externals[0]
+        item = self.add_track(myexternal='true', format='mp4')
+        source = os.path.join(bytestring_path(self.mkdtemp()), b'min.wav')
+        shutil.copy(item.path, source)
+
+        with patch.object(external, 'measure') as measure:
+            external.convert(item, source)
+        self.assertEqual(measure.call_args[0][0],
+                         external.convert_cmd.decode('utf-8'))
+        self.assertTrue(external.cache.contains(external.cache.key(
+            item.path, external.convert_cmd, external.ext)))
+        self.assertFalse(external.cached(item))
+        plugin.close_state()
+
     def test_skip_convert_for_same_format(self):
         item = self.add_track(myexternal='true')
         item['format'] = 'OGG'
@@ -330,3 +818,585 @@ class ExternalRemovableTest(TestHelper):
             self.assertNotIn('Do you want to create the collection?', out)
         item.load()
         self.assertIn('alt.myexternal', item)
+
+
+class SymlinkViewTest(TestHelper):
+
+    def setUp(self):
+        super(SymlinkViewTest, self).setUp()
+        self.set_paths_config({'default': '$artist/$album/$title'})
+        self.config['alternatives'] = {
+            'by-year': {
+                'paths': {'default': '$year/$album/$title'},
+                'formats': 'link',
+                'query': u'onview:true',
+            }
+        }
+
+    def test_rebuild(self):
+        kept = self.add_track(album=u'kept', year=1982, onview=u'true')
+        removed = self.add_track(album=u'removed', year=1982, onview=u'true')
+        self.runcli('alt', 'update', 'by-year')
+        old_link = self.lib_path(b'by-year/1982/removed/track 1.mp3')
+        self.assertTrue(os.path.islink(old_link))
+
+        removed['onview'] = u'false'
+        removed.store()
+        kept.year = 1983
+        kept.store()
+        out = self.runcli('alt', 'update', '--rebuild', 'by-year')
+        self.assertIn('with 1 links', out)
+
+        self.assertFalse(os.path.lexists(old_link))
+        new_link = self.lib_path(b'by-year/1983/kept/track 1.mp3')
+        self.assertSymlink(new_link, kept.path)
+        kept.load()
+        self.assertEqual(bytestring_path(kept['alt.by-year']), new_link)
+        removed.load()
+        self.assertNotIn('alt.by-year', removed)
+        self.assertEqual([name for name in os.listdir(self.libdir)
+                          if name.startswith(b'.')], [])
+
+    def test_update_after_rebuild(self):
+        self.add_track(year=1982, onview=u'true')
+        self.runcli('alt', 'update', '--rebuild', 'by-year')
+        out = self.runcli('alt', 'update', '--full', 'by-year')
+        self.assertEqual([line for line in out.splitlines()
+                          if line[:1] in '+->'], [])
+
+    def test_exchange_paths(self):
+        first = bytestring_path(self.mkdtemp())
+        second = bytestring_path(self.mkdtemp())
+        open(os.path.join(first, b'first'), 'w').close()
+        alternatives.exchange_paths(first, second)
+        self.assertEqual(os.listdir(first), [])
+        self.assertEqual(os.listdir(second), [b'first'])
+
+    def test_rebuild_keeps_other_files(self):
+        self.add_track(year=1982, onview=u'true')
+        self.runcli('alt', 'update', 'by-year')
+        other = self.lib_path(b'by-year/notes.txt')
+        open(other, 'w').close()
+        out = self.runcli('alt', 'update', '--rebuild', 'by-year')
+        self.assertIn(u'holds files that are not links', out)
+        self.assertTrue(os.path.isfile(other))
+
+    def test_rebuild_directory_with_separator(self):
+        self.config['alternatives']['by-year']['directory'] = \
+            self.lib_path(b'by-year').decode('utf8') + u'//'
+        item = self.add_track(album=u'a', year=1982, onview=u'true')
+        self.runcli('alt', 'update', '--rebuild', 'by-year')
+        self.assertSymlink(self.lib_path(b'by-year/1982/a/track 1.mp3'),
+                           item.path)
+
+    def test_remove_links(self):
+        root = bytestring_path(self.mkdtemp())
+        os.makedirs(os.path.join(root, b'a', b'b'))
+        os.symlink(b'/nonexistent', os.path.join(root, b'a', b'b', b'link'))
+        open(os.path.join(root, b'a', b'kept'), 'w').close()
+        open(os.path.join(root, alternatives.MANIFEST_FILE), 'w').close()
+        self.assertEqual(alternatives.remove_links(root),
+                         [os.path.join(root, b'a', b'kept')])
+        self.assertEqual(os.listdir(root), [b'a'])
+        self.assertEqual(os.listdir(os.path.join(root, b'a')), [b'kept'])
+
+
+class MembershipTest(TestHelper):
+
+    def setUp(self):
+        super(MembershipTest, self).setUp()
+        self.add_album(artist='Bach', onplayer='true')
+        album = self.add_album(artist='Beethoven')
+        album['onplayer'] = 'true'
+        album.store()
+        self.add_track(artist='Mozart', year=1791)
+        self.add_track(artist='Bartok', year=1921)
+
+    def external(self, query):
+        self.config['alternatives'] = {'test': {'query': query}}
+        plugin = alternatives.SmartAlternativesPlugin()
+        plugin.build_queries()
+        return plugin.alternative('test', self.lib).externals[0]
+
+    def test_sql_matches_python(self):
+        for query in [u'', u'onplayer:true', u'^onplayer:true',
+                      u'artist:Bach', u'year:1700..1800', u'Mozart',
+                      u'onplayer:tr year:1791', u'onplayer:true , Bartok']:
+            external = self.external(query)
+            python_ids = set(item.id for item, _ in external.match_items())
+            self.assertEqual(external.matched_ids(), python_ids, query)
+            self.assertEqual(external.matched_ids(ids=[1, 3]),
+                             python_ids & set([1, 3]), query)
+
+    def test_regexp_falls_back_to_python(self):
+        external = self.external(u'artist::^B')
+        self.assertIsNone(external.matched_ids())
+        actions = list(external.items_actions())
+        self.assertEqual(len(actions), 3)
+
+    def test_one_scan_for_all_alternatives(self):
+        queries = [u'onplayer:true', u'artist:Bach', u'year:1700..1800',
+                   u'artist::^B', u'title::.', u'']
+        self.config['alternatives'] = dict(
+            ('alt{0}'.format(i), {'query': query})
+            for i, query in enumerate(queries))
+        plugin = alternatives.SmartAlternativesPlugin()
+        externals = [plugin.alternative('alt{0}'.format(i),
+                                        self.lib).externals[0]
+                     for i in range(len(queries))]
+        expected = [set(item.id for item, _ in external.match_items())
+                    for external in externals]
+
+        membership = plugin.membership(self.lib)
+        for external in externals:
+            membership.register(external)
+        with patch.object(self.lib, 'items',
+                          wraps=self.lib.items) as items:
+            for external, ids in zip(externals, expected):
+                self.assertEqual(set(membership.matched(external)), ids)
+                self.assertEqual(set(membership.paths(external)), set())
+        # One pass for both queries without an SQL equivalent
+        self.assertEqual(items.call_count, 1)
+
+
+class RegistryTest(TestHelper):
+
+    def setUp(self):
+        super(RegistryTest, self).setUp()
+        self.config['alternatives'] = {'alternatives': [{
+            'name': 'multi',
+            'query': [u'onplayer:true', u'year:2000..'],
+            'directories': [
+                {'directory': 'relative', 'formats': 'ogg mp3'},
+                {'directory': self.mkdtemp(), 'formats': 'link',
+                 'paths': {'default': u'$title'}},
+            ],
+        }]}
+        self.plugin = alternatives.SmartAlternativesPlugin()
+
+    def test_compiled_once(self):
+        parse = alternatives.parse_query_string
+        with patch('beetsplug.alternatives.parse_query_string',
+                   side_effect=parse) as parse_query:
+            registry = self.plugin.registry(self.lib)
+            self.assertIs(self.plugin.registry(self.lib), registry)
+        # Item and album query, two strings each
+        self.assertEqual(parse_query.call_count, 4)
+
+        spec = registry['multi']
+        self.assertIsInstance(spec.query, alternatives.OrQuery)
+        relative, view = spec.directories
+        self.assertEqual(relative.path_key, u'alt.multi')
+        self.assertEqual(relative.formats, (u'ogg', u'mp3'))
+        self.assertEqual(relative.directory,
+                         os.path.join(self.libdir, b'relative'))
+        self.assertEqual(view.path_key, u'alt.multi.1')
+        (query, template), = view.path_formats
+        self.assertEqual((query, template.original), (u'default', u'$title'))
+
+    def test_config_change_compiles_again(self):
+        registry = self.plugin.registry(self.lib)
+        config = self.config['alternatives'].get()
+        config['alternatives'][0]['query'] = u'x:y'
+        self.config['alternatives'] = config
+        changed = self.plugin.registry(self.lib)
+        self.assertIsNot(changed, registry)
+        self.assertNotEqual(changed['multi'].query, registry['multi'].query)
+
+
+class DestinationTest(TestHelper):
+
+    def setUp(self):
+        super(DestinationTest, self).setUp()
+        self.directory = self.mkdtemp()
+        self.item = self.add_track(title=u'a title')
+
+    def external(self, path_format):
+        self.config['alternatives'] = {'test': {
+            'query': u'',
+            'directory': self.directory,
+            'paths': {'default': path_format},
+        }}
+        plugin = alternatives.SmartAlternativesPlugin()
+        plugin.build_queries()
+        external = plugin.alternative('test', self.lib).externals[0]
+        external.open_manifest()
+        return external
+
+    def test_reuse_destination(self):
+        external = self.external(u'$artist/$title')
+        dest = external.destination(self.item)
+        external.close_manifest()
+
+        external = self.external(u'$artist/$title')
+        with patch.object(Item, 'destination') as destination:
+            self.assertEqual(external.destination(self.item), dest)
+        self.assertFalse(destination.called)
+
+        self.item.title = u'another title'
+        self.assertNotEqual(external.destination(self.item), dest)
+        external.close_manifest()
+
+    def test_paths_change(self):
+        external = self.external(u'$artist/$title')
+        external.destination(self.item)
+        external.close_manifest()
+
+        external = self.external(u'$title')
+        self.assertEqual(external.destination(self.item),
+                         os.path.join(bytestring_path(self.directory),
+                                      b'a title.mp3'))
+        external.close_manifest()
+
+    def test_aunique_is_not_kept(self):
+        external = self.external(u'$album%aunique{}/$title')
+        dest = external.destination(self.item)
+        self.assertEqual(external.destination(self.item), dest)
+        external.close_manifest()
+
+        external = self.external(u'$album%aunique{}/$title')
+        with patch.object(Item, 'destination', return_value=dest) as \
+                destination:
+            external.destination(self.item)
+        self.assertTrue(destination.called)
+        external.close_manifest()
+
+
+class WorkerTest(TestCase):
+
+    def test_largest_job_first(self):
+        order = []
+        worker = alternatives.Worker(order.append, max_workers=1,
+                                     cost=lambda n: n, window=1)
+        for n in [3, 10, 1, 7]:
+            worker.submit(n)
+        self.assertEqual(order, [])
+        list(worker.as_completed())
+        worker.shutdown()
+        self.assertEqual(order, [10, 7, 3, 1])
+
+    def test_bounded_window(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def job(n):
+            with lock:
+                running.append(n)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(n)
+            return n
+
+        worker = alternatives.Worker(job, max_workers=4, window=2)
+        for n in range(10):
+            worker.submit(n)
+        self.assertEqual(sorted(worker.as_completed()), list(range(10)))
+        worker.shutdown()
+        self.assertLessEqual(max(peak), 2)
+
+    def test_group_limit(self):
+        running = {'slow': 0, 'fast': 0}
+        peak = {'slow': 0, 'fast': 0}
+        finished = []
+        lock = threading.Lock()
+
+        def job(group, n):
+            with lock:
+                running[group] += 1
+                peak[group] = max(peak[group], running[group])
+            time.sleep(0.02 if group == 'slow' else 0.001)
+            with lock:
+                running[group] -= 1
+                finished.append(group)
+
+        worker = alternatives.Worker(
+            job, max_workers=4, groups=lambda group, n: [group],
+            limit=lambda group: 1 if group == 'slow' else 0)
+        for n in range(4):
+            worker.submit('slow', n)
+        for n in range(8):
+            worker.submit('fast', n)
+        list(worker.as_completed())
+        worker.shutdown()
+        self.assertEqual(peak['slow'], 1)
+        self.assertGreater(peak['fast'], 1)
+        # The slow jobs did not hold up the fast ones
+        self.assertEqual(finished[-1], 'slow')
+
+    def test_cancel_on_interrupt(self):
+        done = []
+        worker = alternatives.Worker(done.append, max_workers=1, window=1)
+        for n in range(5):
+            worker.submit(n)
+        results = worker.as_completed()
+        next(results)
+        results.close()
+        worker.shutdown()
+        self.assertLess(len(done), 5)
+
+    def test_alternatives_start_concurrently(self):
+        started = dict((name, threading.Event()) for name in 'abc')
+        running = {}
+        peak = {}
+        lock = threading.Lock()
+
+        class Alternative(object):
+            def __init__(self, name, directory, waits_for=None):
+                self.name = name
+                self.directory = directory
+                self.waits_for = waits_for
+                self.saw = None
+
+            def pending(self, full):
+                return None, None
+
+            def ask_create(self, create):
+                return {}
+
+            def directories(self):
+                return set([self.directory])
+
+            def start(self, fanout, seq, ids, **kwargs):
+                with lock:
+                    running[self.directory] = \
+                        running.get(self.directory, 0) + 1
+                    peak[self.directory] = max(peak.get(self.directory, 0),
+                                               running[self.directory])
+                started[self.name].set()
+                if self.waits_for:
+                    self.saw = started[self.waits_for].wait(5)
+                time.sleep(0.01)
+                with lock:
+                    running[self.directory] -= 1
+
+            def finish(self):
+                pass
+
+            def close(self):
+                pass
+
+        alts = [Alternative('a', 'x', 'b'), Alternative('b', 'y', 'a'),
+                Alternative('c', 'x')]
+        alternatives.update_alternatives(alts, max_workers=4)
+        self.assertTrue(alts[0].saw)
+        self.assertTrue(alts[1].saw)
+        self.assertEqual(peak, {'x': 1, 'y': 1})
+
+
+class IdSetTest(TestCase):
+
+    def test_set_operations(self):
+        a = alternatives.IdSet([1, 5, 9, 100])
+        b = alternatives.IdSet([5, 7, 9])
+        self.assertIn(100, a)
+        self.assertNotIn(7, a)
+        self.assertNotIn(1000, a)
+        self.assertEqual(list(a - b), [1, 100])
+        self.assertEqual(list(b - a), [7])
+        self.assertEqual(list(a & b), [5, 9])
+        self.assertEqual(list(a | b), [1, 5, 7, 9, 100])
+        self.assertEqual(len(a | b), 5)
+
+    def test_add_discard(self):
+        ids = alternatives.IdSet()
+        self.assertFalse(ids)
+        ids.add(64)
+        ids.add(3)
+        ids.discard(64)
+        ids.discard(2000)
+        self.assertTrue(ids)
+        self.assertEqual(list(ids), [3])
+
+    def test_bytes(self):
+        ids = alternatives.IdSet(range(0, 1000, 7))
+        copy = alternatives.IdSet(data=ids.tobytes())
+        self.assertEqual(list(copy), list(range(0, 1000, 7)))
+        self.assertEqual(len(ids.tobytes()), 1000 // 8)
+
+
+class TranscodeCacheTest(TestHelper):
+
+    def setUp(self):
+        super(TranscodeCacheTest, self).setUp()
+        self.dir = bytestring_path(self.mkdtemp())
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_digest_ignores_tags(self):
+        source = os.path.join(self.fixture_dir, b'min.mp3')
+        tagged = os.path.join(self.dir, b'tagged.mp3')
+        shutil.copy(source, tagged)
+        mediafile = MediaFile(tagged)
+        mediafile.title = u'another title'
+        mediafile.save()
+        self.assertEqual(alternatives.audio_digest(source),
+                         alternatives.audio_digest(tagged))
+
+    def test_evict_least_recently_used(self):
+        cache = alternatives.TranscodeCache(os.path.join(self.dir, b'c'), 25)
+        self.addCleanup(cache.close)
+        for key in ['aa', 'bb']:
+            cache.store(key, b'ogg', self.write(b'src', b'0123456789'))
+            time.sleep(0.01)
+        self.assertTrue(cache.fetch('aa', b'ogg', os.path.join(self.dir,
+                                                               b'dest')))
+        time.sleep(0.01)
+        cache.store('cc', b'ogg', self.write(b'src', b'0123456789'))
+
+        self.assertTrue(cache.contains('aa'))
+        self.assertFalse(cache.contains('bb'))
+        self.assertTrue(cache.contains('cc'))
+        self.assertEqual(cache.stats(), (2, 20))
+
+    def test_fetch_copies_outside_lock(self):
+        cache = alternatives.TranscodeCache(os.path.join(self.dir, b'c'), 25)
+        self.addCleanup(cache.close)
+        cache.store('aa', b'ogg', self.write(b'src', b'0123456789'))
+        copy_file = alternatives.copy_file
+        unlocked = []
+
+        def copy(path, dest, method):
+            unlocked.append(cache._lock.acquire(False))
+            if unlocked[-1]:
+                cache._lock.release()
+                # A store from another thread must not evict it meanwhile
+                cache.prune(0)
+            return copy_file(path, dest, method)
+
+        dest = os.path.join(self.dir, b'dest')
+        with patch.object(alternatives, 'copy_file', side_effect=copy):
+            self.assertTrue(cache.fetch('aa', b'ogg', dest))
+        self.assertEqual(unlocked, [True])
+        self.assertTrue(cache.contains('aa'))
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_fetch_removed_file(self):
+        cache = alternatives.TranscodeCache(os.path.join(self.dir, b'c'), 25)
+        self.addCleanup(cache.close)
+        cache.store('aa', b'ogg', self.write(b'src', b'0123456789'))
+
+        def copy(path, dest, method):
+            os.remove(path)
+            raise OSError(errno.ENOENT, 'No such file or directory')
+
+        with patch.object(alternatives, 'copy_file', side_effect=copy):
+            self.assertFalse(cache.fetch('aa', b'ogg',
+                                         os.path.join(self.dir, b'dest')))
+        self.assertFalse(cache.contains('aa'))
+
+
+class CapabilitiesTest(TestHelper):
+
+    def setUp(self):
+        super(CapabilitiesTest, self).setUp()
+        self.bin = self.mkdtemp()
+        self.calls = os.path.join(self.bin, 'calls')
+        self.program('lame', 'echo "LAME 64bits version 3.100"')
+        self.program('ffmpeg', """case "$*" in
+            *-decoders*) printf ' A....D flac    FLAC\\n' ;;
+            *-encoders*) printf ' A....D libmp3lame MP3\\n' ;;
+            *) echo 'ffmpeg version 6.0' ;;
+        esac""")
+        patcher = patch.dict(os.environ, {'PATH': self.bin})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = os.path.join(self.mkdtemp(), 'state.db')
+
+    def program(self, name, script):
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\necho {0} >> {1}\n{2}\n'
+                    .format(name, self.calls, script))
+        os.chmod(path, 0o755)
+        return path
+
+    def probes(self):
+        if not os.path.exists(self.calls):
+            return 0
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def test_probe_is_cached(self):
+        capabilities = alternatives.Capabilities(self.db)
+        info = capabilities.probe(alternatives.LAMEProgram)
+        self.assertEqual(info.version, u'LAME 64bits version 3.100')
+        self.assertEqual(info.encodes, frozenset(['mp3']))
+        info = capabilities.probe(alternatives.FFMPEGProgram)
+        self.assertEqual(info.decodes, frozenset(['flac']))
+        self.assertEqual(info.encodes, frozenset(['mp3']))
+        self.assertIsNone(capabilities.probe(alternatives.SOXProgram))
+        capabilities.close()
+        self.assertEqual(self.probes(), 4)
+
+        capabilities = alternatives.Capabilities(self.db)
+        info = capabilities.probe(alternatives.FFMPEGProgram)
+        self.assertEqual(info.decodes, frozenset(['flac']))
+        capabilities.close()
+        self.assertEqual(self.probes(), 4)
+
+        path = os.path.join(self.bin, 'ffmpeg')
+        os.utime(path, (0, 0))
+        capabilities = alternatives.Capabilities(self.db)
+        capabilities.probe(alternatives.FFMPEGProgram)
+        capabilities.close()
+        self.assertEqual(self.probes(), 7)
+
+    def test_fastest_pipeline(self):
+        capabilities = alternatives.Capabilities(self.db)
+        pipeline = alternatives.Pipeline.fastest(capabilities, 'flac', 'mp3')
+        self.assertEqual(pipeline.command, b'ffmpeg | lame')
+        self.assertIsNone(alternatives.Pipeline.fastest(capabilities,
+                                                        'ape', 'mp3'))
+
+        class Measured(object):
+            def rate(self, kind):
+                elapsed = 1.0 if kind == u'ffmpeg | lame' else 0.5
+                return alternatives.Measurement(10.0, 0, elapsed)
+
+        pipeline = alternatives.Pipeline.fastest(capabilities, 'flac', 'mp3',
+                                                 Measured())
+        self.assertEqual(pipeline.command,
+                         b'ffmpeg | ffmpeg -c:a libmp3lame')
+        capabilities.close()
+
+    def test_auto_pipeline(self):
+        self.config['alternatives'] = {
+            'myexternal': {
+                'directory': self.mkdtemp(),
+                'query': u'myexternal:true',
+                'formats': 'mp3',
+                'pipeline': 'auto',
+            }
+        }
+        plugin = alternatives.SmartAlternativesPlugin()
+        plugin.build_queries()
+        external = plugin.alternative('myexternal', self.lib).externals[0]
+        item = Item(format=u'FLAC')
+        self.assertEqual(external.command(item), b'ffmpeg | lame')
+        item = Item(format=u'APE')
+        self.assertEqual(external.command(item), external.convert_cmd)
+        plugin.close_state()
+
+    def test_program_subclasses(self):
+        class GOGOProgram(alternatives.LAMEProgram):
+            name = 'gogo'
+
+        self.assertIn(GOGOProgram, alternatives.Program.programs())
+        self.assertIsInstance(alternatives.Program.named('gogo'),
+                              GOGOProgram)
+        self.assertIsInstance(alternatives.Program.named('lame'),
+                              alternatives.LAMEProgram)
+
+
+class ShellProgram(alternatives.Program):
+    name = 'sh'
+    decoder = ['-c', 'cat "$0"', '$source']
+    filter = ['-c', '$options']
+    encoder = ['-c', 'cat > "$0"', '$dest']
@@ -153,7 +153,7 @@ class TestHelper(TestCase, Assertions):
         self.addCleanup(patcher.stop)
 
         self._tempdirs = []
-        plugins._classes = set([alternatives.AlternativesPlugin,
+        plugins._classes = set([alternatives.SmartAlternativesPlugin,
                                 convert.ConvertPlugin])
         self.setup_beets()
 
@@ -276,8 +276,12 @@ class TestHelper(TestCase, Assertions):
 
 class MockedWorker(alternatives.Worker):
 
-    def __init__(self, fn, max_workers=None):
+    def __init__(self, fn, max_workers=None, cost=None, window=None,
+                 groups=None, limit=None):
+        self._queues = {}
         self._tasks = set()
+        self._running = {}
+        self._held = {}
         self._fn = fn
 
     def submit(self, *args, **kwargs):
@@ -0,0 +1,105 @@
+"""Benchmark what enabling the plugin costs commands that do not use it.
+
+Run from the test directory:
+
+    python startup_benchmark.py --runs 20 --output startup.json
+
+`beet ls` on an empty library is run with and without the plugin
+enabled.  The fastest and the median run of each are reported as one
+JSON object per line, followed by the difference between the two and
+the modules the plugin should only import for `beet alt`.
+"""
+from __future__ import print_function
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+
+RUNS = 20
+
+# Modules the plugin imports only when an alternative is updated
+DEFERRED = ['beetsplug.convert', 'beets.util.artresizer',
+            'concurrent.futures']
+
+LIST = 'import beets.ui; beets.ui.main(["ls"])'
+
+LOADED = '''
+import sys, json
+from beets import plugins
+plugins.load_plugins(["alternatives"])
+plugins.find_plugins()
+print(json.dumps([m for m in {0!r} if m in sys.modules]))
+'''.format(DEFERRED)
+
+
+def beetsdir(plugins):
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, 'config.yaml'), 'w') as f:
+        f.write('directory: {0}\n'.format(os.path.join(directory, 'music')))
+        f.write('library: {0}\n'.format(os.path.join(directory, 'lib.db')))
+        f.write('plugins: [{0}]\n'.format(', '.join(plugins)))
+    return directory
+
+
+def run(directory, code):
+    env = dict(os.environ, BEETSDIR=directory)
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return time.time() - start, output
+
+
+def measure(name, plugins, runs):
+    directory = beetsdir(plugins)
+    try:
+        # The first run writes the byte code and creates the library
+        run(directory, LIST)
+        times = sorted(run(directory, LIST)[0] for _ in range(runs))
+    finally:
+        shutil.rmtree(directory)
+    return {
+        'config': name,
+        'runs': runs,
+        'min': round(times[0], 4),
+        'median': round(times[len(times) // 2], 4),
+    }
+
+
+def main(args=None):
+    parser = OptionParser(usage=u'%prog [options]')
+    parser.add_option('--runs', type='int', default=RUNS,
+                      help='runs of each command')
+    parser.add_option('--output', help='write the results to this file')
+    options, _ = parser.parse_args(args)
+
+    results = [measure('without', [], options.runs),
+               measure('with', ['alternatives'], options.runs)]
+    results.append({
+        'config': 'difference',
+        'runs': options.runs,
+        'min': round(results[1]['min'] - results[0]['min'], 4),
+        'median': round(results[1]['median'] - results[0]['median'], 4),
+    })
+    directory = beetsdir([])
+    try:
+        loaded = json.loads(run(directory, LOADED)[1].decode('utf-8'))
+    finally:
+        shutil.rmtree(directory)
+    results.append({'config': 'deferred_imports_loaded', 'modules': loaded})
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()